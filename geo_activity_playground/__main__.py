@@ -80,6 +80,24 @@ def main() -> None:
     subparser.add_argument("--decay", type=float, default=0.05)
     subparser.add_argument("--video-width", type=int, default=1920)
     subparser.add_argument("--video-height", type=int, default=1080)
+    subparser.add_argument(
+        "--processes",
+        type=int,
+        help="number of processes that render frames, defaults to the number of CPUs",
+    )
+    subparser.add_argument("--framerate", type=int, default=30)
+    # Frames that are piped into ffmpeg cannot be resumed.
+    output_group = subparser.add_mutually_exclusive_group()
+    output_group.add_argument(
+        "--ffmpeg",
+        type=pathlib.Path,
+        help="encode the frames into this video file with ffmpeg instead of writing PNG files",
+    )
+    output_group.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip PNG frames that have already been written",
+    )
     subparser.set_defaults(func=main_heatmap_video)
 
     subparser = subparsers.add_parser(
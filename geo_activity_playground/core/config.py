@@ -5,6 +5,7 @@ import logging
 import pathlib
 from typing import Optional
 
+from .data_version import DATA_VERSION
 from .paths import new_config_file
 from .paths import strava_dynamic_config_path
 
@@ -36,6 +37,9 @@ class Config:
     kinds_without_achievements: list[str] = dataclasses.field(default_factory=list)
     metadata_extraction_regexes: list[str] = dataclasses.field(default_factory=list)
     num_processes: Optional[int] = 1
+    prerender_zoom_levels: list[int] = dataclasses.field(
+        default_factory=lambda: [10, 11, 12, 13, 14]
+    )
     privacy_zones: dict[str, list[list[float]]] = dataclasses.field(
         default_factory=dict
     )
@@ -46,6 +50,7 @@ class Config:
     strava_client_code: Optional[str] = None
     time_diff_threshold_seconds: Optional[int] = 30
     upload_password: Optional[str] = None
+    map_tile_cache_max_mb: int = 2000
     map_tile_url: str = "https://tile.openstreetmap.org/{zoom}/{x}/{y}.png"
     map_tile_attribution: str = (
         '&copy; <a href="http://www.openstreetmap.org/copyright">OpenStreetMap</a> | <a href="https://www.openstreetmap.org/fixthemap">Correct Map</a>'
@@ -75,6 +80,7 @@ class ConfigAccessor:
                 indent=2,
                 sort_keys=True,
             )
+        DATA_VERSION.bump()
 
 
 @functools.cache
@@ -0,0 +1,60 @@
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Optional
+
+from .paths import atomic_open
+from .paths import data_version_path
+
+
+class DataVersion:
+    """
+    Counter of changes to the activities, photos, explorer tiles and settings, together with the time of the last change.
+
+    The counter is stored on disk, such that changes made by another process like the command line importer are seen as well. The file is only read again when it has changed.
+    """
+
+    def __init__(self, path: Optional[pathlib.Path] = None) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._mtime: Optional[int] = None
+        self._state = {"version": 0, "modified": 0.0}
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path or data_version_path()
+
+    def get(self) -> tuple[int, float]:
+        """
+        The counter and the time of the last change in seconds since the epoch.
+        """
+        with self._lock:
+            self._reload()
+            return self._state["version"], self._state["modified"]
+
+    def bump(self) -> None:
+        with self._lock:
+            self._reload()
+            self._state = {
+                "version": self._state["version"] + 1,
+                "modified": time.time(),
+            }
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_open(self.path, "w") as f:
+                json.dump(self._state, f)
+            self._mtime = os.stat(self.path).st_mtime_ns
+
+    def _reload(self) -> None:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            with open(self.path) as f:
+                self._state = json.load(f)
+            self._mtime = mtime
+
+
+DATA_VERSION = DataVersion()
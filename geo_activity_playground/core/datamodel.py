@@ -25,6 +25,7 @@ from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
 
 from .config import Config
+from .data_version import DATA_VERSION
 from .paths import activity_extracted_meta_dir
 from .paths import activity_extracted_time_series_dir
 from .paths import TIME_SERIES_DIR
@@ -77,6 +78,24 @@ class Base(DeclarativeBase):
 
 DB = SQLAlchemy(model_class=Base)
 
+
+@sa.event.listens_for(DB.session, "after_flush")
+def _mark_changed(session: sqlalchemy.orm.Session, flush_context) -> None:
+    session.info["changed"] = True
+
+
+@sa.event.listens_for(DB.session, "after_rollback")
+def _discard_changed(session: sqlalchemy.orm.Session) -> None:
+    session.info.pop("changed", None)
+
+
+@sa.event.listens_for(DB.session, "after_commit")
+def _bump_data_version(session: sqlalchemy.orm.Session) -> None:
+    # Imports, edits and deletions all end with a commit of the changes.
+    if session.info.pop("changed", False):
+        DATA_VERSION.bump()
+
+
 activity_tag_association_table = Table(
     "activity_tag_association_table",
     Base.metadata,
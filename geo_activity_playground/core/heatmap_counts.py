@@ -0,0 +1,349 @@
+import collections
+import contextlib
+import logging
+import os
+import pathlib
+import pickle
+import shutil
+import threading
+from collections.abc import Callable
+from collections.abc import Iterator
+from typing import Optional
+
+import numpy as np
+
+from .paths import atomic_open
+from .raster_map import OSM_TILE_SIZE
+from .tasks import get_state
+from .tasks import set_state
+from .tasks import try_load_pickle
+
+logger = logging.getLogger(__name__)
+
+TILE_SHAPE = (OSM_TILE_SIZE, OSM_TILE_SIZE)
+TILE_BYTES = OSM_TILE_SIZE * OSM_TILE_SIZE * np.dtype(np.int32).itemsize
+
+# Counts are rasterized from the time series at this zoom level and above and at every `PYRAMID_STEP`-th zoom level below. The zoom levels in between are derived from the next finer one, such that a tile is summed up from at most 16 rasterized tiles.
+PYRAMID_BASE_ZOOM = 17
+PYRAMID_STEP = 3
+
+# Pixels of a tile in a checkerboard pattern.
+_CHECKERBOARD = np.indices(TILE_SHAPE).sum(axis=0).astype(np.int32) % 2
+
+
+def pack_activity_ids(activity_ids: set[int]) -> bytes:
+    """
+    Stores a set of activity ids as a bitmap with one bit per id.
+    """
+    if not activity_ids:
+        return b""
+    flags = np.zeros(max(activity_ids) + 1, dtype=bool)
+    flags[list(activity_ids)] = True
+    return np.packbits(flags, bitorder="little").tobytes()
+
+
+def is_rasterized_zoom(z: int) -> bool:
+    """
+    Whether the counts of a zoom level are rasterized instead of derived in the pyramid.
+    """
+    return z >= PYRAMID_BASE_ZOOM or (PYRAMID_BASE_ZOOM - z) % PYRAMID_STEP == 0
+
+
+def unpack_activity_ids(packed: bytes) -> set[int]:
+    flags = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), bitorder="little")
+    return set(np.flatnonzero(flags).tolist())
+
+
+def downsample_counts(children: list[list[np.ndarray]]) -> np.ndarray:
+    """
+    Counts of a tile from the counts of its 2×2 children at the next zoom level, given as rows of columns.
+
+    Summing 2×2 pixel blocks halves the width of a line and doubles its counts along the length. Dividing by two keeps the sum across a line, which is what a line rasterized at the coarser zoom would have. Odd sums are rounded up on every other pixel in a checkerboard pattern, such that the counts are kept on average and faint lines neither vanish nor get brighter with every level.
+    """
+    summed = (
+        np.block(children).reshape(OSM_TILE_SIZE, 2, OSM_TILE_SIZE, 2).sum(axis=(1, 3))
+    )
+    halved, remainder = np.divmod(summed, 2)
+    return halved + remainder * _CHECKERBOARD
+
+
+class _CountChunk:
+    """
+    Counts of the map tiles in a square block of tiles, stored in one memory-mapped file.
+
+    Every tile that has counts gets a slot in the file. The slots, the activities that have been added to each tile and the latest revision among them are kept in a small index next to it. The index is only written by `flush_index`, such that many updated tiles lead to a single write. Until then a marker file shows that the index on disk is behind the counts, and a chunk with such a marker is discarded when it is loaded again.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.counts_path = path.with_suffix(".counts")
+        self.index_path = path.with_suffix(".pickle")
+        self.dirty_path = path.with_suffix(".dirty")
+        self.lock = threading.Lock()
+        # Number of requests that currently use the chunk, it isn't closed while that is not zero.
+        self.users = 0
+        index = try_load_pickle(self.index_path)
+        if (
+            index is None
+            or self.dirty_path.exists()
+            or self._file_size() < len(index["slots"]) * TILE_BYTES
+        ):
+            self.counts_path.unlink(missing_ok=True)
+            self.dirty_path.unlink(missing_ok=True)
+            index = {"slots": {}, "applied": {}, "revisions": {}}
+        self.slots: dict[tuple[int, int], int] = index["slots"]
+        self.applied: dict[tuple[int, int], bytes] = index["applied"]
+        self.revisions: dict[tuple[int, int], int] = index["revisions"]
+        self.dirty = False
+        self._counts: Optional[np.memmap] = None
+
+    def read(self, tile: tuple[int, int]) -> np.ndarray:
+        slot = self.slots.get(tile, None)
+        if slot is None:
+            return np.zeros(TILE_SHAPE, dtype=np.int32)
+        return np.array(self._get_counts()[slot])
+
+    def write(
+        self,
+        tile: tuple[int, int],
+        counts: np.ndarray,
+        activity_ids: set[int],
+        revision: int,
+    ) -> None:
+        if not self.dirty:
+            self.dirty_path.parent.mkdir(parents=True, exist_ok=True)
+            self.dirty_path.touch()
+            self.dirty = True
+        slot = self.slots.get(tile, None)
+        if slot is None:
+            slot = len(self.slots)
+            self._counts = None
+            with open(self.counts_path, "ab") as f:
+                f.truncate((slot + 1) * TILE_BYTES)
+            self.slots[tile] = slot
+        self._get_counts()[slot] = counts
+        self.applied[tile] = pack_activity_ids(activity_ids)
+        self.revisions[tile] = revision
+
+    def flush_index(self) -> None:
+        if not self.dirty:
+            return
+        self._get_counts().flush()
+        with atomic_open(self.index_path, "wb") as f:
+            pickle.dump(
+                {
+                    "slots": self.slots,
+                    "applied": self.applied,
+                    "revisions": self.revisions,
+                },
+                f,
+            )
+        self.dirty_path.unlink(missing_ok=True)
+        self.dirty = False
+
+    def close(self) -> None:
+        """
+        Writes the index and unmaps the counts, which closes the file.
+        """
+        self.flush_index()
+        # Only copies of the counts are handed out, so this is the last reference to the map.
+        self._counts = None
+
+    def _get_counts(self) -> np.memmap:
+        if self._counts is None:
+            self._counts = np.memmap(
+                self.counts_path,
+                dtype=np.int32,
+                mode="r+",
+                shape=(len(self.slots), *TILE_SHAPE),
+            )
+        return self._counts
+
+    def _file_size(self) -> int:
+        try:
+            return os.path.getsize(self.counts_path)
+        except FileNotFoundError:
+            return 0
+
+
+class HeatmapCountStore:
+    """
+    Heatmap counts of the unfiltered map tiles of all zoom levels.
+
+    Per zoom level the map tiles are grouped into chunks of `CHUNK_SIZE`² tiles. Each chunk is a single memory-mapped file with a slot per tile and an index with a bitmap of the activities that have been rasterized into each tile. A tile that is up to date is served by reading its slot, only new activities lead to a write. The index also keeps the latest revision of the activities of each tile, a tile with a changed activity is computed again. The indices of changed chunks are written together `INDEX_FLUSH_DELAY` seconds after the first change.
+
+    At most `MAX_OPEN_CHUNKS` chunks are kept open, the least recently used ones are closed.
+
+    Tiles of zoom levels that are not rasterized, see `is_rasterized_zoom`, are derived from their children with `get_derived_counts`. Only tiles near the requested ones are thus stored, and an activity is rasterized once per rasterized zoom level instead of once per zoom level.
+    """
+
+    CHUNK_SIZE = 16
+    MAX_OPEN_CHUNKS = 32
+    INDEX_FLUSH_DELAY = 5.0
+    # Stored counts of a different version are discarded.
+    VERSION = 5
+
+    def __init__(
+        self,
+        base_dir: pathlib.Path,
+        activity_revision: Callable[[int], int] = lambda activity_id: 0,
+    ) -> None:
+        """
+        `activity_revision` returns a number that changes whenever the activity with the given id is changed.
+        """
+        self.base_dir = base_dir
+        self._activity_revision = activity_revision
+        self._chunks: collections.OrderedDict[tuple[int, int, int], _CountChunk] = (
+            collections.OrderedDict()
+        )
+        self._checked_zooms: set[int] = set()
+        self._lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        # Zoom levels of another version are removed right away, also the ones that are not requested anymore.
+        if base_dir.exists():
+            for zoom_dir in base_dir.iterdir():
+                if (
+                    zoom_dir.is_dir()
+                    and get_state(zoom_dir / "version.json", None) != self.VERSION
+                ):
+                    shutil.rmtree(zoom_dir, ignore_errors=True)
+
+    def get_counts(
+        self,
+        x: int,
+        y: int,
+        z: int,
+        activity_ids: set[int],
+        rasterize: Callable[[set[int]], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Counts of a tile with exactly the given activities.
+
+        Activities that have not been added yet are passed to `rasterize`. If activities have been removed or changed, the tile is computed from scratch.
+        """
+        tile = (x, y)
+        revision = self._get_revision(activity_ids)
+        with self._use_chunk(x, y, z) as chunk:
+            applied = unpack_activity_ids(chunk.applied.get(tile, b""))
+            previous_revision = chunk.revisions.get(tile, 0)
+            if applied == activity_ids and revision == previous_revision:
+                return chunk.read(tile)
+            if applied - activity_ids or (
+                self._get_revision(applied) != previous_revision
+            ):
+                logger.warning(
+                    f"Resetting heatmap counts for {x=}/{y=}/{z=} because activities have been removed or changed."
+                )
+                counts = rasterize(activity_ids)
+            else:
+                counts = chunk.read(tile) + rasterize(activity_ids - applied)
+            chunk.write(tile, counts, activity_ids, revision)
+            return counts
+
+    def get_derived_counts(
+        self,
+        x: int,
+        y: int,
+        z: int,
+        activity_ids: set[int],
+        derive: Callable[[], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Counts of a tile that is computed as a whole from other tiles, for instance its children in the pyramid.
+
+        The tile is derived again whenever its activities differ from the ones it has been derived with or one of them has changed.
+        """
+        tile = (x, y)
+        revision = self._get_revision(activity_ids)
+        with self._use_chunk(x, y, z) as chunk:
+            if (
+                unpack_activity_ids(chunk.applied.get(tile, b"")) == activity_ids
+                and chunk.revisions.get(tile, 0) == revision
+            ):
+                return chunk.read(tile)
+            counts = derive()
+            chunk.write(tile, counts, activity_ids, revision)
+            return counts
+
+    def flush(self) -> None:
+        """
+        Writes the indices of all changed chunks.
+        """
+        with self._lock:
+            self._flush_timer = None
+            chunks = list(self._chunks.values())
+        for chunk in chunks:
+            with chunk.lock:
+                chunk.flush_index()
+
+    def close(self) -> None:
+        """
+        Cancels the pending flush, writes the indices and closes all chunks.
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            chunks = list(self._chunks.values())
+            self._chunks.clear()
+        for chunk in chunks:
+            with chunk.lock:
+                chunk.close()
+
+    def _get_revision(self, activity_ids: set[int]) -> int:
+        # Activities get a new revision when they change, so the latest one changes as well.
+        return max(map(self._activity_revision, activity_ids), default=0)
+
+    @contextlib.contextmanager
+    def _use_chunk(self, x: int, y: int, z: int) -> Iterator[_CountChunk]:
+        """
+        Locks the chunk of a tile for reading and writing and keeps it open meanwhile.
+        """
+        with self._lock:
+            chunk = self._get_chunk(x, y, z)
+            chunk.users += 1
+        try:
+            with chunk.lock:
+                yield chunk
+                changed = chunk.dirty
+        finally:
+            with self._lock:
+                chunk.users -= 1
+        if changed:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        with self._lock:
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.INDEX_FLUSH_DELAY, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _get_chunk(self, x: int, y: int, z: int) -> _CountChunk:
+        # Needs to be called with the lock held.
+        key = (z, x // self.CHUNK_SIZE, y // self.CHUNK_SIZE)
+        if z not in self._checked_zooms:
+            version_path = self.base_dir / str(z) / "version.json"
+            if get_state(version_path, None) != self.VERSION:
+                shutil.rmtree(version_path.parent, ignore_errors=True)
+                set_state(version_path, self.VERSION)
+            self._checked_zooms.add(z)
+        chunk = self._chunks.get(key, None)
+        if chunk is None:
+            chunk = _CountChunk(self.base_dir / str(z) / f"{key[1]}-{key[2]}")
+            self._chunks[key] = chunk
+            self._close_unused_chunks(key)
+        else:
+            self._chunks.move_to_end(key)
+        return chunk
+
+    def _close_unused_chunks(self, keep: tuple[int, int, int]) -> None:
+        # Needs to be called with the lock held.
+        unused = [
+            key
+            for key, chunk in self._chunks.items()
+            if chunk.users == 0 and key != keep
+        ]
+        for key in unused[: len(self._chunks) - self.MAX_OPEN_CHUNKS]:
+            chunk = self._chunks.pop(key)
+            with chunk.lock:
+                chunk.close()
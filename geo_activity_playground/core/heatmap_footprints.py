@@ -0,0 +1,190 @@
+import collections
+import dataclasses
+import pathlib
+import shutil
+import threading
+from collections.abc import Callable
+from collections.abc import Iterable
+from typing import Optional
+
+import numpy as np
+
+from .heatmap_counts import TILE_SHAPE
+from .paths import atomic_open
+from .tasks import get_state
+from .tasks import set_state
+
+NUM_TILE_PIXELS = TILE_SHAPE[0] * TILE_SHAPE[1]
+
+
+def encode_runs(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Splits the pixels of a tile in row-major order into runs of equal counts and returns start, length and value of the runs that aren't zero.
+    """
+    flat = counts.ravel()
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(flat)) + 1])
+    lengths = np.diff(np.append(starts, len(flat)))
+    values = flat[starts]
+    keep = values != 0
+    return (
+        starts[keep].astype(np.int32),
+        lengths[keep].astype(np.int32),
+        values[keep].astype(np.int32),
+    )
+
+
+def sum_runs(starts: np.ndarray, lengths: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Adds up runs, possibly from many layers, into the counts of a tile.
+
+    Every run adds its value at its start and subtracts it after its end, the cumulative sum then has the counts.
+    """
+    difference = np.bincount(
+        np.concatenate([starts, starts + lengths]),
+        weights=np.concatenate([values, -values]),
+        minlength=NUM_TILE_PIXELS + 1,
+    )
+    return np.cumsum(difference[:NUM_TILE_PIXELS]).astype(np.int32).reshape(TILE_SHAPE)
+
+
+@dataclasses.dataclass
+class ActivityFootprint:
+    """
+    Rasterized counts of one activity at one zoom level as pixel runs per map tile.
+
+    The runs of tile `i` are the ones between `offsets[i]` and `offsets[i + 1]`.
+    """
+
+    tile_x: np.ndarray
+    tile_y: np.ndarray
+    offsets: np.ndarray
+    starts: np.ndarray
+    lengths: np.ndarray
+    values: np.ndarray
+
+    @classmethod
+    def from_tile_counts(
+        cls, tile_counts: dict[tuple[int, int], np.ndarray]
+    ) -> "ActivityFootprint":
+        runs = [encode_runs(counts) for counts in tile_counts.values()]
+        offsets = np.zeros(len(runs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(starts) for starts, _, _ in runs])
+        empty = np.zeros(0, dtype=np.int32)
+        return cls(
+            tile_x=np.array([x for x, _ in tile_counts], dtype=np.int64),
+            tile_y=np.array([y for _, y in tile_counts], dtype=np.int64),
+            offsets=offsets,
+            starts=np.concatenate([r[0] for r in runs] or [empty]),
+            lengths=np.concatenate([r[1] for r in runs] or [empty]),
+            values=np.concatenate([r[2] for r in runs] or [empty]),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            getattr(self, field.name).nbytes for field in dataclasses.fields(self)
+        )
+
+    def tile_runs(
+        self, x: int, y: int
+    ) -> Optional[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        matches = np.flatnonzero((self.tile_x == x) & (self.tile_y == y))
+        if len(matches) == 0:
+            return None
+        index = matches[0]
+        begin, end = self.offsets[index], self.offsets[index + 1]
+        return (
+            self.starts[begin:end],
+            self.lengths[begin:end],
+            self.values[begin:end],
+        )
+
+
+class HeatmapFootprintCache:
+    """
+    Rasterized footprints of single activities, from which filtered heatmap tiles are summed up.
+
+    An activity is rasterized at a zoom level once, when it is first needed, and stored as sparse pixel runs on disk. The most recently used footprints are kept in memory up to `MAX_BYTES`. A footprint is rasterized again when the revision of its activity changes.
+    """
+
+    MAX_BYTES = 64 * 1024**2
+    # Stored footprints of a different version are discarded.
+    VERSION = 3
+
+    def __init__(
+        self,
+        base_dir: pathlib.Path,
+        rasterize: Callable[[int, int], dict[tuple[int, int], np.ndarray]],
+        activity_revision: Callable[[int], int] = lambda activity_id: 0,
+    ) -> None:
+        """
+        `rasterize` is called with an activity id and a zoom level and returns the counts of all map tiles that the activity touches. `activity_revision` returns a number that changes whenever the activity with the given id is changed.
+        """
+        self.base_dir = base_dir
+        self._rasterize = rasterize
+        self._activity_revision = activity_revision
+        version_path = base_dir / "version.json"
+        if get_state(version_path, None) != self.VERSION:
+            shutil.rmtree(base_dir, ignore_errors=True)
+            set_state(version_path, self.VERSION)
+        self._footprints: collections.OrderedDict[
+            tuple[int, int], tuple[int, ActivityFootprint]
+        ] = collections.OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def get_counts(
+        self, x: int, y: int, z: int, activity_ids: Iterable[int]
+    ) -> np.ndarray:
+        layers = []
+        for activity_id in activity_ids:
+            runs = self.get_footprint(activity_id, z).tile_runs(x, y)
+            if runs is not None:
+                layers.append(runs)
+        if not layers:
+            return np.zeros(TILE_SHAPE, dtype=np.int32)
+        return sum_runs(*(np.concatenate(column) for column in zip(*layers)))
+
+    def get_footprint(self, activity_id: int, z: int) -> ActivityFootprint:
+        key = (activity_id, z)
+        path = self.base_dir / str(z) / f"{activity_id}.npz"
+        revision = self._activity_revision(activity_id)
+        with self._lock:
+            cached = self._footprints.get(key, None)
+            if cached is not None and cached[0] == revision:
+                self._footprints.move_to_end(key)
+                return cached[1]
+        footprint = None
+        if path.exists():
+            with np.load(path) as data:
+                if int(data["revision"]) == revision:
+                    footprint = ActivityFootprint(
+                        **{
+                            field.name: data[field.name]
+                            for field in dataclasses.fields(ActivityFootprint)
+                        }
+                    )
+        if footprint is None:
+            footprint = ActivityFootprint.from_tile_counts(
+                self._rasterize(activity_id, z)
+            )
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_open(path, "wb") as f:
+                np.savez(
+                    f,
+                    revision=np.int64(revision),
+                    **{
+                        field.name: getattr(footprint, field.name)
+                        for field in dataclasses.fields(footprint)
+                    },
+                )
+        with self._lock:
+            previous = self._footprints.pop(key, None)
+            if previous is not None:
+                self._num_bytes -= previous[1].nbytes
+            self._footprints[key] = (revision, footprint)
+            self._num_bytes += footprint.nbytes
+            while self._num_bytes > self.MAX_BYTES and len(self._footprints) > 1:
+                _, (_, evicted) = self._footprints.popitem(last=False)
+                self._num_bytes -= evicted.nbytes
+        return footprint
@@ -0,0 +1,167 @@
+import dataclasses
+import datetime
+import pathlib
+import shutil
+import threading
+from collections.abc import Callable
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .heatmap_counts import HeatmapCountStore
+from .tasks import get_state
+from .tasks import set_state
+
+
+def split_date_range(
+    begin: datetime.date, end: datetime.date
+) -> tuple[list[int], list[tuple[int, int]], list[tuple[datetime.date, datetime.date]]]:
+    """
+    Splits the days from `begin` until before `end` into whole years, whole months and ranges of the remaining days.
+    """
+    years = []
+    months = []
+    days: list[tuple[datetime.date, datetime.date]] = []
+    cursor = begin
+    while cursor < end:
+        next_year = datetime.date(cursor.year + 1, 1, 1)
+        next_month = _next_month(cursor)
+        if cursor.month == 1 and cursor.day == 1 and next_year <= end:
+            years.append(cursor.year)
+            cursor = next_year
+        elif cursor.day == 1 and next_month <= end:
+            months.append((cursor.year, cursor.month))
+            cursor = next_month
+        else:
+            boundary = min(next_month, end)
+            if days and days[-1][1] == cursor:
+                days[-1] = (days[-1][0], boundary)
+            else:
+                days.append((cursor, boundary))
+            cursor = boundary
+    return years, months, days
+
+
+def _next_month(day: datetime.date) -> datetime.date:
+    return (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+class ActivityCalendar:
+    """
+    Start days of the activities, from which the activities of a year, a month or any range of days are looked up.
+
+    Days are taken from the start time as stored, which is also what the search compares against.
+    """
+
+    def __init__(self, meta: pd.DataFrame) -> None:
+        known = meta.dropna(subset=["start"])
+        days = known["start"].to_numpy().astype("datetime64[D]")
+        order = np.argsort(days, kind="stable")
+        self._days = days[order]
+        self._ids = known["id"].to_numpy()[order]
+
+    @property
+    def first_day(self) -> Optional[datetime.date]:
+        return self._days[0].item() if len(self._days) else None
+
+    @property
+    def last_day(self) -> Optional[datetime.date]:
+        return self._days[-1].item() if len(self._days) else None
+
+    @property
+    def years(self) -> list[int]:
+        if not len(self._days):
+            return []
+        return list(range(self.first_day.year, self.last_day.year + 1))
+
+    def between(self, begin: datetime.date, end: datetime.date) -> frozenset[int]:
+        """
+        Activities that start on `begin` or later and before `end`.
+        """
+        first, last = np.searchsorted(
+            self._days, [np.datetime64(begin, "D"), np.datetime64(end, "D")]
+        )
+        return frozenset(self._ids[first:last].tolist())
+
+
+@dataclasses.dataclass(frozen=True)
+class TimeSlices:
+    """
+    The activities of a range of days, divided into whole years and months that have stored heatmap layers, and the activities of the remaining days.
+    """
+
+    # Name of the layer and its activities.
+    layers: tuple[tuple[str, frozenset[int]], ...]
+    remainder: frozenset[int]
+
+    @classmethod
+    def from_date_range(
+        cls,
+        calendar: ActivityCalendar,
+        begin: Optional[datetime.date],
+        end: Optional[datetime.date],
+    ) -> "TimeSlices":
+        """
+        Open ends of the range extend to the first or last activity.
+        """
+        if calendar.first_day is None:
+            return cls((), frozenset())
+        begin = begin or calendar.first_day
+        end = end or calendar.last_day + datetime.timedelta(days=1)
+        years, months, days = split_date_range(begin, end)
+        layers = [
+            (
+                str(year),
+                calendar.between(
+                    datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+                ),
+            )
+            for year in years
+        ] + [
+            (
+                f"{year}-{month:02d}",
+                calendar.between(
+                    datetime.date(year, month, 1),
+                    _next_month(datetime.date(year, month, 1)),
+                ),
+            )
+            for year, month in months
+        ]
+        return cls(
+            tuple((name, ids) for name, ids in layers if ids),
+            frozenset().union(*(calendar.between(*days_range) for days_range in days)),
+        )
+
+
+class HeatmapLayers:
+    """
+    Heatmap counts per year and per month, such that the heatmap of a range of dates is summed up from a few layers.
+
+    Every layer is a count store of its own. Its tiles are summed up from the footprints of its activities when they are first requested, so only the requested tiles are stored and there is no pyramid.
+    """
+
+    # Stored layers of a different version are discarded.
+    VERSION = 2
+
+    def __init__(
+        self,
+        base_dir: pathlib.Path,
+        activity_revision: Callable[[int], int] = lambda activity_id: 0,
+    ) -> None:
+        self.base_dir = base_dir
+        self._activity_revision = activity_revision
+        version_path = base_dir / "version.json"
+        if get_state(version_path, None) != self.VERSION:
+            shutil.rmtree(base_dir, ignore_errors=True)
+            set_state(version_path, self.VERSION)
+        self._stores: dict[str, HeatmapCountStore] = {}
+        self._lock = threading.Lock()
+
+    def get_store(self, name: str) -> HeatmapCountStore:
+        with self._lock:
+            if name not in self._stores:
+                self._stores[name] = HeatmapCountStore(
+                    self.base_dir / name, self._activity_revision
+                )
+            return self._stores[name]
@@ -54,10 +54,16 @@ _activity_enriched_time_series_dir = _activity_enriched_dir / "Time Series"
 _activities_file = _activity_dir / "activities.parquet"
 
 _tiles_per_time_series = _cache_dir / "Tiles" / "Tiles Per Time Series"
+_explorer_tiles_dir = _cache_dir / "Explorer Tiles"
+_heatmap_counts_dir = _cache_dir / "Heatmap Counts"
+_heatmap_footprints_dir = _cache_dir / "Heatmap Footprints"
+_heatmap_downloads_dir = _cache_dir / "Heatmap Downloads"
+_heatmap_layers_dir = _cache_dir / "Heatmap Layers"
 
 _strava_api_dir = pathlib.Path("Strava API")
 _strava_dynamic_config_path = _strava_api_dir / "strava-client-id.json"
 _strava_last_activity_date_path = _cache_dir / "strava-last-activity-date.json"
+_data_version_path = _cache_dir / "data-version.json"
 _new_config_file = pathlib.Path("config.json")
 _activity_meta_override_dir = pathlib.Path("Metadata Override")
 _time_series_dir = pathlib.Path("Time Series")
@@ -71,6 +77,11 @@ activity_extracted_time_series_dir = dir_wrapper(_activity_extracted_time_series
 activity_enriched_meta_dir = dir_wrapper(_activity_enriched_meta_dir)
 activity_enriched_time_series_dir = dir_wrapper(_activity_enriched_time_series_dir)
 tiles_per_time_series = dir_wrapper(_tiles_per_time_series)
+explorer_tiles_dir = dir_wrapper(_explorer_tiles_dir)
+heatmap_counts_dir = dir_wrapper(_heatmap_counts_dir)
+heatmap_footprints_dir = dir_wrapper(_heatmap_footprints_dir)
+heatmap_downloads_dir = dir_wrapper(_heatmap_downloads_dir)
+heatmap_layers_dir = dir_wrapper(_heatmap_layers_dir)
 strava_api_dir = dir_wrapper(_strava_api_dir)
 activity_meta_override_dir = dir_wrapper(_activity_meta_override_dir)
 TIME_SERIES_DIR = dir_wrapper(_time_series_dir)
@@ -79,4 +90,5 @@ PHOTOS_DIR = dir_wrapper(_photos_dir)
 activities_file = file_wrapper(_activities_file)
 strava_dynamic_config_path = file_wrapper(_strava_dynamic_config_path)
 strava_last_activity_date_path = file_wrapper(_strava_last_activity_date_path)
+data_version_path = file_wrapper(_data_version_path)
 new_config_file = file_wrapper(_new_config_file)
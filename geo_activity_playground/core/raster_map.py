@@ -1,16 +1,20 @@
 import abc
+import collections
 import dataclasses
-import functools
+import io
 import logging
 import pathlib
-import time
+import threading
 import urllib.parse
 
 import numpy as np
-import requests
 from PIL import Image
 
 from .config import Config
+from .paths import atomic_open
+from .tile_archives import open_tile_archive
+from .tile_fetcher import mark_used
+from .tile_fetcher import TileFetcher
 from .tiles import compute_tile_float
 
 
@@ -21,6 +25,12 @@ OSM_TILE_SIZE = 256  # OSM tile size in pixel
 OSM_MAX_ZOOM = 19  # OSM maximum zoom level
 MAX_TILE_COUNT = 2000  # maximum number of tiles to download
 
+TILE_FETCHER = TileFetcher()
+
+LUMINANCE_WEIGHTS = [0.2126, 0.7152, 0.0722]
+# Tiles that a tile archive doesn't have are filled with the land color of the OpenStreetMap style.
+EMPTY_TILE_COLOR = (242, 239, 233)
+
 ## Basic data types ##
 
 
@@ -130,17 +140,91 @@ def get_sensible_zoom_level(
     return TileBounds(zoom, x_tile_min, y_tile_min, x_tile_max, y_tile_max)
 
 
-@functools.lru_cache()
-def get_tile(zoom: int, x: int, y: int, url_template: str) -> Image.Image:
-    destination = osm_tile_path(x, y, zoom, url_template)
-    if not destination.exists():
-        logger.info(f"Downloading OSM tile {x=}, {y=}, {zoom=} …")
-        url = url_template.format(x=x, y=y, zoom=zoom)
-        download_file(url, destination)
-    with Image.open(destination) as image:
-        image.load()
-        image = image.convert("RGB")
-    return image
+@dataclasses.dataclass
+class TileCacheStats:
+    hits: int
+    misses: int
+    num_tiles: int
+    num_bytes: int
+    max_bytes: int
+
+
+class DecodedTileCache:
+    """
+    Map tiles that have been decoded from their image files, as RGB arrays of `uint8`.
+
+    The most recently used tiles are kept in memory up to `max_bytes`. The arrays are read-only because they are shared between all callers.
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024**2) -> None:
+        self.max_bytes = max_bytes
+        self._tiles: collections.OrderedDict[tuple[str, int, int, int], np.ndarray] = (
+            collections.OrderedDict()
+        )
+        self._num_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get_tile(self, zoom: int, x: int, y: int, url_template: str) -> np.ndarray:
+        key = (url_template, zoom, x, y)
+        with self._lock:
+            tile = self._tiles.get(key, None)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self._hits += 1
+                return tile
+            self._misses += 1
+        tile = _decode_tile(zoom, x, y, url_template)
+        tile.flags.writeable = False
+        with self._lock:
+            previous = self._tiles.pop(key, None)
+            if previous is not None:
+                self._num_bytes -= previous.nbytes
+            self._tiles[key] = tile
+            self._num_bytes += tile.nbytes
+            while self._num_bytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._num_bytes -= evicted.nbytes
+        return tile
+
+    def stats(self) -> TileCacheStats:
+        with self._lock:
+            return TileCacheStats(
+                self._hits,
+                self._misses,
+                len(self._tiles),
+                self._num_bytes,
+                self.max_bytes,
+            )
+
+
+DECODED_TILE_CACHE = DecodedTileCache()
+
+
+def _decode_tile(zoom: int, x: int, y: int, url_template: str) -> np.ndarray:
+    archive = open_tile_archive(url_template)
+    if archive is None:
+        source = TILE_FETCHER.fetch(
+            url_template.format(x=x, y=y, zoom=zoom),
+            osm_tile_path(x, y, zoom, url_template),
+        )
+    else:
+        data = archive.get_tile_bytes(zoom, x, y)
+        if data is None:
+            tile = np.empty((OSM_TILE_SIZE, OSM_TILE_SIZE, 3), dtype=np.uint8)
+            tile[:] = EMPTY_TILE_COLOR
+            return tile
+        source = io.BytesIO(data)
+    with Image.open(source) as image:
+        return np.array(image.convert("RGB"))
+
+
+def get_tile(zoom: int, x: int, y: int, url_template: str) -> np.ndarray:
+    """
+    A map tile as a read-only RGB array of `uint8` from the shared cache of decoded tiles.
+    """
+    return DECODED_TILE_CACHE.get_tile(zoom, x, y, url_template)
 
 
 def tile_bounds_around_center(
@@ -191,8 +275,11 @@ def _paste_array(
 
 
 def map_image_from_tile_bounds(tile_bounds: TileBounds, config: Config) -> np.ndarray:
+    """
+    Map of an area as an RGB image of `uint8`, pasted together from the map tiles.
+    """
     pixel_bounds = pixel_bounds_from_tile_bounds(tile_bounds)
-    background = np.zeros((pixel_bounds.height, pixel_bounds.width, 3))
+    background = np.zeros((pixel_bounds.height, pixel_bounds.width, 3), dtype=np.uint8)
 
     north_west = np.array([tile_bounds.x1, tile_bounds.y1])
     offset = north_west % 1
@@ -204,12 +291,19 @@ def map_image_from_tile_bounds(tile_bounds: TileBounds, config: Config) -> np.nd
     num_tile_x = int(np.ceil(tile_bounds.width)) + 1
     num_tile_y = int(np.ceil(tile_bounds.height)) + 1
 
+    prefetch_tiles(
+        [
+            (tile_bounds.zoom, x, y)
+            for x in range(int(tile_anchor[0]), int(tile_anchor[0] + num_tile_x))
+            for y in range(int(tile_anchor[1]), int(tile_anchor[1]) + num_tile_y)
+        ],
+        config.map_tile_url,
+    )
     for x in range(int(tile_anchor[0]), int(tile_anchor[0] + num_tile_x)):
         for y in range(int(tile_anchor[1]), int(tile_anchor[1]) + num_tile_y):
-            tile = np.array(get_tile(tile_bounds.zoom, x, y, config.map_tile_url)) / 255
             _paste_array(
                 background,
-                tile,
+                get_tile(tile_bounds.zoom, x, y, config.map_tile_url),
                 (y - int(tile_anchor[1])) * OSM_TILE_SIZE + int(pixel_anchor[1]),
                 (x - int(tile_anchor[0])) * OSM_TILE_SIZE + int(pixel_anchor[0]),
             )
@@ -218,9 +312,10 @@ def map_image_from_tile_bounds(tile_bounds: TileBounds, config: Config) -> np.nd
 
 
 def convert_to_grayscale(image: np.ndarray) -> np.ndarray:
-    image = np.sum(image * [0.2126, 0.7152, 0.0722], axis=2)
-    image = np.dstack((image, image, image))
-    return image
+    """
+    Grayscale version of an RGB image of `uint8`, still with three channels.
+    """
+    return np.repeat(luminance(image)[..., None], 3, axis=2)
 
 
 def osm_tile_path(x: int, y: int, zoom: int, url_template: str) -> pathlib.Path:
@@ -231,61 +326,157 @@ def osm_tile_path(x: int, y: int, zoom: int, url_template: str) -> pathlib.Path:
     return path
 
 
-def download_file(url: str, destination: pathlib.Path):
-    if not destination.parent.exists():
-        destination.parent.mkdir(exist_ok=True, parents=True)
-    r = requests.get(
-        url,
-        allow_redirects=True,
-        headers={"User-Agent": "Martin's Geo Activity Playground"},
+def transformed_tile_path(
+    x: int, y: int, zoom: int, url_template: str, scheme: str
+) -> pathlib.Path:
+    """
+    Path of a tile with a color scheme applied, which is next to the original tile.
+    """
+    path = osm_tile_path(x, y, zoom, url_template)
+    return path.with_stem(f"{path.stem}-{scheme}")
+
+
+def prefetch_tiles(tiles: list[tuple[int, int, int]], url_template: str) -> None:
+    """
+    Downloads the missing or expired tiles of a list of `(zoom, x, y)` concurrently, such that `get_tile` finds them on disk.
+    """
+    if open_tile_archive(url_template) is not None:
+        return
+    TILE_FETCHER.fetch_many(
+        [
+            (
+                url_template.format(x=x, y=y, zoom=zoom),
+                osm_tile_path(x, y, zoom, url_template),
+            )
+            for zoom, x, y in tiles
+        ]
     )
-    assert r.ok
-    with open(destination, "wb") as f:
-        f.write(r.content)
-    time.sleep(0.1)
 
 
 class TileGetter:
+    # Transformations of tiles whose paths share one of these locks wait for each other.
+    NUM_PATH_LOCKS = 64
+
     def __init__(self, map_tile_url: str):
         self._map_tile_url = map_tile_url
+        self._path_locks = [threading.Lock() for _ in range(self.NUM_PATH_LOCKS)]
 
     def get_tile(
         self,
         z: int,
         x: int,
         y: int,
-    ):
+    ) -> np.ndarray:
         return get_tile(z, x, y, self._map_tile_url)
 
+    def get_transformed_tile_path(
+        self, z: int, x: int, y: int, scheme: str, image_transform: "ImageTransform"
+    ) -> pathlib.Path:
+        """
+        PNG file of a tile with a color scheme applied.
+
+        The file is created once and only created again when the original tile has been downloaded anew or the tile archive has changed. It is counted towards the size of the tile directory, such that it is evicted like the downloaded tiles.
+        """
+        archive = open_tile_archive(self._map_tile_url)
+        if archive is None:
+            original = TILE_FETCHER.fetch(
+                self._map_tile_url.format(x=x, y=y, zoom=z),
+                osm_tile_path(x, y, z, self._map_tile_url),
+            )
+        else:
+            original = archive.path
+        path = transformed_tile_path(x, y, z, self._map_tile_url, scheme)
+        with self._get_path_lock(path):
+            if path.exists() and path.stat().st_mtime >= original.stat().st_mtime:
+                mark_used(path)
+            else:
+                image = image_transform.transform_tile(
+                    get_tile(z, x, y, self._map_tile_url)
+                )
+                previous_size = path.stat().st_size if path.exists() else 0
+                with atomic_open(path, "wb") as f:
+                    Image.fromarray(image).save(f, format="png")
+                TILE_FETCHER.add_bytes(path.stat().st_size - previous_size)
+        return path
+
+    def _get_path_lock(self, path: pathlib.Path) -> threading.Lock:
+        return self._path_locks[hash(path) % len(self._path_locks)]
+
+
+def _channel_tables(weights: list[float]) -> np.ndarray:
+    """
+    Lookup tables with the weighted values of the channels in 1/256 steps.
+    """
+    return np.round(np.outer(weights, np.arange(256)) * 256).astype(np.uint16)
+
+
+_LUMINANCE_TABLES = _channel_tables(LUMINANCE_WEIGHTS)
+
+
+def luminance(image: np.ndarray) -> np.ndarray:
+    """
+    Luminance of an RGB image of `uint8`, summed up from a lookup table per channel.
+    """
+    total = _LUMINANCE_TABLES[0][image[..., 0]]
+    total += _LUMINANCE_TABLES[1][image[..., 1]]
+    total += _LUMINANCE_TABLES[2][image[..., 2]]
+    total += 128
+    total >>= 8
+    return total.astype(np.uint8)
+
 
 class ImageTransform:
     @abc.abstractmethod
     def transform_image(self, image: np.ndarray) -> np.ndarray:
         pass
 
+    def transform_tile(self, tile: np.ndarray) -> np.ndarray:
+        """
+        Transforms an RGB image of `uint8` into another one.
+        """
+        transformed = self.transform_image(tile / 255)
+        return np.round(np.clip(transformed, 0, 1) * 255).astype(np.uint8)
+
 
 class IdentityImageTransform(ImageTransform):
     def transform_image(self, image: np.ndarray) -> np.ndarray:
         return image
 
+    def transform_tile(self, tile: np.ndarray) -> np.ndarray:
+        return tile
+
 
 class GrayscaleImageTransform(ImageTransform):
     def transform_image(self, image: np.ndarray) -> np.ndarray:
-        image = np.sum(image * [0.2126, 0.7152, 0.0722], axis=2)  # to grayscale
+        image = image @ np.asarray(LUMINANCE_WEIGHTS, image.dtype)  # to grayscale
         return np.dstack((image, image, image))  # to rgb
 
+    def transform_tile(self, tile: np.ndarray) -> np.ndarray:
+        gray = luminance(tile)
+        return np.dstack((gray, gray, gray))
+
 
 class PastelImageTransform(ImageTransform):
     def __init__(self, factor: float = 0.7):
         self._factor = factor
+        self._gray_table = _channel_tables([factor])[0]
+        self._color_table = _channel_tables([1 - factor])[0]
 
     def transform_image(self, image: np.ndarray) -> np.ndarray:
-        averaged_tile = np.sum(image * [0.2126, 0.7152, 0.0722], axis=2)
+        averaged_tile = image @ np.asarray(LUMINANCE_WEIGHTS, image.dtype)
         grayscale_tile = np.dstack((averaged_tile, averaged_tile, averaged_tile))
         return self._factor * grayscale_tile + (1 - self._factor) * image
 
+    def transform_tile(self, tile: np.ndarray) -> np.ndarray:
+        mixed = self._gray_table[luminance(tile)][..., None] + self._color_table[tile]
+        return ((mixed + 128) >> 8).astype(np.uint8)
+
 
 class InverseGrayscaleImageTransform(ImageTransform):
     def transform_image(self, image: np.ndarray) -> np.ndarray:
-        image = np.sum(image * [0.2126, 0.7152, 0.0722], axis=2)  # to grayscale
+        image = image @ np.asarray(LUMINANCE_WEIGHTS, image.dtype)  # to grayscale
         return 1 - np.dstack((image, image, image))  # to rgb
+
+    def transform_tile(self, tile: np.ndarray) -> np.ndarray:
+        gray = 255 - luminance(tile)
+        return np.dstack((gray, gray, gray))
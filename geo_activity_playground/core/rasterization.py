@@ -0,0 +1,221 @@
+"""
+Rasterization of many thick polylines into count buffers with array operations.
+
+Polylines are given as one array of pixel coordinates together with offsets, such that polyline `i` consists of the points `xy[offsets[i] : offsets[i + 1]]`. Every pixel whose center is within half the line width of a polyline is covered by it. A pixel counts once per polyline that covers it, also if the polyline passes it several times.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Upper bound for the size of the boolean arrays that remove repeated coverage.
+_MAX_BATCH_PIXELS = 2**22
+
+
+def heatmap_line_width(zoom: int) -> int:
+    """
+    Width of activity lines in heatmap pixels, which grows with the zoom level beyond zoom 17.
+    """
+    return max(3, 6 * (zoom - 17))
+
+
+def polylines_from_time_series(
+    time_series: pd.DataFrame,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Polylines of the segments of an activity in Web Mercator coordinates of zoom level 0.
+    """
+    time_series = time_series.dropna(subset=["x", "y"])
+    xy = time_series[["x", "y"]].to_numpy(dtype=np.float64)
+    if "segment_id" in time_series.columns:
+        segment_id = time_series["segment_id"].to_numpy()
+        breaks = np.flatnonzero(segment_id[1:] != segment_id[:-1]) + 1
+    else:
+        breaks = np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate([[0], breaks, [len(xy)]]) if len(xy) else np.zeros(1)
+    return xy, offsets.astype(np.int64)
+
+
+def concatenate_polylines(
+    polylines: list[tuple[np.ndarray, np.ndarray]],
+) -> tuple[np.ndarray, np.ndarray]:
+    xys = [xy for xy, _ in polylines]
+    offsets = [np.zeros(1, dtype=np.int64)]
+    shift = 0
+    for xy, polyline_offsets in polylines:
+        offsets.append(polyline_offsets[1:] + shift)
+        shift += len(xy)
+    return (
+        np.concatenate(xys) if xys else np.zeros((0, 2)),
+        np.concatenate(offsets),
+    )
+
+
+def rasterize_polylines(
+    counts: np.ndarray, xy: np.ndarray, offsets: np.ndarray, width: float
+) -> None:
+    """
+    Adds the coverage of the polylines to the count buffer of shape (height, width).
+
+    Every line segment is first clipped to the buffer. A thick segment is a capsule, which intersects every pixel column or row along the longer axis of the segment in one interval. These intervals are computed from the edges and round caps of the capsule, such that only the covered pixels are ever enumerated.
+    """
+    height, buffer_width = counts.shape
+    offsets = np.asarray(offsets)
+    radius = width / 2
+    segment_start, segment_end, segment_polyline = _segments(xy, offsets)
+    if len(segment_start) == 0:
+        return
+
+    # Clip the segments to the buffer with a margin for the line width.
+    margin = radius + 1
+    keep, segment_start, segment_end = _clip_segments(
+        segment_start,
+        segment_end,
+        (-margin, -margin),
+        (buffer_width - 1 + margin, height - 1 + margin),
+    )
+    segment_polyline = segment_polyline[keep]
+    if len(segment_start) == 0:
+        return
+
+    # Work in (u, v) coordinates, where u is the longer axis of each segment.
+    delta = segment_end - segment_start
+    swap = np.abs(delta[:, 1]) > np.abs(delta[:, 0])
+    u0 = np.where(swap, segment_start[:, 1], segment_start[:, 0])
+    v0 = np.where(swap, segment_start[:, 0], segment_start[:, 1])
+    u1 = np.where(swap, segment_end[:, 1], segment_end[:, 0])
+    v1 = np.where(swap, segment_end[:, 0], segment_end[:, 1])
+    backwards = u1 < u0
+    u0, u1 = np.where(backwards, u1, u0), np.where(backwards, u0, u1)
+    v0, v1 = np.where(backwards, v1, v0), np.where(backwards, v0, v1)
+    du = u1 - u0
+    dv = v1 - v0
+    length = np.hypot(du, dv)
+    slope = np.divide(dv, du, out=np.zeros_like(du), where=du > 0)
+    # The edges of the capsule are shifted along u against the segment by this much.
+    shift = np.divide(radius * dv, length, out=np.zeros_like(du), where=length > 0)
+    half_band = radius * np.sqrt(1 + slope**2)
+    u_size = np.where(swap, height, buffer_width)
+    v_size = np.where(swap, buffer_width, height)
+
+    # Steps along u that are within the buffer.
+    u_first = np.maximum(np.ceil(u0 - radius), 0).astype(np.int64)
+    u_last = np.minimum(np.floor(u1 + radius).astype(np.int64), u_size - 1)
+    num_steps = np.maximum(u_last - u_first + 1, 0)
+    step_segment = np.repeat(np.arange(len(u0)), num_steps)
+    step_u = (
+        np.arange(len(step_segment))
+        - np.repeat(np.cumsum(num_steps) - num_steps, num_steps)
+        + u_first[step_segment]
+    )
+
+    # The interval along v, either on the straight edges or on the caps.
+    def cap(u: np.ndarray, center_u: np.ndarray) -> np.ndarray:
+        return np.sqrt(np.maximum(radius**2 - (u - center_u) ** 2, 0))
+
+    s_u0, s_u1, s_v0, s_v1 = (a[step_segment] for a in (u0, u1, v0, v1))
+    s_shift = shift[step_segment]
+    v_line = s_v0 + (step_u - s_u0) * slope[step_segment]
+    s_half_band = half_band[step_segment]
+    v_high = np.where(
+        step_u < s_u0 - s_shift,
+        s_v0 + cap(step_u, s_u0),
+        np.where(
+            step_u > s_u1 - s_shift, s_v1 + cap(step_u, s_u1), v_line + s_half_band
+        ),
+    )
+    v_low = np.where(
+        step_u < s_u0 + s_shift,
+        s_v0 - cap(step_u, s_u0),
+        np.where(
+            step_u > s_u1 + s_shift, s_v1 - cap(step_u, s_u1), v_line - s_half_band
+        ),
+    )
+    v_first = np.maximum(np.ceil(v_low), 0).astype(np.int64)
+    v_last = np.minimum(np.floor(v_high).astype(np.int64), v_size[step_segment] - 1)
+    band_size = np.maximum(v_last - v_first + 1, 0)
+
+    # Enumerate the covered pixels as flat indices into the buffer.
+    step_swap = swap[step_segment]
+    step_index = np.where(
+        step_swap,
+        step_u * buffer_width + v_first,
+        v_first * buffer_width + step_u,
+    )
+    step_stride = np.where(step_swap, 1, buffer_width)
+    pixel_step = np.repeat(np.arange(len(step_u)), band_size)
+    index = (
+        step_index[pixel_step]
+        + (
+            np.arange(len(pixel_step))
+            - np.repeat(np.cumsum(band_size) - band_size, band_size)
+        )
+        * step_stride[pixel_step]
+    )
+    _add_coverage(counts, index, segment_polyline[step_segment[pixel_step]])
+
+
+def _add_coverage(counts: np.ndarray, index: np.ndarray, polyline: np.ndarray) -> None:
+    """
+    Adds one to every pixel per polyline that covers it.
+
+    The pixels are grouped by polyline. For a batch of polylines at a time, their coverage is marked in a boolean array with one row per polyline, which removes duplicates without sorting, and then summed up.
+    """
+    if len(index) == 0:
+        return
+    num_pixels = counts.size
+    # Number the polylines that cover anything consecutively.
+    rank = np.concatenate([[0], np.cumsum(polyline[1:] != polyline[:-1])])
+    batch_size = max(1, _MAX_BATCH_PIXELS // num_pixels)
+    batch_starts = np.searchsorted(rank, np.arange(0, rank[-1] + 1, batch_size))
+    batch_ends = np.append(batch_starts[1:], len(rank))
+    flat_counts = counts.reshape(-1)
+    for begin, end in zip(batch_starts, batch_ends):
+        batch_rank = rank[begin:end] - rank[begin]
+        covered = np.zeros((batch_rank[-1] + 1, num_pixels), dtype=bool)
+        covered[batch_rank, index[begin:end]] = True
+        flat_counts += covered.sum(axis=0, dtype=counts.dtype)
+
+
+def _segments(
+    xy: np.ndarray, offsets: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Line segments between consecutive points of the same polyline. A polyline with a single point becomes a segment of length zero.
+    """
+    lengths = np.diff(offsets)
+    point_polyline = np.repeat(np.arange(len(lengths)), lengths)
+    same = point_polyline[1:] == point_polyline[:-1]
+    single = np.flatnonzero(lengths == 1)
+    starts = np.concatenate([xy[:-1][same], xy[offsets[single]]])
+    ends = np.concatenate([xy[1:][same], xy[offsets[single]]])
+    polylines = np.concatenate([point_polyline[:-1][same], single])
+    return starts, ends, polylines
+
+
+def _clip_segments(
+    start: np.ndarray,
+    end: np.ndarray,
+    lower: tuple[float, float],
+    upper: tuple[float, float],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Liang–Barsky clipping of many segments to a rectangle. Returns the mask of segments that intersect it and their clipped ends.
+    """
+    delta = end - start
+    t_enter = np.zeros(len(start))
+    t_exit = np.ones(len(start))
+    keep = np.ones(len(start), dtype=bool)
+    for axis in range(2):
+        for boundary, direction in [(lower[axis], -1), (upper[axis], 1)]:
+            p = direction * delta[:, axis]
+            q = direction * (boundary - start[:, axis])
+            parallel = p == 0
+            keep &= ~(parallel & (q < 0))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                r = q / p
+            t_enter = np.where(~parallel & (p < 0), np.maximum(t_enter, r), t_enter)
+            t_exit = np.where(~parallel & (p > 0), np.minimum(t_exit, r), t_exit)
+    keep &= t_enter <= t_exit
+    clipped_start = start + t_enter[:, None] * delta
+    clipped_end = start + t_exit[:, None] * delta
+    return keep, clipped_start[keep], clipped_end[keep]
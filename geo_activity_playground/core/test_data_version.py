@@ -0,0 +1,45 @@
+import flask
+import pytest
+
+from .data_version import DATA_VERSION
+from .data_version import DataVersion
+from .datamodel import DB
+from .datamodel import Tag
+
+
+def test_bump(tmp_path) -> None:
+    path = tmp_path / "data-version.json"
+    data_version = DataVersion(path)
+    assert data_version.get() == (0, 0.0)
+    data_version.bump()
+    version, modified = data_version.get()
+    assert version == 1 and modified > 0
+
+    # Another process sees the change.
+    other = DataVersion(path)
+    assert other.get() == (1, modified)
+    other.bump()
+    assert data_version.get()[0] == 2
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app = flask.Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    DB.init_app(app)
+    with app.app_context():
+        DB.create_all()
+        yield DB
+
+
+def test_commit_bumps_version(database) -> None:
+    version, _ = DATA_VERSION.get()
+    database.session.add(Tag(tag="Holiday"))
+    database.session.commit()
+    assert DATA_VERSION.get()[0] == version + 1
+
+    # Reading doesn't change anything.
+    database.session.get(Tag, 1)
+    database.session.commit()
+    assert DATA_VERSION.get()[0] == version + 1
@@ -0,0 +1,263 @@
+import threading
+
+import numpy as np
+import pytest
+
+from .heatmap_counts import downsample_counts
+from .heatmap_counts import HeatmapCountStore
+from .heatmap_counts import is_rasterized_zoom
+from .heatmap_counts import pack_activity_ids
+from .heatmap_counts import TILE_SHAPE
+from .heatmap_counts import unpack_activity_ids
+from .rasterization import heatmap_line_width
+from .rasterization import rasterize_polylines
+
+
+class FakeRasterizer:
+    def __init__(self) -> None:
+        self.calls: list[set[int]] = []
+
+    def __call__(self, activity_ids: set[int]) -> np.ndarray:
+        self.calls.append(set(activity_ids))
+        counts = np.zeros(TILE_SHAPE, dtype=np.int32)
+        for activity_id in activity_ids:
+            counts[activity_id, :] += 1
+        return counts
+
+
+@pytest.fixture
+def make_store():
+    """
+    Creates stores that are closed after the test, such that no flush runs after the temporary directory is gone.
+    """
+    stores: list[HeatmapCountStore] = []
+
+    def make(*args, **kwargs) -> HeatmapCountStore:
+        store = HeatmapCountStore(*args, **kwargs)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.close()
+
+
+def test_pack_activity_ids() -> None:
+    assert pack_activity_ids(set()) == b""
+    assert unpack_activity_ids(b"") == set()
+    ids = {0, 7, 8, 1234}
+    assert unpack_activity_ids(pack_activity_ids(ids)) == ids
+    assert len(pack_activity_ids(ids)) == 155
+
+
+def test_counts_are_added_incrementally(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    rasterize = FakeRasterizer()
+    counts = store.get_counts(100, 200, 14, {1, 2}, rasterize)
+    assert counts[1].sum() == 256 and counts[2].sum() == 256
+    counts = store.get_counts(100, 200, 14, {1, 2, 3}, rasterize)
+    assert counts[3].sum() == 256
+    assert rasterize.calls == [{1, 2}, {3}]
+
+    # An up to date tile is only read.
+    store.flush()
+    index_path = tmp_path / "14" / "6-12.pickle"
+    mtime = index_path.stat().st_mtime_ns
+    store.get_counts(100, 200, 14, {1, 2, 3}, rasterize)
+    assert len(rasterize.calls) == 2
+    assert index_path.stat().st_mtime_ns == mtime
+
+    # A second tile in the same chunk gets its own slot.
+    other = store.get_counts(101, 200, 14, {5}, rasterize)
+    assert other.sum() == 256 and other[5].sum() == 256
+    assert (tmp_path / "14" / "6-12.counts").stat().st_size == 2 * 256 * 256 * 4
+
+    # The counts survive a restart once the index has been written.
+    store.flush()
+    reopened = make_store(tmp_path)
+    np.testing.assert_array_equal(
+        reopened.get_counts(100, 200, 14, {1, 2, 3}, rasterize), counts
+    )
+    assert len(rasterize.calls) == 3
+
+
+def test_unwritten_index_discards_chunk(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    rasterize = FakeRasterizer()
+    store.get_counts(0, 0, 10, {1}, rasterize)
+    store.flush()
+    store.get_counts(0, 0, 10, {1, 2}, rasterize)
+    assert (tmp_path / "10" / "0-0.dirty").exists()
+    # The index on disk doesn't know about activity 2 yet, so the chunk can't be trusted.
+    reopened = make_store(tmp_path)
+    counts = reopened.get_counts(0, 0, 10, {1, 2}, rasterize)
+    assert rasterize.calls == [{1}, {2}, {1, 2}]
+    assert counts[1].sum() == 256 and counts[2].sum() == 256
+
+
+def test_index_is_written_after_delay(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    store.INDEX_FLUSH_DELAY = 0.01
+    store.get_counts(0, 0, 10, {1}, FakeRasterizer())
+    store._flush_timer.join()
+    assert (tmp_path / "10" / "0-0.pickle").exists()
+    assert not (tmp_path / "10" / "0-0.dirty").exists()
+
+
+def test_close_writes_index_and_cancels_flush(tmp_path) -> None:
+    store = HeatmapCountStore(tmp_path)
+    store.get_counts(0, 0, 10, {1}, FakeRasterizer())
+    timer = store._flush_timer
+    store.close()
+    # The timer would only fire after `INDEX_FLUSH_DELAY` seconds.
+    timer.join(1)
+    assert not timer.is_alive()
+    assert (tmp_path / "10" / "0-0.pickle").exists()
+    assert not (tmp_path / "10" / "0-0.dirty").exists()
+    assert store._chunks == {}
+
+
+def test_least_recently_used_chunks_are_closed(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    store.MAX_OPEN_CHUNKS = 2
+    rasterize = FakeRasterizer()
+    for x in range(3):
+        store.get_counts(x * store.CHUNK_SIZE, 0, 10, {1}, rasterize)
+    assert list(store._chunks) == [(10, 1, 0), (10, 2, 0)]
+    # The closed chunk has written its index and is opened again from disk.
+    assert (tmp_path / "10" / "0-0.pickle").exists()
+    store.get_counts(0, 0, 10, {1}, rasterize)
+    assert len(rasterize.calls) == 3
+
+
+def test_removed_activity_resets_tile(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    rasterize = FakeRasterizer()
+    store.get_counts(0, 0, 10, {1, 2}, rasterize)
+    counts = store.get_counts(0, 0, 10, {2}, rasterize)
+    assert rasterize.calls == [{1, 2}, {2}]
+    assert counts[1].sum() == 0 and counts[2].sum() == 256
+
+
+def test_changed_activity_resets_tile(tmp_path, make_store) -> None:
+    revisions = {1: 0, 2: 0}
+    store = make_store(tmp_path, revisions.__getitem__)
+    rasterize = FakeRasterizer()
+    store.get_counts(0, 0, 10, {1}, rasterize)
+    store.get_counts(0, 0, 10, {1, 2}, rasterize)
+    revisions[1] = 5
+    store.get_counts(0, 0, 10, {1, 2}, rasterize)
+    store.get_counts(0, 0, 10, {1, 2}, rasterize)
+    assert rasterize.calls == [{1}, {2}, {1, 2}]
+
+    derive = FakeRasterizer()
+    store.get_derived_counts(0, 0, 9, {1, 2}, lambda: derive({1, 2}))
+    store.get_derived_counts(0, 0, 9, {1, 2}, lambda: derive({1, 2}))
+    revisions[2] = 6
+    store.get_derived_counts(0, 0, 9, {1, 2}, lambda: derive({1, 2}))
+    assert len(derive.calls) == 2
+
+
+def test_concurrent_requests_rasterize_once(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    rasterize = FakeRasterizer()
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                store.get_counts(3, 4, 12, {1, 2, 3}, rasterize)
+            )
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert rasterize.calls == [{1, 2, 3}]
+    assert all(result.sum() == 3 * 256 for result in results)
+
+
+def test_downsample_keeps_line_cross_section() -> None:
+    # A horizontal line of width 3 through the upper left child.
+    upper_left = np.zeros(TILE_SHAPE, dtype=np.int32)
+    upper_left[10:13, :] = 1
+    empty = np.zeros(TILE_SHAPE, dtype=np.int32)
+    counts = downsample_counts([[upper_left, empty], [empty, empty]])
+    assert counts.shape == TILE_SHAPE
+    assert counts[:, :128].sum(axis=0).tolist() == [3] * 128
+    assert counts[:, 128:].sum() == 0
+    assert np.flatnonzero(counts[:, 0]).tolist() == [5, 6]
+
+
+def rasterize_line(xy: np.ndarray, x: int, y: int, z: int) -> np.ndarray:
+    counts = np.zeros(TILE_SHAPE, dtype=np.int32)
+    rasterize_polylines(
+        counts,
+        (xy * 2**z - (x, y)) * 256,
+        np.array([0, len(xy)]),
+        heatmap_line_width(z),
+    )
+    return counts
+
+
+def derive_line(xy: np.ndarray, x: int, y: int, z: int, levels: int) -> np.ndarray:
+    if levels == 0:
+        return rasterize_line(xy, x, y, z)
+    return downsample_counts(
+        [
+            [
+                derive_line(xy, 2 * x + dx, 2 * y + dy, z + 1, levels - 1)
+                for dx in range(2)
+            ]
+            for dy in range(2)
+        ]
+    )
+
+
+def test_derived_line_matches_rasterized_line() -> None:
+    # A single track with a kink through the tile (300, 400) at zoom 10.
+    xy = np.array([[300.1, 400.2], [300.9, 400.7], [300.3, 400.95]]) / 2**10
+    rasterized = rasterize_line(xy, 300, 400, 10)
+    for levels in [1, 2]:
+        derived = derive_line(xy, 300, 400, 10, levels)
+        # The counts across the line are kept, it is just narrower.
+        assert abs(derived.sum() - rasterized.sum()) <= 0.01 * rasterized.sum()
+        assert derived.max() <= 2**levels
+        assert np.count_nonzero(derived) >= np.count_nonzero(rasterized) / 2**levels
+
+
+def test_rasterized_zooms() -> None:
+    assert [z for z in range(20) if is_rasterized_zoom(z)] == [
+        2,
+        5,
+        8,
+        11,
+        14,
+        17,
+        18,
+        19,
+    ]
+
+
+def test_derived_counts_follow_activities(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    derivations = []
+
+    def derive() -> np.ndarray:
+        derivations.append(1)
+        return np.full(TILE_SHAPE, len(derivations), dtype=np.int32)
+
+    assert store.get_derived_counts(1, 1, 5, {1}, derive)[0, 0] == 1
+    assert store.get_derived_counts(1, 1, 5, {1}, derive)[0, 0] == 1
+    assert store.get_derived_counts(1, 1, 5, {1, 2}, derive)[0, 0] == 2
+    assert len(derivations) == 2
+
+
+def test_outdated_version_is_discarded(tmp_path, make_store) -> None:
+    store = make_store(tmp_path)
+    rasterize = FakeRasterizer()
+    store.get_counts(0, 0, 10, {1}, rasterize)
+    (tmp_path / "10" / "version.json").write_text("1")
+    make_store(tmp_path).get_counts(0, 0, 10, {1}, rasterize)
+    assert rasterize.calls == [{1}, {1}]
@@ -0,0 +1,81 @@
+import numpy as np
+
+from .heatmap_counts import TILE_SHAPE
+from .heatmap_footprints import encode_runs
+from .heatmap_footprints import HeatmapFootprintCache
+from .heatmap_footprints import sum_runs
+
+
+def random_counts(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(TILE_SHAPE, dtype=np.int32)
+    counts[rng.integers(0, 256, 300), rng.integers(0, 256, 300)] = rng.integers(
+        1, 4, 300
+    )
+    counts[100:103, :] += 1
+    return counts
+
+
+def test_runs_round_trip() -> None:
+    counts = random_counts(0)
+    starts, lengths, values = encode_runs(counts)
+    assert np.all(values != 0)
+    np.testing.assert_array_equal(sum_runs(starts, lengths, values), counts)
+
+
+def test_sum_of_layers() -> None:
+    layers = [encode_runs(random_counts(seed)) for seed in range(5)]
+    total = sum_runs(*(np.concatenate(column) for column in zip(*layers)))
+    np.testing.assert_array_equal(total, sum(random_counts(seed) for seed in range(5)))
+
+
+def test_last_pixel() -> None:
+    counts = np.zeros(TILE_SHAPE, dtype=np.int32)
+    counts[-1, -1] = 2
+    np.testing.assert_array_equal(sum_runs(*encode_runs(counts)), counts)
+
+
+class FakeRasterizer:
+    def __init__(self) -> None:
+        self.calls: list[tuple[int, int]] = []
+        self.tiles = {1: [(0, 0), (1, 0)], 2: [(0, 0)]}
+
+    def __call__(self, activity_id: int, z: int) -> dict:
+        self.calls.append((activity_id, z))
+        result = {}
+        for tile in self.tiles[activity_id]:
+            counts = np.zeros(TILE_SHAPE, dtype=np.int32)
+            counts[activity_id, tile[0]] = 1
+            result[tile] = counts
+        return result
+
+
+def test_footprint_cache(tmp_path) -> None:
+    rasterize = FakeRasterizer()
+    revisions = {1: 0, 2: 0}
+    cache = HeatmapFootprintCache(tmp_path, rasterize, revisions.__getitem__)
+    counts = cache.get_counts(0, 0, 12, [1, 2])
+    assert counts.sum() == 2 and counts[1, 0] == 1 and counts[2, 0] == 1
+    assert cache.get_counts(1, 0, 12, [1])[1, 1] == 1
+    assert rasterize.calls == [(1, 12), (2, 12)]
+
+    # Footprints are stored on disk.
+    reopened = HeatmapFootprintCache(tmp_path, rasterize, revisions.__getitem__)
+    np.testing.assert_array_equal(reopened.get_counts(0, 0, 12, [1, 2]), counts)
+    assert len(rasterize.calls) == 2
+
+    # A changed activity is rasterized again, in memory and on disk.
+    rasterize.tiles[2] = [(5, 5)]
+    revisions[2] = 1
+    assert cache.get_counts(0, 0, 12, [2]).sum() == 0
+    assert cache.get_counts(5, 5, 12, [2])[2, 5] == 1
+    assert reopened.get_counts(0, 0, 12, [2]).sum() == 0
+    assert rasterize.calls[2:] == [(2, 12)]
+
+
+def test_footprint_cache_eviction(tmp_path) -> None:
+    cache = HeatmapFootprintCache(tmp_path, FakeRasterizer())
+    cache.MAX_BYTES = 1
+    cache.get_counts(0, 0, 12, [1])
+    cache.get_counts(0, 0, 12, [2])
+    assert list(cache._footprints) == [(2, 12)]
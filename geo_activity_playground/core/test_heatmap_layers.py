@@ -0,0 +1,104 @@
+import datetime
+
+import pandas as pd
+
+from .heatmap_layers import ActivityCalendar
+from .heatmap_layers import HeatmapLayers
+from .heatmap_layers import split_date_range
+from .heatmap_layers import TimeSlices
+
+
+def test_split_whole_years() -> None:
+    assert split_date_range(datetime.date(2019, 1, 1), datetime.date(2021, 1, 1)) == (
+        [2019, 2020],
+        [],
+        [],
+    )
+
+
+def test_split_months_and_days() -> None:
+    years, months, days = split_date_range(
+        datetime.date(2019, 11, 15), datetime.date(2021, 2, 10)
+    )
+    assert years == [2020]
+    assert months == [(2019, 12), (2021, 1)]
+    assert days == [
+        (datetime.date(2019, 11, 15), datetime.date(2019, 12, 1)),
+        (datetime.date(2021, 2, 1), datetime.date(2021, 2, 10)),
+    ]
+
+
+def test_split_within_month() -> None:
+    assert split_date_range(datetime.date(2020, 3, 5), datetime.date(2020, 3, 9)) == (
+        [],
+        [],
+        [(datetime.date(2020, 3, 5), datetime.date(2020, 3, 9))],
+    )
+
+
+def make_calendar() -> ActivityCalendar:
+    meta = pd.DataFrame(
+        {
+            "id": [1, 2, 3, 4, 5],
+            "start": pd.to_datetime(
+                [
+                    "2020-06-01 08:00",
+                    "2019-03-10 17:30",
+                    None,
+                    "2021-01-01 00:10",
+                    "2020-12-31 23:50",
+                ]
+            ),
+        }
+    )
+    return ActivityCalendar(meta)
+
+
+def test_calendar() -> None:
+    calendar = make_calendar()
+    assert calendar.first_day == datetime.date(2019, 3, 10)
+    assert calendar.last_day == datetime.date(2021, 1, 1)
+    assert calendar.years == [2019, 2020, 2021]
+    assert calendar.between(
+        datetime.date(2020, 1, 1), datetime.date(2021, 1, 1)
+    ) == frozenset({1, 5})
+    assert (
+        calendar.between(datetime.date(2019, 3, 11), datetime.date(2020, 6, 1))
+        == frozenset()
+    )
+
+
+def test_time_slices() -> None:
+    calendar = make_calendar()
+    slices = TimeSlices.from_date_range(
+        calendar, datetime.date(2019, 3, 1), datetime.date(2020, 12, 31)
+    )
+    # Months without activities don't get a layer.
+    assert slices.layers == (
+        ("2019-03", frozenset({2})),
+        ("2020-06", frozenset({1})),
+    )
+    assert slices.remainder == frozenset()
+
+
+def test_time_slices_open_ends() -> None:
+    calendar = make_calendar()
+    slices = TimeSlices.from_date_range(calendar, None, None)
+    assert slices.layers == (("2020", frozenset({1, 5})),)
+    assert slices.remainder == frozenset({2, 4})
+
+    empty = TimeSlices.from_date_range(
+        ActivityCalendar(pd.DataFrame({"id": [], "start": pd.to_datetime([])})),
+        None,
+        None,
+    )
+    assert empty == TimeSlices((), frozenset())
+
+
+def test_layer_stores(tmp_path) -> None:
+    (tmp_path / "2019" / "17").mkdir(parents=True)
+    layers = HeatmapLayers(tmp_path)
+    # Layers of an earlier version are removed.
+    assert not (tmp_path / "2019").exists()
+    assert layers.get_store("2020") is layers.get_store("2020")
+    assert layers.get_store("2020-06").base_dir == tmp_path / "2020-06"
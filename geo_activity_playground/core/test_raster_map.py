@@ -0,0 +1,176 @@
+import os
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from . import raster_map
+from .config import Config
+from .raster_map import convert_to_grayscale
+from .raster_map import DecodedTileCache
+from .raster_map import GrayscaleImageTransform
+from .raster_map import IdentityImageTransform
+from .raster_map import InverseGrayscaleImageTransform
+from .raster_map import map_image_from_tile_bounds
+from .raster_map import osm_tile_path
+from .raster_map import OSM_TILE_SIZE
+from .raster_map import PastelImageTransform
+from .raster_map import TileBounds
+from .raster_map import TileGetter
+
+URL_TEMPLATE = "http://localhost/{zoom}/{x}/{y}.png"
+TILE_BYTES = OSM_TILE_SIZE * OSM_TILE_SIZE * 3
+
+
+@pytest.fixture
+def tiles(tmp_path, monkeypatch) -> None:
+    """
+    Tiles that are already on disk, such that nothing is downloaded.
+    """
+    monkeypatch.chdir(tmp_path)
+    for x in range(3):
+        for y in range(2):
+            Image.new("RGB", (OSM_TILE_SIZE, OSM_TILE_SIZE), (x, 100, 200)).save(
+                osm_tile_path(x, y, 10, URL_TEMPLATE)
+            )
+
+
+def test_decoded_tiles(tiles) -> None:
+    cache = DecodedTileCache()
+    tile = cache.get_tile(10, 1, 0, URL_TEMPLATE)
+    assert tile.dtype == np.uint8
+    assert tile.shape == (OSM_TILE_SIZE, OSM_TILE_SIZE, 3)
+    assert tile[0, 0].tolist() == [1, 100, 200]
+    assert not tile.flags.writeable
+    assert cache.get_tile(10, 1, 0, URL_TEMPLATE) is tile
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.num_tiles) == (1, 1, 1)
+    assert stats.num_bytes == TILE_BYTES
+
+
+def test_memory_budget(tiles) -> None:
+    cache = DecodedTileCache(max_bytes=2 * TILE_BYTES)
+    first = cache.get_tile(10, 0, 0, URL_TEMPLATE)
+    cache.get_tile(10, 1, 0, URL_TEMPLATE)
+    # Using the first tile again makes the second one the least recently used.
+    assert cache.get_tile(10, 0, 0, URL_TEMPLATE) is first
+    cache.get_tile(10, 2, 0, URL_TEMPLATE)
+    assert cache.stats().num_bytes == 2 * TILE_BYTES
+    assert cache.get_tile(10, 0, 0, URL_TEMPLATE) is first
+    cache.get_tile(10, 1, 0, URL_TEMPLATE)
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.num_tiles) == (2, 4, 2)
+
+
+@pytest.mark.parametrize(
+    "image_transform",
+    [
+        IdentityImageTransform(),
+        GrayscaleImageTransform(),
+        PastelImageTransform(),
+        InverseGrayscaleImageTransform(),
+    ],
+)
+def test_transform_tile(image_transform) -> None:
+    rng = np.random.default_rng(0)
+    tile = rng.integers(0, 256, (OSM_TILE_SIZE, OSM_TILE_SIZE, 3), dtype=np.uint8)
+    expected = image_transform.transform_image(tile / 255) * 255
+    transformed = image_transform.transform_tile(tile)
+    assert transformed.dtype == np.uint8
+    assert transformed.shape == tile.shape
+    assert np.abs(transformed - expected).max() <= 1
+
+
+def test_transformed_tile_path(tiles, monkeypatch) -> None:
+    added_bytes = []
+    monkeypatch.setattr(raster_map.TILE_FETCHER, "add_bytes", added_bytes.append)
+    tile_getter = TileGetter(URL_TEMPLATE)
+    path = tile_getter.get_transformed_tile_path(
+        10, 1, 0, "grayscale", GrayscaleImageTransform()
+    )
+    assert path.parent == osm_tile_path(1, 0, 10, URL_TEMPLATE).parent
+    image = np.array(Image.open(path))
+    assert image.shape == (OSM_TILE_SIZE, OSM_TILE_SIZE, 3)
+    assert image[0, 0].tolist() == [round(0.7152 * 100 + 0.0722 * 200 + 0.2126)] * 3
+    # The transformed tile is evicted together with the downloaded ones.
+    assert added_bytes == [path.stat().st_size]
+
+    # A newer original leads to a new transformed tile.
+    modified = path.stat().st_mtime_ns
+    os.utime(path, ns=(modified - 10**9, modified - 10**9))
+    tile_getter.get_transformed_tile_path(
+        10, 1, 0, "grayscale", GrayscaleImageTransform()
+    )
+    assert path.stat().st_mtime_ns > modified - 10**9
+
+
+def test_map_image(tiles) -> None:
+    config = Config(map_tile_url=URL_TEMPLATE)
+    image = map_image_from_tile_bounds(TileBounds(10, 0.5, 0.0, 2.5, 0.5), config)
+    assert image.dtype == np.uint8
+    assert image.shape == (OSM_TILE_SIZE // 2, 2 * OSM_TILE_SIZE, 3)
+    assert image[0, [0, OSM_TILE_SIZE - 1, OSM_TILE_SIZE]].tolist() == [
+        [0, 100, 200],
+        [1, 100, 200],
+        [1, 100, 200],
+    ]
+    gray = convert_to_grayscale(image)
+    assert gray.dtype == np.uint8
+    assert gray[0, 0].tolist() == [round(0.7152 * 100 + 0.0722 * 200)] * 3
+
+
+def measure_peak_bytes(function) -> int:
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks."
+)
+def test_benchmark_background_memory(tmp_path, monkeypatch) -> None:
+    # A background of 4000×4000 pixels like a large sharepic or heatmap video.
+    monkeypatch.chdir(tmp_path)
+    num_tiles = 4000 // OSM_TILE_SIZE + 2
+    for x in range(num_tiles):
+        for y in range(num_tiles):
+            Image.new("RGB", (OSM_TILE_SIZE, OSM_TILE_SIZE), (x, y, 200)).save(
+                osm_tile_path(x, y, 10, URL_TEMPLATE)
+            )
+    config = Config(map_tile_url=URL_TEMPLATE)
+    tile_bounds = TileBounds(
+        10, 0.5, 0.5, 0.5 + 4000 / OSM_TILE_SIZE, 0.5 + 4000 / OSM_TILE_SIZE
+    )
+    # Decode all tiles before measuring.
+    map_image_from_tile_bounds(tile_bounds, config)
+
+    def float64_sharepic() -> None:
+        background = map_image_from_tile_bounds(tile_bounds, config) / 255
+        (background * 255).astype("uint8")
+
+    def float64_video_background() -> None:
+        background = map_image_from_tile_bounds(tile_bounds, config) / 255
+        gray = np.sum(background * [0.2126, 0.7152, 0.0722], axis=2)
+        1.0 - np.dstack((gray, gray, gray))
+
+    def sharepic() -> None:
+        map_image_from_tile_bounds(tile_bounds, config)
+
+    def video_background() -> None:
+        background = convert_to_grayscale(
+            map_image_from_tile_bounds(tile_bounds, config)
+        )
+        np.subtract(255, background, out=background)
+
+    for name, old, new in [
+        ("Sharepic", float64_sharepic, sharepic),
+        ("Heatmap video", float64_video_background, video_background),
+    ]:
+        old_peak = measure_peak_bytes(old)
+        new_peak = measure_peak_bytes(new)
+        print(f"{name}: float64 {old_peak / 1e6:.0f} MB, uint8 {new_peak / 1e6:.0f} MB")
+        assert new_peak < old_peak / 4
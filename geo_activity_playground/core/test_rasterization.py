@@ -0,0 +1,118 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+from PIL import ImageDraw
+
+from .rasterization import concatenate_polylines
+from .rasterization import polylines_from_time_series
+from .rasterization import rasterize_polylines
+
+
+def test_horizontal_line() -> None:
+    counts = np.zeros((32, 32), dtype=np.int32)
+    rasterize_polylines(counts, np.array([[4.0, 10.0], [20.0, 10.0]]), [0, 2], 3)
+    assert np.flatnonzero(counts[:, 12]).tolist() == [9, 10, 11]
+    assert np.flatnonzero(counts[10]).tolist() == list(range(3, 22))
+    assert counts.max() == 1
+
+
+def test_polyline_counts_once() -> None:
+    # The polyline goes back and forth over the same pixels.
+    xy = np.array([[2.0, 5.0], [25.0, 5.0], [2.0, 5.0], [25.0, 6.0]])
+    counts = np.zeros((16, 32), dtype=np.int32)
+    rasterize_polylines(counts, xy, [0, 4], 4)
+    assert counts.max() == 1
+
+
+def test_polylines_add_up() -> None:
+    line = np.array([[2.0, 5.0], [25.0, 5.0]])
+    xy, offsets = concatenate_polylines(
+        [(line, np.array([0, 2])), (line, np.array([0, 2]))]
+    )
+    counts = np.zeros((16, 32), dtype=np.int32)
+    rasterize_polylines(counts, xy, offsets, 3)
+    assert counts.max() == 2 and counts[5, 10] == 2
+
+
+def test_clipping() -> None:
+    counts = np.zeros((16, 16), dtype=np.int32)
+    xy = np.array([[-1e6, 10.0], [1e6, 10.0], [1e6, 1e6], [100.0, -5.0]])
+    rasterize_polylines(counts, xy, [0, 2, 4], 3)
+    assert counts.sum() == 3 * 16
+    assert counts[9:12].min() == 1
+
+
+def test_single_point() -> None:
+    counts = np.zeros((16, 16), dtype=np.int32)
+    rasterize_polylines(counts, np.array([[8.0, 8.0]]), [0, 1], 5)
+    assert counts[8, 8] == 1 and counts[8, 10] == 1 and counts[8, 11] == 0
+
+
+def test_polylines_from_time_series() -> None:
+    time_series = pd.DataFrame(
+        {
+            "x": [0.1, 0.2, np.nan, 0.3, 0.4],
+            "y": [0.5, 0.5, 0.5, 0.5, 0.6],
+            "segment_id": [0, 0, 0, 1, 1],
+        }
+    )
+    xy, offsets = polylines_from_time_series(time_series)
+    assert xy.shape == (4, 2)
+    assert offsets.tolist() == [0, 2, 4]
+
+
+def random_polylines(
+    num_polylines: int, num_points: int, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    xy = np.floor(
+        np.cumsum(rng.normal(0, 15, (num_polylines, num_points, 2)), axis=1) + 128
+    )
+    offsets = np.arange(num_polylines + 1) * num_points
+    return xy.reshape(-1, 2), offsets
+
+
+def draw_with_pil(xy: np.ndarray, offsets: np.ndarray, width: int) -> np.ndarray:
+    counts = np.zeros((256, 256), dtype=np.int32)
+    for begin, end in zip(offsets[:-1], offsets[1:]):
+        im = Image.new("L", (256, 256))
+        ImageDraw.Draw(im).line(
+            list(map(int, xy[begin:end].flatten())), fill=1, width=width
+        )
+        counts += np.array(im)
+    return counts
+
+
+@pytest.mark.parametrize("width", [3, 6, 12])
+def test_similar_to_pil(width: int) -> None:
+    xy, offsets = random_polylines(5, 40)
+    expected = draw_with_pil(xy, offsets, width) > 0
+    counts = np.zeros((256, 256), dtype=np.int32)
+    rasterize_polylines(counts, xy, offsets, width)
+    actual = counts > 0
+    assert (actual & expected).sum() / (actual | expected).sum() > 0.75
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks."
+)
+def test_benchmark_against_pil() -> None:
+    # Tracks with a point every few pixels that mostly run outside of the tile.
+    rng = np.random.default_rng(0)
+    num_polylines, num_points = 50, 3000
+    heading = np.cumsum(rng.normal(0, 0.2, (num_polylines, num_points)), axis=1)
+    steps = np.stack([np.cos(heading), np.sin(heading)], axis=2) * 3
+    xy = np.cumsum(steps, axis=1) + rng.uniform(-200, 400, (num_polylines, 1, 2))
+    xy = xy.reshape(-1, 2)
+    offsets = np.arange(num_polylines + 1) * num_points
+    start = time.perf_counter()
+    draw_with_pil(xy, offsets, 3)
+    pil_duration = time.perf_counter() - start
+    start = time.perf_counter()
+    rasterize_polylines(np.zeros((256, 256), dtype=np.int32), xy, offsets, 3)
+    batch_duration = time.perf_counter() - start
+    print(f"PIL: {pil_duration:.3f} s, batch: {batch_duration:.3f} s")
@@ -0,0 +1,170 @@
+import gzip
+import io
+import os
+import pathlib
+import sqlite3
+import struct
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from .raster_map import DecodedTileCache
+from .raster_map import EMPTY_TILE_COLOR
+from .raster_map import OSM_TILE_SIZE
+from .tile_archives import MBTilesArchive
+from .tile_archives import open_tile_archive
+from .tile_archives import PMTilesArchive
+from .tile_archives import TileArchiveError
+from .tile_archives import zxy_to_tile_id
+
+
+def encode_tile(color: tuple[int, int, int]) -> bytes:
+    f = io.BytesIO()
+    Image.new("RGB", (OSM_TILE_SIZE, OSM_TILE_SIZE), color).save(f, format="png")
+    return f.getvalue()
+
+
+def varints(values: list[int]) -> bytes:
+    data = bytearray()
+    for value in values:
+        while value >= 0x80:
+            data.append(value & 0x7F | 0x80)
+            value >>= 7
+        data.append(value)
+    return bytes(data)
+
+
+def encode_directory(entries: list[tuple[int, int, int, int]]) -> bytes:
+    """
+    Directory of entries with tile id, run length, offset and length, gzip-compressed.
+    """
+    tile_ids = [entry[0] for entry in entries]
+    values = [len(entries)]
+    values += [tile_ids[0]] + [b - a for a, b in zip(tile_ids, tile_ids[1:])]
+    values += [entry[1] for entry in entries]
+    values += [entry[3] for entry in entries]
+    values += [
+        0 if i > 0 and offset == entries[i - 1][2] + entries[i - 1][3] else offset + 1
+        for i, (_, _, offset, _) in enumerate(entries)
+    ]
+    return gzip.compress(varints(values))
+
+
+def write_pmtiles(path: pathlib.Path, tiles: dict[tuple[int, int, int], bytes]) -> None:
+    """
+    Writes the tiles with the upper half of the ids in a leaf directory, and consecutive tiles with the same content as a run.
+    """
+    data = bytearray()
+    entries: list[list[int]] = []
+    for tile_id, content in sorted(
+        (zxy_to_tile_id(*zxy), content) for zxy, content in tiles.items()
+    ):
+        if (
+            entries
+            and entries[-1][0] + entries[-1][1] == tile_id
+            and data[entries[-1][2] :] == content
+        ):
+            entries[-1][1] += 1
+        else:
+            entries.append([tile_id, 1, len(data), len(content)])
+            data += content
+    split = len(entries) // 2
+    leaf = encode_directory(entries[split:])
+    root = encode_directory(entries[:split] + [(entries[split][0], 0, 0, len(leaf))])
+    root_offset = 127
+    leaf_offset = root_offset + len(root)
+    data_offset = leaf_offset + len(leaf)
+    header = struct.pack(
+        "<7sB11Q4B",
+        b"PMTiles",
+        3,
+        root_offset,
+        len(root),
+        0,
+        0,
+        leaf_offset,
+        len(leaf),
+        data_offset,
+        len(data),
+        len(tiles),
+        len(entries),
+        len(entries),
+        1,
+        2,
+        1,
+        2,
+    )
+    path.write_bytes(header.ljust(127, b"\0") + root + leaf + data)
+
+
+TILES = {
+    (0, 0, 0): encode_tile((10, 20, 30)),
+    (2, 1, 1): encode_tile((40, 50, 60)),
+    (2, 1, 2): encode_tile((40, 50, 60)),
+    (2, 2, 2): encode_tile((40, 50, 60)),
+    (2, 3, 0): encode_tile((70, 80, 90)),
+    (3, 5, 6): encode_tile((100, 110, 120)),
+}
+
+
+@pytest.fixture
+def mbtiles_path(tmp_path) -> pathlib.Path:
+    path = tmp_path / "region.mbtiles"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        connection.execute("INSERT INTO metadata VALUES ('format', 'png')")
+        connection.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+        connection.executemany(
+            "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+            [(z, x, 2**z - 1 - y, data) for (z, x, y), data in TILES.items()],
+        )
+    return path
+
+
+@pytest.fixture
+def pmtiles_path(tmp_path) -> pathlib.Path:
+    path = tmp_path / "region.pmtiles"
+    write_pmtiles(path, TILES)
+    return path
+
+
+@pytest.mark.parametrize("archive_type", [MBTilesArchive, PMTilesArchive])
+def test_archive(archive_type, mbtiles_path, pmtiles_path) -> None:
+    path = mbtiles_path if archive_type is MBTilesArchive else pmtiles_path
+    archive = archive_type(path)
+    for zxy, data in TILES.items():
+        assert archive.get_tile_bytes(*zxy) == data
+    assert archive.get_tile_bytes(2, 0, 0) is None
+    assert archive.get_tile_bytes(3, 5, 5) is None
+    assert archive.get_tile_bytes(5, 0, 0) is None
+
+
+def test_vector_tiles(mbtiles_path) -> None:
+    with sqlite3.connect(mbtiles_path) as connection:
+        connection.execute("UPDATE metadata SET value = 'pbf' WHERE name = 'format'")
+    with pytest.raises(TileArchiveError):
+        MBTilesArchive(mbtiles_path)
+
+
+def test_changed_archive_is_opened_again(pmtiles_path) -> None:
+    url_template = str(pmtiles_path)
+    archive = open_tile_archive(url_template)
+    assert open_tile_archive(url_template) is archive
+    modified = pmtiles_path.stat().st_mtime_ns
+    os.utime(pmtiles_path, ns=(modified + 10**9, modified + 10**9))
+    assert open_tile_archive(url_template) is not archive
+
+
+def test_decoded_tiles_from_archive(pmtiles_path) -> None:
+    url_template = str(pmtiles_path)
+    assert isinstance(open_tile_archive(url_template), PMTilesArchive)
+    assert (
+        open_tile_archive("https://tile.openstreetmap.org/{zoom}/{x}/{y}.png") is None
+    )
+    cache = DecodedTileCache()
+    assert cache.get_tile(2, 3, 0, url_template)[0, 0].tolist() == [70, 80, 90]
+    empty = cache.get_tile(2, 0, 0, url_template)
+    assert np.all(empty == EMPTY_TILE_COLOR)
@@ -0,0 +1,145 @@
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+from .tile_fetcher import TileFetcher
+from .tile_fetcher import TileFetchError
+
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for a tile server that answers with the path as content and an ETag, and fails on request.
+    """
+
+    def do_GET(self) -> None:
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+        if failures:
+            self.send_response(503)
+            self.end_headers()
+        elif self.path.startswith("/missing"):
+            self.send_response(404)
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == f'"{self.path}"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = self.path.encode() * 100
+            self.send_response(200)
+            self.send_header("ETag", f'"{self.path}"')
+            self.send_header("Cache-Control", "max-age=3600")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path: str) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+@pytest.fixture
+def fetcher(tmp_path) -> TileFetcher:
+    return TileFetcher(tmp_path, min_interval=0.0, retry_delay=0.01)
+
+
+def test_download_once(server, fetcher, tmp_path) -> None:
+    destination = tmp_path / "1/2/3.png"
+    assert fetcher.fetch(url(server, "/1/2/3.png"), destination) == destination
+    assert destination.read_bytes() == b"/1/2/3.png" * 100
+    fetcher.fetch(url(server, "/1/2/3.png"), destination)
+    assert server.requests == ["/1/2/3.png"]
+
+
+def test_revalidate_expired(server, fetcher, tmp_path) -> None:
+    destination = tmp_path / "1/2/3.png"
+    fetcher.fetch(url(server, "/1/2/3.png"), destination)
+    meta_path = tmp_path / "1/2/3.png.json"
+    meta_path.write_text(meta_path.read_text().replace('"expires": ', '"expires": -'))
+    fetcher.fetch(url(server, "/1/2/3.png"), destination)
+    assert len(server.requests) == 2
+    assert destination.read_bytes() == b"/1/2/3.png" * 100
+    # The 304 has made the tile fresh again.
+    fetcher.fetch(url(server, "/1/2/3.png"), destination)
+    assert len(server.requests) == 2
+
+
+def test_retry(server, fetcher, tmp_path) -> None:
+    server.failures["/1/2/3.png"] = 2
+    fetcher.fetch(url(server, "/1/2/3.png"), tmp_path / "1/2/3.png")
+    assert server.requests == ["/1/2/3.png"] * 3
+
+
+def test_failure(server, fetcher, tmp_path) -> None:
+    with pytest.raises(TileFetchError):
+        fetcher.fetch(url(server, "/missing.png"), tmp_path / "missing.png")
+    # Client errors are not retried.
+    assert server.requests == ["/missing.png"]
+    assert not (tmp_path / "missing.png").exists()
+
+
+def test_use_expired_when_offline(server, fetcher, tmp_path) -> None:
+    destination = tmp_path / "1/2/3.png"
+    destination.parent.mkdir(parents=True)
+    destination.write_bytes(b"old")
+    os.utime(destination, (0, 0))
+    server.failures["/1/2/3.png"] = 10
+    fetcher.fetch(url(server, "/1/2/3.png"), destination)
+    assert destination.read_bytes() == b"old"
+    assert len(server.requests) == fetcher.max_retries + 1
+
+
+def wait_for_size(fetcher: TileFetcher) -> None:
+    thread = fetcher._size_thread
+    if thread is not None:
+        thread.join()
+
+
+def test_evict_least_recently_used(server, tmp_path) -> None:
+    # Every tile has 1000 bytes.
+    fetcher = TileFetcher(tmp_path, min_interval=0.0, max_bytes=3500)
+    paths = [f"/{i}/0/0.png" for i in range(1, 4)]
+    for path in paths:
+        fetcher.fetch(url(server, path), tmp_path / path[1:])
+    wait_for_size(fetcher)
+    assert fetcher._total_bytes == 3000
+    os.utime(tmp_path / "2/0/0.png", (1, 1))
+    os.utime(tmp_path / "1/0/0.png", (2, 2))
+    fetcher.fetch(url(server, "/4/0/0.png"), tmp_path / "4/0/0.png")
+    wait_for_size(fetcher)
+    assert not (tmp_path / "2/0/0.png").exists()
+    assert not (tmp_path / "2/0/0.png.json").exists()
+    assert all((tmp_path / name).exists() for name in ["1/0/0.png", "3/0/0.png"])
+
+
+def test_fetch_many_rate_limited(server, tmp_path) -> None:
+    fetcher = TileFetcher(tmp_path, max_workers=4, min_interval=0.05)
+    items = [
+        (url(server, f"/{i}/0/0.png"), tmp_path / f"{i}/0/0.png") for i in range(6)
+    ]
+    start = time.monotonic()
+    assert fetcher.fetch_many(items) == [destination for _, destination in items]
+    assert time.monotonic() - start >= 0.25
+    assert sorted(server.requests) == sorted(f"/{i}/0/0.png" for i in range(6))
@@ -1,6 +1,9 @@
+import numpy as np
+
 from .tiles import compute_tile
 from .tiles import get_tile_upper_left_lat_lon
 from .tiles import interpolate_missing_tile
+from .tiles import interpolate_missing_tiles
 
 
 def test_rheinbach() -> None:
@@ -21,3 +24,16 @@ def test_interpolate() -> None:
     assert interpolate_missing_tile(2.5, 1.5, 1.25, 2.25) == (1, 1)
     assert interpolate_missing_tile(2.25, 2.5, 1.75, 1.25) == (2, 1)
     assert interpolate_missing_tile(1.25, 2.25, 2.25, 2.5) == None
+
+
+def test_interpolate_vectorized() -> None:
+    rng = np.random.default_rng(0)
+    x1, y1, x2, y2 = rng.uniform(10, 13, (4, 1000))
+    mask, tile_x, tile_y = interpolate_missing_tiles(x1, y1, x2, y2)
+    for i in range(len(x1)):
+        expected = interpolate_missing_tile(x1[i], y1[i], x2[i], y2[i])
+        if expected is None:
+            assert not mask[i]
+        else:
+            assert mask[i]
+            assert (tile_x[i], tile_y[i]) == expected
@@ -0,0 +1,304 @@
+"""
+Map tiles from a single local file, for machines without access to a tile server.
+"""
+
+import abc
+import bisect
+import collections
+import dataclasses
+import functools
+import gzip
+import mmap
+import pathlib
+import sqlite3
+import struct
+import threading
+from typing import Optional
+
+ARCHIVE_SUFFIXES = {".mbtiles", ".pmtiles"}
+
+
+class TileArchiveError(RuntimeError):
+    pass
+
+
+class TileArchive(abc.ABC):
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+
+    @abc.abstractmethod
+    def get_tile_bytes(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """
+        Encoded image of a tile in the usual XYZ scheme or `None` if the archive doesn't have it.
+        """
+        pass
+
+
+class MBTilesArchive(TileArchive):
+    """
+    Tiles from an MBTiles file, which is an SQLite database with a table of tiles.
+
+    Every thread gets a read-only connection of its own that is kept open. Rows are numbered from the south in MBTiles, so `y` is flipped.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        super().__init__(path)
+        self._uri = path.resolve().as_uri() + "?mode=ro"
+        self._local = threading.local()
+        tile_format = (
+            self._get_connection()
+            .execute("SELECT value FROM metadata WHERE name = 'format'")
+            .fetchone()
+        )
+        if tile_format is not None and tile_format[0] == "pbf":
+            raise TileArchiveError(
+                f"{path} has vector tiles, only images are supported."
+            )
+
+    def get_tile_bytes(self, z: int, x: int, y: int) -> Optional[bytes]:
+        row = (
+            self._get_connection()
+            .execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, 2**z - 1 - y),
+            )
+            .fetchone()
+        )
+        return None if row is None else bytes(row[0])
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+            self._local.connection = connection
+        return connection
+
+
+@dataclasses.dataclass
+class PMTilesHeader:
+    root_offset: int
+    root_length: int
+    leaf_directory_offset: int
+    tile_data_offset: int
+    internal_compression: int
+    tile_compression: int
+    tile_type: int
+
+    # Layout of the fixed header of PMTiles version 3, little-endian.
+    FORMAT = "<7sB11Q4B"
+    LENGTH = 127
+    COMPRESSION_NONE = 1
+    COMPRESSION_GZIP = 2
+    TILE_TYPE_MVT = 1
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "PMTilesHeader":
+        fields = struct.unpack_from(cls.FORMAT, data)
+        magic, version = fields[:2]
+        if magic != b"PMTiles" or version != 3:
+            raise TileArchiveError("Only PMTiles version 3 is supported.")
+        (
+            root_offset,
+            root_length,
+            _metadata_offset,
+            _metadata_length,
+            leaf_directory_offset,
+            _leaf_directory_length,
+            tile_data_offset,
+            *_,
+        ) = fields[2:13]
+        _clustered, internal_compression, tile_compression, tile_type = fields[13:17]
+        return cls(
+            root_offset,
+            root_length,
+            leaf_directory_offset,
+            tile_data_offset,
+            internal_compression,
+            tile_compression,
+            tile_type,
+        )
+
+
+@dataclasses.dataclass
+class PMTilesDirectory:
+    """
+    Entries of a PMTiles directory as parallel lists, sorted by tile id.
+
+    An entry with a run length of zero points to a leaf directory, every other entry to the data of `run_length` consecutive tiles.
+    """
+
+    tile_ids: list[int]
+    run_lengths: list[int]
+    offsets: list[int]
+    lengths: list[int]
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "PMTilesDirectory":
+        values = _read_varints(data)
+        num_entries = values[0]
+        columns = [
+            values[1 + i * num_entries : 1 + (i + 1) * num_entries] for i in range(4)
+        ]
+        tile_ids, run_lengths, lengths, raw_offsets = columns
+        for i in range(1, num_entries):
+            tile_ids[i] += tile_ids[i - 1]
+        offsets = []
+        for i, raw_offset in enumerate(raw_offsets):
+            if raw_offset == 0 and i > 0:
+                offsets.append(offsets[i - 1] + lengths[i - 1])
+            else:
+                offsets.append(raw_offset - 1)
+        return cls(tile_ids, run_lengths, offsets, lengths)
+
+    def find(self, tile_id: int) -> Optional[int]:
+        """
+        Index of the entry that covers a tile or the leaf directory that might have it.
+        """
+        index = bisect.bisect_right(self.tile_ids, tile_id) - 1
+        if index < 0:
+            return None
+        if self.run_lengths[index] == 0:
+            return index
+        if tile_id - self.tile_ids[index] < self.run_lengths[index]:
+            return index
+        return None
+
+
+class PMTilesArchive(TileArchive):
+    """
+    Tiles from a PMTiles file, which has all tiles and a directory of them in a single file.
+
+    The file is memory-mapped, such that tiles are read by random access from any thread. Tiles are looked up by their id along a Hilbert curve in the root directory and at most three levels of leaf directories, the most recently used of which are kept decoded.
+    """
+
+    MAX_DEPTH = 4
+    NUM_CACHED_LEAVES = 64
+
+    def __init__(self, path: pathlib.Path) -> None:
+        super().__init__(path)
+        with open(path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header = PMTilesHeader.from_bytes(self._data[: PMTilesHeader.LENGTH])
+        if self._header.tile_type == PMTilesHeader.TILE_TYPE_MVT:
+            raise TileArchiveError(
+                f"{path} has vector tiles, only images are supported."
+            )
+        self._root = self._read_directory(
+            self._header.root_offset, self._header.root_length
+        )
+        self._leaves: collections.OrderedDict[int, PMTilesDirectory] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get_tile_bytes(self, z: int, x: int, y: int) -> Optional[bytes]:
+        tile_id = zxy_to_tile_id(z, x, y)
+        directory = self._root
+        for _ in range(self.MAX_DEPTH):
+            index = directory.find(tile_id)
+            if index is None:
+                return None
+            offset, length = directory.offsets[index], directory.lengths[index]
+            if directory.run_lengths[index] > 0:
+                start = self._header.tile_data_offset + offset
+                return _decompress(
+                    self._data[start : start + length], self._header.tile_compression
+                )
+            directory = self._get_leaf(offset, length)
+        return None
+
+    def _get_leaf(self, offset: int, length: int) -> PMTilesDirectory:
+        with self._lock:
+            leaf = self._leaves.get(offset, None)
+            if leaf is not None:
+                self._leaves.move_to_end(offset)
+                return leaf
+        leaf = self._read_directory(self._header.leaf_directory_offset + offset, length)
+        with self._lock:
+            self._leaves[offset] = leaf
+            if len(self._leaves) > self.NUM_CACHED_LEAVES:
+                self._leaves.popitem(last=False)
+        return leaf
+
+    def _read_directory(self, offset: int, length: int) -> PMTilesDirectory:
+        return PMTilesDirectory.from_bytes(
+            _decompress(
+                self._data[offset : offset + length],
+                self._header.internal_compression,
+            )
+        )
+
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    """
+    Id of a tile in PMTiles: all tiles of lower zoom levels come first, then the tiles of the zoom level along a Hilbert curve.
+    """
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    for level in reversed(range(z)):
+        size = 1 << level
+        rx = (x >> level) & 1
+        ry = (y >> level) & 1
+        tile_id += size * size * ((3 * rx) ^ ry)
+        # Rotate the quadrant, such that the curve continues within it.
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - (x & (size - 1))
+                y = size - 1 - (y & (size - 1))
+            x, y = y, x
+    return tile_id
+
+
+def _read_varints(data: bytes) -> list[int]:
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+def _decompress(data: bytes, compression: int) -> bytes:
+    if compression == PMTilesHeader.COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    if compression in (0, PMTilesHeader.COMPRESSION_NONE):
+        return bytes(data)
+    raise TileArchiveError(f"Unsupported compression {compression} in PMTiles.")
+
+
+def archive_path(url_template: str) -> Optional[pathlib.Path]:
+    """
+    Path of the tile archive that a tile source refers to, or `None` for a URL of a tile server.
+    """
+    path = pathlib.Path(url_template.removeprefix("file://"))
+    if "{" in url_template or path.suffix not in ARCHIVE_SUFFIXES:
+        return None
+    return path
+
+
+def open_tile_archive(url_template: str) -> Optional[TileArchive]:
+    """
+    Tile archive of a tile source, which stays open for all later lookups until the file is replaced.
+    """
+    path = archive_path(url_template)
+    if path is None:
+        return None
+    try:
+        mtime_ns = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        raise TileArchiveError(f"Tile archive {path} does not exist.") from None
+    return _open_tile_archive(path, mtime_ns)
+
+
+@functools.lru_cache(8)
+def _open_tile_archive(path: pathlib.Path, mtime_ns: int) -> TileArchive:
+    # The modification time is part of the key, such that a changed file is opened again.
+    if path.suffix == ".mbtiles":
+        return MBTilesArchive(path)
+    else:
+        return PMTilesArchive(path)
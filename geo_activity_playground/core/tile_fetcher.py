@@ -0,0 +1,293 @@
+import concurrent.futures
+import email.utils
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import urllib.parse
+from typing import Optional
+
+import requests.adapters
+
+from .paths import atomic_open
+
+logger = logging.getLogger(__name__)
+
+
+class TileFetchError(RuntimeError):
+    pass
+
+
+class TileFetcher:
+    """
+    Downloads map tiles into a directory that serves as a cache on disk.
+
+    All downloads share one HTTP session with a connection pool and run on a small thread pool. Requests to the same host are spaced by `min_interval` seconds to stay within the usage policy of the tile servers. Failed requests are retried with a growing delay.
+
+    Next to every tile a small metadata file keeps its ETag, its Last-Modified date and until when it is fresh. A tile that has expired is revalidated with a conditional request, such that an unchanged tile costs a 304 without a body. If the server cannot be reached, the expired tile is used anyway.
+
+    The directory is kept below `max_bytes` by deleting the tiles that have not been used for the longest time. Every use of a tile updates its access time for that. The directory is listed and cleaned up in a background thread, such that no download waits for it.
+    """
+
+    USER_AGENT = "Martin's Geo Activity Playground"
+    # Freshness of tiles without caching headers and of tiles downloaded before the metadata has been kept.
+    DEFAULT_MAX_AGE = 7 * 24 * 3600
+    # An expired tile that could not be revalidated is used for this long before trying again.
+    RETRY_STALE_AFTER = 3600
+    # Eviction deletes tiles until the directory is this fraction of the limit.
+    EVICTION_TARGET = 0.9
+    # Downloads to destinations that share one of these locks wait for each other.
+    NUM_DESTINATION_LOCKS = 64
+
+    def __init__(
+        self,
+        base_dir: pathlib.Path = pathlib.Path("Open Street Map Tiles"),
+        max_workers: int = 2,
+        min_interval: float = 0.1,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+        timeout: float = 30.0,
+        max_bytes: int = 2_000_000_000,
+    ) -> None:
+        self.base_dir = base_dir
+        self.max_workers = max_workers
+        self.min_interval = min_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = self.USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._next_request: dict[str, float] = {}
+        self._destination_locks = [
+            threading.Lock() for _ in range(self.NUM_DESTINATION_LOCKS)
+        ]
+        self._lock = threading.Lock()
+        self._size_lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+        # Bytes added while the size of the directory is being determined.
+        self._unmeasured_bytes = 0
+        self._size_thread: Optional[threading.Thread] = None
+
+    def fetch(self, url: str, destination: pathlib.Path) -> pathlib.Path:
+        """
+        Makes sure that `destination` has a current copy of `url` and returns it.
+        """
+        with self._get_destination_lock(destination):
+            meta_path = _meta_path(destination)
+            if destination.exists():
+                meta = _load_meta(meta_path, destination)
+                if meta["expires"] > time.time():
+                    mark_used(destination)
+                    return destination
+                try:
+                    self._download(url, destination, meta)
+                except TileFetchError as e:
+                    logger.warning(f"Using expired tile {destination}: {e}")
+                    meta["expires"] = time.time() + self.RETRY_STALE_AFTER
+                    _save_meta(meta_path, meta)
+                mark_used(destination)
+            else:
+                logger.info(f"Downloading tile {url} …")
+                self._download(url, destination, {})
+        return destination
+
+    def fetch_many(self, items: list[tuple[str, pathlib.Path]]) -> list[pathlib.Path]:
+        """
+        Fetches several tiles concurrently, given as pairs of URL and destination.
+        """
+        executor = self._get_executor()
+        futures = [
+            executor.submit(self.fetch, url, destination) for url, destination in items
+        ]
+        return [future.result() for future in futures]
+
+    def _download(self, url: str, destination: pathlib.Path, meta: dict) -> None:
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        response = self._request(url, headers)
+        if response.status_code == 304:
+            meta["expires"] = time.time() + _max_age(response, self.DEFAULT_MAX_AGE)
+            _save_meta(_meta_path(destination), meta)
+            return
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        previous_size = destination.stat().st_size if destination.exists() else 0
+        with atomic_open(destination, "wb") as f:
+            f.write(response.content)
+        _save_meta(
+            _meta_path(destination),
+            {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "expires": time.time() + _max_age(response, self.DEFAULT_MAX_AGE),
+            },
+        )
+        self.add_bytes(len(response.content) - previous_size)
+
+    def _request(self, url: str, headers: dict[str, str]) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_host(urllib.parse.urlsplit(url).netloc)
+            delay = self.retry_delay * 2**attempt
+            try:
+                response = self._session.get(
+                    url, headers=headers, timeout=self.timeout, allow_redirects=True
+                )
+            except requests.RequestException as e:
+                error = f"{e}"
+            else:
+                if response.status_code in (200, 304):
+                    return response
+                error = f"HTTP status {response.status_code}"
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            if attempt < self.max_retries:
+                logger.debug(f"Retrying {url} in {delay} s after: {error}")
+                time.sleep(delay)
+        raise TileFetchError(f"Cannot download {url}: {error}")
+
+    def _wait_for_host(self, host: str) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_request.get(host, now))
+            self._next_request[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def add_bytes(self, num_bytes: int) -> None:
+        """
+        Counts bytes that have been written into the directory, also by others, and starts the eviction once it has become too big.
+        """
+        with self._size_lock:
+            if self._size_thread is not None:
+                self._unmeasured_bytes += num_bytes
+                return
+            if self._total_bytes is not None:
+                self._total_bytes += num_bytes
+                if self._total_bytes <= self.max_bytes:
+                    return
+            self._unmeasured_bytes = 0
+            self._size_thread = threading.Thread(
+                target=self._update_size, name="TileFetcher-size", daemon=True
+            )
+            self._size_thread.start()
+
+    def _update_size(self) -> None:
+        """
+        Lists the directory to determine its size and deletes tiles while it is too big.
+        """
+        try:
+            while True:
+                tiles = _list_tiles(self.base_dir)
+                total_bytes = sum(size for _, size, _ in tiles)
+                if total_bytes > self.max_bytes:
+                    total_bytes = self._evict(
+                        tiles, int(self.EVICTION_TARGET * self.max_bytes)
+                    )
+                with self._size_lock:
+                    total_bytes += self._unmeasured_bytes
+                    self._unmeasured_bytes = 0
+                    if total_bytes <= self.max_bytes:
+                        self._total_bytes = total_bytes
+                        self._size_thread = None
+                        return
+        except Exception:
+            logger.exception(f"Cannot determine the size of {self.base_dir}.")
+            with self._size_lock:
+                self._total_bytes = None
+                self._size_thread = None
+
+    def _evict(
+        self, tiles: list[tuple[pathlib.Path, int, float]], target_bytes: int
+    ) -> int:
+        """
+        Deletes the least recently used tiles until the directory has at most `target_bytes` and returns its size.
+        """
+        tiles = sorted(tiles, key=lambda tile: tile[2])
+        total_bytes = sum(size for _, size, _ in tiles)
+        num_deleted = 0
+        for path, size, _ in tiles:
+            if total_bytes <= target_bytes:
+                break
+            path.unlink(missing_ok=True)
+            _meta_path(path).unlink(missing_ok=True)
+            total_bytes -= size
+            num_deleted += 1
+        logger.info(
+            f"Deleted {num_deleted} least recently used tiles to stay below {self.max_bytes} bytes."
+        )
+        return total_bytes
+
+    def _get_destination_lock(self, destination: pathlib.Path) -> threading.Lock:
+        return self._destination_locks[hash(destination) % len(self._destination_locks)]
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="TileFetcher"
+                )
+            return self._executor
+
+
+def _meta_path(destination: pathlib.Path) -> pathlib.Path:
+    return destination.with_name(destination.name + ".json")
+
+
+def _load_meta(meta_path: pathlib.Path, destination: pathlib.Path) -> dict:
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"expires": destination.stat().st_mtime + TileFetcher.DEFAULT_MAX_AGE}
+
+
+def _save_meta(meta_path: pathlib.Path, meta: dict) -> None:
+    with atomic_open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+def mark_used(path: pathlib.Path) -> None:
+    """
+    Marks a tile as used by setting its access time and keeping its modification time, such that it is evicted later.
+    """
+    os.utime(path, (time.time(), path.stat().st_mtime))
+
+
+def _list_tiles(base_dir: pathlib.Path) -> list[tuple[pathlib.Path, int, float]]:
+    tiles = []
+    for path in base_dir.rglob("*"):
+        if path.suffix == ".json" or not path.is_file():
+            continue
+        stat = path.stat()
+        tiles.append((path, stat.st_size, stat.st_atime))
+    return tiles
+
+
+def _max_age(response: requests.Response, default: float) -> float:
+    for directive in response.headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            return int(value)
+    expires = response.headers.get("Expires")
+    if expires:
+        try:
+            return email.utils.parsedate_to_datetime(expires).timestamp() - time.time()
+        except (TypeError, ValueError):
+            pass
+    return default
@@ -36,6 +36,18 @@ def get_tile_upper_left_lat_lon(
     return lat_deg, lon_deg
 
 
+def get_tile_upper_left_lat_lon_array(
+    tile_x: np.ndarray, tile_y: np.ndarray, zoom: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized version of `get_tile_upper_left_lat_lon` for many tile corners.
+    """
+    n = 2.0**zoom
+    lon_deg = np.asarray(tile_x) / n * 360.0 - 180.0
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(tile_y) / n))))
+    return lat_deg, lon_deg
+
+
 def xy_to_latlon(x: float, y: float, zoom: int) -> tuple[float, float]:
     """
     Returns (lat, lon) in degree from OSM coordinates (x,y) rom https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
@@ -69,6 +81,36 @@ def interpolate_missing_tile(
         return (int(x1), y_hat)
 
 
+def interpolate_missing_tiles(
+    x1: np.ndarray, y1: np.ndarray, x2: np.ndarray, y2: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorized version of `interpolate_missing_tile` for many pairs of points.
+
+    Returns a mask of the pairs that need an interpolated tile together with the tile coordinates. Entries outside of the mask are meaningless.
+    """
+    ix1, iy1, ix2, iy2 = np.trunc(x1), np.trunc(y1), np.trunc(x2), np.trunc(y2)
+    with np.errstate(invalid="ignore"):
+        mask = (
+            np.isfinite(x1)
+            & np.isfinite(y1)
+            & np.isfinite(x2)
+            & np.isfinite(y2)
+            & (ix1 != ix2)
+            & (iy1 != iy2)
+            & (np.abs(ix1 - ix2) <= 1)
+            & (np.abs(iy1 - iy2) <= 1)
+        )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_hat = np.trunc(np.maximum(x1, x2))
+        l = (x_hat - x1) / (x2 - x1)
+        y_hat = np.trunc(y1 + l * (y2 - y1))
+    tile_x = np.where(y_hat == iy1, ix2, ix1)
+    tile_x = np.where(mask, tile_x, 0).astype(np.int64)
+    tile_y = np.where(mask, y_hat, 0).astype(np.int64)
+    return mask, tile_x, tile_y
+
+
 def adjacent_to(tile: tuple[int, int]) -> Iterator[tuple[int, int]]:
     x, y = tile
     yield (x + 1, y)
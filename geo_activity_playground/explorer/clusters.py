@@ -0,0 +1,141 @@
+from typing import Optional
+
+from ..core.tiles import adjacent_to
+
+
+class TileClusters:
+    """
+    Incremental cluster detection for explorer tiles.
+
+    A cluster tile is a visited tile whose four neighbors are also visited. Adjacent cluster tiles form a cluster. The clusters are kept in a union-find structure with union by size and path compression, such that adding a tile is amortized constant time regardless of the size of the biggest cluster.
+
+    Each cluster is named after one of its tiles. When two clusters merge, the merged cluster keeps the name of the cluster that the newly added tile touches, the same way the former list-based implementation did.
+    """
+
+    def __init__(self) -> None:
+        self.num_neighbors: dict[tuple[int, int], int] = {}
+        self.max_cluster_size = 0
+        self._parents: dict[tuple[int, int], tuple[int, int]] = {}
+        self._sizes: dict[tuple[int, int], int] = {}
+        self._names: dict[tuple[int, int], tuple[int, int]] = {}
+        self._memberships: Optional[dict[tuple[int, int], tuple[int, int]]] = None
+        self._clusters: Optional[dict[tuple[int, int], list[tuple[int, int]]]] = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_memberships"] = None
+        state["_clusters"] = None
+        return state
+
+    def __contains__(self, tile: tuple[int, int]) -> bool:
+        return tile in self._parents
+
+    def __len__(self) -> int:
+        return len(self._parents)
+
+    def add_tile(self, tile: tuple[int, int]) -> bool:
+        """
+        Adds a newly visited tile and returns whether clusters have been merged.
+        """
+        # This tile is new, therefore it doesn't have an entries in the neighbor list yet.
+        self.num_neighbors[tile] = 0
+        for other in adjacent_to(tile):
+            if other in self.num_neighbors:
+                self.num_neighbors[tile] += 1
+                self.num_neighbors[other] += 1
+
+        # The current tile and its neighbors become their own clusters, if they are full now.
+        this_and_neighbors = [tile] + list(adjacent_to(tile))
+        for other in this_and_neighbors:
+            if self.num_neighbors.get(other, 0) == 4 and other not in self._parents:
+                self._parents[other] = other
+                self._sizes[other] = 1
+                self._names[other] = other
+                self.max_cluster_size = max(self.max_cluster_size, 1)
+                self._invalidate()
+
+        merged = False
+        for candidate in this_and_neighbors:
+            if candidate not in self._parents:
+                continue
+            for other in adjacent_to(candidate):
+                if other not in self._parents:
+                    continue
+                if self._union(candidate, other):
+                    merged = True
+        return merged
+
+    def find(self, tile: tuple[int, int]) -> tuple[int, int]:
+        root = tile
+        while (parent := self._parents[root]) != root:
+            root = parent
+        while tile != root:
+            parent = self._parents[tile]
+            self._parents[tile] = root
+            tile = parent
+        return root
+
+    def name_of(self, tile: tuple[int, int]) -> Optional[tuple[int, int]]:
+        if tile in self._parents:
+            return self._names[self.find(tile)]
+        else:
+            return None
+
+    def size_of(self, tile: tuple[int, int]) -> int:
+        if tile in self._parents:
+            return self._sizes[self.find(tile)]
+        else:
+            return 0
+
+    @property
+    def memberships(self) -> dict[tuple[int, int], tuple[int, int]]:
+        """
+        Maps every cluster tile to the name of its cluster.
+        """
+        self._materialize()
+        assert self._memberships is not None
+        return self._memberships
+
+    @property
+    def clusters(self) -> dict[tuple[int, int], list[tuple[int, int]]]:
+        """
+        Maps the name of every cluster to its tiles.
+        """
+        self._materialize()
+        assert self._clusters is not None
+        return self._clusters
+
+    def _union(self, candidate: tuple[int, int], other: tuple[int, int]) -> bool:
+        candidate_root = self.find(candidate)
+        other_root = self.find(other)
+        if candidate_root == other_root:
+            return False
+        name = self._names[candidate_root]
+        if self._sizes[candidate_root] < self._sizes[other_root]:
+            big, small = other_root, candidate_root
+        else:
+            big, small = candidate_root, other_root
+        self._parents[small] = big
+        self._sizes[big] += self._sizes.pop(small)
+        del self._names[small]
+        self._names[big] = name
+        self.max_cluster_size = max(self.max_cluster_size, self._sizes[big])
+        self._invalidate()
+        return True
+
+    def _invalidate(self) -> None:
+        self._memberships = None
+        self._clusters = None
+
+    def _materialize(self) -> None:
+        if self._memberships is not None and self._clusters is not None:
+            return
+        memberships = {tile: self._names[self.find(tile)] for tile in self._parents}
+        members: dict[tuple[int, int], list[tuple[int, int]]] = {}
+        for tile, name in memberships.items():
+            members.setdefault(name, []).append(tile)
+        # Clusters are ordered by the time their name became a cluster tile.
+        self._clusters = {
+            name: members[name] for name in self._parents if name in members
+        }
+        self._memberships = memberships
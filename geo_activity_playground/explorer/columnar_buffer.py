@@ -0,0 +1,110 @@
+from typing import Any
+from typing import Optional
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+UTC_TIME = "datetime64[ns, UTC]"
+
+
+class ColumnarBuffer:
+    """
+    Append-only table that stores each column in a NumPy array.
+
+    The arrays grow geometrically, such that appending a few rows at a time is amortized constant time per row instead of copying the whole table like `pd.concat` does. The DataFrame is only assembled when `frame` is accessed and then kept until the next change.
+
+    Columns with the dtype `UTC_TIME` hold time zone aware timestamps. They are stored as nanoseconds since the epoch, naive timestamps are assumed to be UTC.
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, columns: dict[str, str]) -> None:
+        self.columns = dict(columns)
+        self._clear()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_arrays"] = {
+            name: array[: self._length].copy() for name, array in self._arrays.items()
+        }
+        state["_frame"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self._length
+
+    def append(self, rows: Union[pd.DataFrame, dict[str, Any], list[dict]]) -> None:
+        """
+        Appends rows given as a DataFrame, a dict of columns or a list of records.
+        """
+        if isinstance(rows, list):
+            rows = pd.DataFrame(rows, columns=list(self.columns))
+        values = {
+            name: self._to_storage(rows[name], dtype)
+            for name, dtype in self.columns.items()
+        }
+        num_rows = len(next(iter(values.values()))) if values else 0
+        if num_rows == 0:
+            return
+        self._reserve(self._length + num_rows)
+        for name, array in values.items():
+            self._arrays[name][self._length : self._length + num_rows] = array
+        self._length += num_rows
+        self._frame = None
+
+    def replace(self, rows: Union[pd.DataFrame, dict[str, Any], list[dict]]) -> None:
+        """
+        Replaces the whole content, for instance after rows have been removed or reordered.
+        """
+        self._clear()
+        self.append(rows)
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            self._frame = pd.DataFrame(
+                {
+                    name: self._from_storage(self._arrays[name][: self._length], dtype)
+                    for name, dtype in self.columns.items()
+                }
+            )
+        return self._frame
+
+    def _clear(self) -> None:
+        # Always fresh arrays, such that frames handed out before are not overwritten.
+        self._length = 0
+        self._arrays = {
+            name: np.empty(self.INITIAL_CAPACITY, dtype=self._storage_dtype(dtype))
+            for name, dtype in self.columns.items()
+        }
+        self._frame: Optional[pd.DataFrame] = None
+
+    def _reserve(self, capacity: int) -> None:
+        current = len(next(iter(self._arrays.values()))) if self._arrays else 0
+        if capacity <= current:
+            return
+        new_capacity = max(capacity, 2 * current, self.INITIAL_CAPACITY)
+        for name, array in self._arrays.items():
+            grown = np.empty(new_capacity, dtype=array.dtype)
+            grown[: self._length] = array[: self._length]
+            self._arrays[name] = grown
+
+    @staticmethod
+    def _storage_dtype(dtype: str) -> np.dtype:
+        if dtype == UTC_TIME:
+            return np.dtype(np.int64)
+        return np.dtype(dtype)
+
+    @staticmethod
+    def _to_storage(values: Any, dtype: str) -> np.ndarray:
+        if dtype == UTC_TIME:
+            times = pd.DatetimeIndex(pd.to_datetime(values, utc=True))
+            return times.as_unit("ns").asi8
+        return np.asarray(values, dtype=dtype)
+
+    @staticmethod
+    def _from_storage(array: np.ndarray, dtype: str) -> Any:
+        if dtype == UTC_TIME:
+            return pd.DatetimeIndex(array.view("datetime64[ns]")).tz_localize("UTC")
+        return array
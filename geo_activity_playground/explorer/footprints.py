@@ -0,0 +1,149 @@
+import dataclasses
+import datetime
+import functools
+import threading
+from collections.abc import Iterable
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .tile_bitmap import TileBitmap
+from .tile_sets import find_clusters
+from .tile_sets import find_max_square
+from .tile_sets import split_tile_keys
+from .tile_sets import tile_keys
+from .tile_visits import TileVisitAccessor
+
+
+@dataclasses.dataclass
+class ZoomFootprints:
+    """
+    The tiles of all activities at one zoom level as flat columns, one row per activity and tile.
+    """
+
+    activity_id: np.ndarray
+    key: np.ndarray
+    time: np.ndarray
+
+
+@dataclasses.dataclass
+class FilteredExplorerState:
+    """
+    Explorer tiles, clusters and the biggest square of a subset of the activities.
+
+    The attributes that the tile renderer needs have the same names as in `TileEvolutionState`.
+    """
+
+    keys: np.ndarray
+    first_time: np.ndarray
+    last_time: np.ndarray
+    num_visits: np.ndarray
+    memberships: dict[tuple[int, int], tuple[int, int]]
+    clusters: dict[tuple[int, int], list[tuple[int, int]]]
+    max_square_size: int
+    square_x: Optional[int]
+    square_y: Optional[int]
+
+    @functools.cached_property
+    def visited_tiles(self) -> TileBitmap:
+        return TileBitmap.from_tiles(*split_tile_keys(self.keys))
+
+    @property
+    def tiles(self) -> pd.DataFrame:
+        tile_x, tile_y = split_tile_keys(self.keys)
+        return pd.DataFrame({"tile_x": tile_x, "tile_y": tile_y})
+
+
+class FootprintIndex:
+    """
+    Flat per-zoom copy of the reverse index from activities to tiles.
+
+    The reverse index in the tile state has a small DataFrame per activity. Selecting the tiles of many activities from that is slow, so the footprints of a zoom level are concatenated once per data version. Combining the footprints of any set of activities is then a single `np.isin`.
+    """
+
+    def __init__(self, tile_visit_accessor: TileVisitAccessor) -> None:
+        self.tile_visit_accessor = tile_visit_accessor
+        self._footprints: dict[int, tuple[int, ZoomFootprints]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, zoom: int) -> ZoomFootprints:
+        data_version = self.tile_visit_accessor.tile_state["data_version"]
+        with self._lock:
+            cached = self._footprints.get(zoom, None)
+            if cached is None or cached[0] != data_version:
+                self._footprints[zoom] = (data_version, self._build(zoom))
+            return self._footprints[zoom][1]
+
+    def filtered_state(
+        self,
+        zoom: int,
+        activity_ids: Iterable[int],
+        as_of: Optional[datetime.date] = None,
+    ) -> FilteredExplorerState:
+        """
+        Combines the footprints of the given activities and analyzes clusters and the biggest square of the result.
+        """
+        footprints = self.get(zoom)
+        selection = np.isin(
+            footprints.activity_id, np.fromiter(activity_ids, dtype=np.int64)
+        )
+        if as_of is not None:
+            cutoff = pd.Timestamp(as_of + datetime.timedelta(days=1), tz="UTC")
+            selection &= footprints.time < cutoff.value
+        return analyze_tiles(footprints.key[selection], footprints.time[selection])
+
+    def _build(self, zoom: int) -> ZoomFootprints:
+        activity_ids = []
+        keys = []
+        times = []
+        tiles_per_activity = self.tile_visit_accessor.tile_state["tiles_per_activity"]
+        for activity_id, footprint in tiles_per_activity.items():
+            at_zoom = footprint.loc[footprint["zoom"] == zoom]
+            activity_ids.append(np.full(len(at_zoom), activity_id, dtype=np.int64))
+            keys.append(tile_keys(at_zoom["tile_x"], at_zoom["tile_y"]))
+            times.append(at_zoom["time"].array.asi8)
+        if not keys:
+            empty = np.zeros(0, dtype=np.int64)
+            return ZoomFootprints(empty, empty, empty)
+        return ZoomFootprints(
+            np.concatenate(activity_ids), np.concatenate(keys), np.concatenate(times)
+        )
+
+
+def analyze_tiles(keys: np.ndarray, times: np.ndarray) -> FilteredExplorerState:
+    """
+    Explorer analysis of a set of visits, given as tile keys and times in nanoseconds with possible repetitions.
+    """
+    # Sort by tile and then by time, unknown times last.
+    sortable_times = np.where(times == pd.NaT.value, np.iinfo(np.int64).max, times)
+    order = np.lexsort((sortable_times, keys))
+    keys = keys[order]
+    times = times[order]
+    unique_keys, first, num_visits = np.unique(
+        keys, return_index=True, return_counts=True
+    )
+    first_time = times[first]
+    last_time = np.maximum.reduceat(times, first) if len(keys) else times[first]
+
+    is_cluster, cluster_names = find_clusters(unique_keys)
+    tile_x, tile_y = split_tile_keys(unique_keys)
+    tiles = list(zip(tile_x[is_cluster].tolist(), tile_y[is_cluster].tolist()))
+    names = list(zip(tile_x[cluster_names].tolist(), tile_y[cluster_names].tolist()))
+    memberships = dict(zip(tiles, names))
+    clusters: dict[tuple[int, int], list[tuple[int, int]]] = {}
+    for tile, name in zip(tiles, names):
+        clusters.setdefault(name, []).append(tile)
+
+    max_square_size, square_x, square_y = find_max_square(unique_keys)
+    return FilteredExplorerState(
+        keys=unique_keys,
+        first_time=first_time,
+        last_time=last_time,
+        num_visits=num_visits,
+        memberships=memberships,
+        clusters=clusters,
+        max_square_size=max_square_size,
+        square_x=square_x if max_square_size else None,
+        square_y=square_y if max_square_size else None,
+    )
@@ -5,27 +5,31 @@ from typing import Optional
 
 import geojson
 import gpxpy
+import numpy as np
 import pandas as pd
 
 from ..core.coordinates import Bounds
 from ..core.tiles import get_tile_upper_left_lat_lon
+from ..core.tiles import get_tile_upper_left_lat_lon_array
+from .tile_bitmap import TileBitmap
+from .tile_sets import label_components
+from .tile_sets import lookup_tiles
+from .tile_sets import tile_keys
 
 
 logger = logging.getLogger(__name__)
 
 
 def get_border_tiles(
-    tiles: pd.DataFrame, zoom: int, tile_bounds: Bounds
+    visited_tiles: TileBitmap, zoom: int, tile_bounds: Bounds
 ) -> list[list[tuple[float, float]]]:
     logger.info("Generate border tiles …")
-    tile_set = set(zip(tiles["tile_x"], tiles["tile_y"]))
-    border_tiles = set()
-    for tile_x in range(tile_bounds.x_min, tile_bounds.x_max):
-        for tile_y in range(tile_bounds.y_min, tile_bounds.y_max):
-            tile = (tile_x, tile_y)
-            if tile not in tile_set:
-                border_tiles.add(tile)
-    return make_grid_points(border_tiles, zoom)
+    return make_grid_points(
+        visited_tiles.missing(
+            tile_bounds.x_min, tile_bounds.y_min, tile_bounds.x_max, tile_bounds.y_max
+        ),
+        zoom,
+    )
 
 
 def get_explored_tiles(
@@ -82,6 +86,105 @@ def make_grid_points(
     return result
 
 
+# Steps along the tile grid, indexed by direction: right, down, left, up. With the y axis pointing down, turning right means going to the next direction.
+_DIRECTIONS = np.array([(1, 0), (0, 1), (-1, 0), (0, -1)])
+
+
+def get_tile_outlines(tiles: Iterable[tuple[int, int]]) -> list[list[np.ndarray]]:
+    """
+    Merges adjacent tiles into polygons on the integer tile grid.
+
+    Each polygon is a list of closed rings, the outer ring comes first and the holes follow. Rings are arrays of `(x, y)` tile corners which only contain the corners where the outline changes direction. Tiles that only touch diagonally end up in separate polygons.
+    """
+    tile_array = np.array(list(tiles), dtype=np.int64).reshape(-1, 2)
+    keys = np.unique(tile_keys(tile_array[:, 0], tile_array[:, 1]))
+    if len(keys) == 0:
+        return []
+    tile_x = keys >> 32
+    tile_y = keys & 0xFFFFFFFF
+
+    # Walking clockwise around every tile, the edges that are not shared with a neighbor form the outline. Directions are chosen such that the tile lies to the right of its edges.
+    starts = []
+    directions = []
+    cells = []
+    neighbors = []
+    for direction, (dx, dy) in enumerate(_DIRECTIONS):
+        # The neighbor across the edge that goes into `direction`, which is the one to the left.
+        nx, ny = dy, -dx
+        has_neighbor, neighbor = lookup_tiles(keys, tile_x + nx, tile_y + ny)
+        neighbors.append((has_neighbor, neighbor))
+        border = ~has_neighbor
+        # Start corner of the edge relative to the upper left corner of the tile.
+        sx, sy = [(0, 0), (1, 0), (1, 1), (0, 1)][direction]
+        starts.append(
+            np.column_stack([tile_x[border] + sx, tile_y[border] + sy]),
+        )
+        directions.append(np.full(border.sum(), direction))
+        cells.append(np.nonzero(border)[0])
+    start = np.concatenate(starts)
+    direction = np.concatenate(directions)
+    cell = np.concatenate(cells)
+
+    # At corners where two tiles touch diagonally there are two outgoing edges. Turning right keeps the outline with its tile.
+    end = start + _DIRECTIONS[direction]
+    edge_keys = tile_keys(start[:, 0], start[:, 1]) * 4 + direction
+    order = np.argsort(edge_keys)
+    sorted_edge_keys = edge_keys[order]
+    end_keys = tile_keys(end[:, 0], end[:, 1]) * 4
+    wanted = end_keys + (direction + 1) % 4
+    index = np.searchsorted(sorted_edge_keys, wanted)
+    found = sorted_edge_keys[np.minimum(index, len(order) - 1)] == wanted
+    fallback = np.searchsorted(sorted_edge_keys, end_keys)
+    following = order[np.where(found, index, fallback)].tolist()
+
+    labels = label_components(len(keys), neighbors)
+    polygons: dict[int, list[np.ndarray]] = {}
+    visited = bytearray(len(following))
+    for first in range(len(following)):
+        if visited[first]:
+            continue
+        ring = []
+        edge = first
+        while not visited[edge]:
+            visited[edge] = 1
+            ring.append(edge)
+            edge = following[edge]
+        ring = np.array(ring)
+        corners = direction[ring] != np.roll(direction[ring], 1)
+        vertices = start[ring[corners]]
+        vertices = np.concatenate([vertices, vertices[:1]])
+        rings = polygons.setdefault(int(labels[cell[first]]), [])
+        x, y = vertices[:, 0], vertices[:, 1]
+        if np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) > 0:
+            rings.insert(0, vertices)
+        else:
+            rings.append(vertices)
+    return [polygons[label] for label in sorted(polygons)]
+
+
+def make_outline_polygons(
+    tiles: Iterable[tuple[int, int]], zoom: int
+) -> list[list[list[tuple[float, float]]]]:
+    """
+    Merged outlines of the tiles with the rings given as `(lat, lon)` points.
+    """
+    outlines = get_tile_outlines(tiles)
+    rings = [ring for polygon in outlines for ring in polygon]
+    if not rings:
+        return []
+    vertices = np.concatenate(rings)
+    lat, lon = get_tile_upper_left_lat_lon_array(vertices[:, 0], vertices[:, 1], zoom)
+    points = list(zip(lat.tolist(), lon.tolist()))
+    result = []
+    offset = 0
+    for polygon in outlines:
+        result.append([])
+        for ring in polygon:
+            result[-1].append(points[offset : offset + len(ring)])
+            offset += len(ring)
+    return result
+
+
 def make_grid_file_gpx(grid_points: list[list[tuple[float, float]]]) -> str:
     gpx = gpxpy.gpx.GPX()
     gpx_track = gpxpy.gpx.GPXTrack()
@@ -106,3 +209,31 @@ def make_grid_file_geojson(grid_points: list[list[tuple[float, float]]]) -> str:
     )
     result = geojson.dumps(fc, sort_keys=True, indent=4, ensure_ascii=False)
     return result
+
+
+def make_outline_feature_collection(
+    polygons: list[list[list[tuple[float, float]]]],
+) -> geojson.FeatureCollection:
+    return geojson.FeatureCollection(
+        [
+            geojson.Feature(
+                geometry=geojson.Polygon(
+                    [[[lon, lat] for lat, lon in ring] for ring in polygon]
+                )
+            )
+            for polygon in polygons
+        ]
+    )
+
+
+def make_outline_file_geojson(polygons: list[list[list[tuple[float, float]]]]) -> str:
+    return geojson.dumps(
+        make_outline_feature_collection(polygons),
+        sort_keys=True,
+        indent=4,
+        ensure_ascii=False,
+    )
+
+
+def make_outline_file_gpx(polygons: list[list[list[tuple[float, float]]]]) -> str:
+    return make_grid_file_gpx([ring for polygon in polygons for ring in polygon])
@@ -0,0 +1,105 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..core.tiles import adjacent_to
+from .tile_visits import _compute_cluster_evolution
+from .tile_visits import TileEvolutionState
+
+
+def reference_cluster_evolution(tiles: pd.DataFrame) -> tuple[dict, dict, list]:
+    """
+    The former list-based implementation that the union-find has to reproduce.
+    """
+    num_neighbors = {}
+    memberships = {}
+    clusters = {}
+    max_cluster_so_far = 0
+    rows = []
+    for time, tile in zip(tiles["time"], zip(tiles["tile_x"], tiles["tile_y"])):
+        new_clusters = False
+        num_neighbors[tile] = 0
+        for other in adjacent_to(tile):
+            if other in num_neighbors:
+                num_neighbors[tile] += 1
+                num_neighbors[other] += 1
+        this_and_neighbors = [tile] + list(adjacent_to(tile))
+        for other in this_and_neighbors:
+            if num_neighbors.get(other, 0) == 4:
+                clusters[other] = [other]
+                memberships[other] = other
+        for candidate in this_and_neighbors:
+            if candidate not in memberships:
+                continue
+            for other in adjacent_to(candidate):
+                if other not in memberships:
+                    continue
+                if memberships[candidate] == memberships[other]:
+                    continue
+                other_cluster_name = memberships[other]
+                other_cluster = clusters[other_cluster_name]
+                clusters[memberships[candidate]].extend(other_cluster)
+                for member in other_cluster:
+                    memberships[member] = memberships[candidate]
+                del clusters[other_cluster_name]
+                new_clusters = True
+        if new_clusters:
+            max_cluster_size = max(map(len, clusters.values()), default=0)
+            if max_cluster_size > max_cluster_so_far:
+                rows.append((time, max_cluster_size))
+                max_cluster_so_far = max_cluster_size
+    return memberships, clusters, rows
+
+
+def make_random_history(size: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    xs, ys = np.meshgrid(np.arange(size), np.arange(size))
+    order = rng.permutation(size * size)
+    return pd.DataFrame(
+        {
+            "time": pd.date_range(
+                "2020-01-01", periods=size * size, freq="1h", tz="UTC"
+            ),
+            "tile_x": xs.flatten()[order] + 8000,
+            "tile_y": ys.flatten()[order] + 5000,
+        }
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_matches_reference(seed: int) -> None:
+    tiles = make_random_history(30, seed)
+    memberships, clusters, rows = reference_cluster_evolution(tiles)
+
+    s = TileEvolutionState()
+    # Feed the history in chunks to also cover the incremental path.
+    for end in [100, 450, len(tiles)]:
+        _compute_cluster_evolution(tiles.iloc[:end], s, 17)
+
+    assert s.memberships == memberships
+    assert list(s.clusters) == list(clusters)
+    assert {name: sorted(members) for name, members in s.clusters.items()} == {
+        name: sorted(members) for name, members in clusters.items()
+    }
+    assert (
+        list(zip(s.cluster_evolution["time"], s.cluster_evolution["max_cluster_size"]))
+        == rows
+    )
+    assert s.tile_clusters.max_cluster_size == max(map(len, clusters.values()))
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks."
+)
+def test_benchmark_cluster_evolution() -> None:
+    tiles = make_random_history(710, 0)
+    assert len(tiles) > 500_000
+    s = TileEvolutionState()
+    start = time.perf_counter()
+    _compute_cluster_evolution(tiles, s, 17)
+    duration = time.perf_counter() - start
+    print(f"Cluster evolution for {len(tiles)} tiles took {duration:.1f} s.")
+    assert s.tile_clusters.max_cluster_size == 708**2
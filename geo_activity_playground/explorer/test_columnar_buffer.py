@@ -0,0 +1,56 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from .columnar_buffer import ColumnarBuffer
+from .columnar_buffer import UTC_TIME
+
+
+def make_buffer() -> ColumnarBuffer:
+    return ColumnarBuffer({"time": UTC_TIME, "value": "int64"})
+
+
+def test_append_grows() -> None:
+    buffer = make_buffer()
+    times = pd.date_range("2024-01-01", periods=1000, freq="1min", tz="UTC")
+    for start in range(0, 1000, 7):
+        buffer.append(
+            {
+                "time": times[start : start + 7],
+                "value": np.arange(start, min(start + 7, 1000)),
+            }
+        )
+    assert len(buffer) == 1000
+    assert list(buffer.frame["value"]) == list(range(1000))
+    assert list(buffer.frame["time"]) == list(times)
+
+
+def test_records_and_naive_times() -> None:
+    buffer = make_buffer()
+    buffer.append([{"time": pd.Timestamp("2024-01-01 12:00"), "value": 1}])
+    buffer.append([])
+    assert buffer.frame["time"].iloc[0] == pd.Timestamp("2024-01-01 12:00", tz="UTC")
+    assert len(buffer) == 1
+
+
+def test_frame_is_not_changed_by_later_modifications() -> None:
+    buffer = make_buffer()
+    buffer.append({"time": [pd.Timestamp("2024-01-01", tz="UTC")], "value": [1]})
+    frame = buffer.frame
+    buffer.append({"time": [pd.Timestamp("2024-01-02", tz="UTC")], "value": [2]})
+    buffer.replace({"time": [pd.Timestamp("2024-01-03", tz="UTC")], "value": [3]})
+    assert list(frame["value"]) == [1]
+    assert list(buffer.frame["value"]) == [3]
+
+
+def test_pickle() -> None:
+    buffer = make_buffer()
+    buffer.append(
+        {"time": [pd.NaT, pd.Timestamp("2024-01-01", tz="UTC")], "value": [1, 2]}
+    )
+    restored = pickle.loads(pickle.dumps(buffer))
+    assert len(restored) == 2
+    assert pd.isna(restored.frame["time"].iloc[0])
+    restored.append({"time": [pd.Timestamp("2024-01-02", tz="UTC")], "value": [3]})
+    assert list(restored.frame["value"]) == [1, 2, 3]
@@ -0,0 +1,82 @@
+import os
+import time
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..core.config import Config
+from .footprints import analyze_tiles
+from .footprints import FootprintIndex
+from .test_tile_visits import compute_from_scratch
+from .test_tile_visits import repository  # noqa: F401
+from .tile_sets import split_tile_keys
+from .tile_sets import tile_keys
+
+
+def test_filtered_state_of_all_activities(repository, tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    # Activity 3 is not considered for achievements, the others make up the explorer state.
+    tile_visit_accessor = compute_from_scratch(
+        repository, Config(explorer_zoom_levels=[19])
+    )
+    tile_state = tile_visit_accessor.tile_state
+    index = FootprintIndex(tile_visit_accessor)
+
+    state = index.filtered_state(19, [1, 2, 4])
+    tile_x, tile_y = split_tile_keys(state.keys)
+    tile_visits = tile_state["tile_visits"][19]
+    assert set(zip(tile_x.tolist(), tile_y.tolist())) == set(tile_visits)
+    evolution_state = tile_state["evolution_state"][19]
+    assert set(state.memberships) == set(evolution_state.memberships)
+    assert state.max_square_size == evolution_state.max_square_size
+    tile = (102, 202)
+    position = int(np.searchsorted(state.keys, tile_keys(*tile)))
+    assert state.num_visits[position] == len(tile_visits[tile]["activity_ids"])
+    assert state.first_time[position] == tile_visits[tile]["first_time"].value
+    assert state.last_time[position] == tile_visits[tile]["last_time"].value
+
+    state = index.filtered_state(19, [3])
+    assert len(state.keys) == 10
+    assert state.memberships == {}
+    assert state.max_square_size == 1
+
+
+def test_analyze_tiles_without_visits() -> None:
+    state = analyze_tiles(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    assert len(state.keys) == 0
+    assert state.square_x is None
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks."
+)
+def test_benchmark_filtered_state() -> None:
+    rng = np.random.default_rng(0)
+    tiles_per_activity = {}
+    for activity_id in range(2000):
+        steps = rng.integers(-1, 2, (200, 2))
+        tiles = np.unique(
+            np.cumsum(steps, axis=0) + rng.integers(8000, 8200, 2), axis=0
+        )
+        tiles_per_activity[activity_id] = pd.DataFrame(
+            {
+                "zoom": 14,
+                "tile_x": tiles[:, 0],
+                "tile_y": tiles[:, 1],
+                "time": pd.Timestamp("2024-01-01", tz="UTC"),
+            }
+        )
+    accessor = types.SimpleNamespace(
+        tile_state={"data_version": 0, "tiles_per_activity": tiles_per_activity}
+    )
+    index = FootprintIndex(accessor)
+    index.get(14)
+    start = time.perf_counter()
+    state = index.filtered_state(14, range(0, 2000, 2))
+    duration = time.perf_counter() - start
+    print(
+        f"Filtered state with {len(state.keys)} tiles and a square of {state.max_square_size} took {duration:.3f} s."
+    )
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from ..core.tiles import get_tile_upper_left_lat_lon
+from .grid_file import get_tile_outlines
+from .grid_file import make_outline_feature_collection
+from .grid_file import make_outline_polygons
+
+
+def _signed_area(ring: np.ndarray) -> float:
+    x, y = ring[:, 0], ring[:, 1]
+    return np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) / 2
+
+
+def test_single_tile() -> None:
+    (polygon,) = get_tile_outlines([(3, 4)])
+    (ring,) = polygon
+    assert ring.tolist() == [[3, 4], [4, 4], [4, 5], [3, 5], [3, 4]]
+
+
+def test_block_with_hole() -> None:
+    tiles = [(x, y) for x in range(3) for y in range(3) if (x, y) != (1, 1)]
+    (polygon,) = get_tile_outlines(tiles)
+    outer, hole = polygon
+    assert len(outer) == 5
+    assert _signed_area(outer) == 9
+    assert _signed_area(hole) == -1
+
+
+def test_diagonal_tiles_are_separate() -> None:
+    outlines = get_tile_outlines([(0, 0), (1, 1), (0, 2), (1, 2)])
+    assert [len(polygon) for polygon in outlines] == [1, 1]
+    assert sorted(_signed_area(polygon[0]) for polygon in outlines) == [1, 3]
+
+
+def test_random_tiles() -> None:
+    rng = np.random.default_rng(0)
+    tiles = {
+        (int(x), int(y))
+        for x, y in zip(rng.integers(0, 30, 500), rng.integers(0, 30, 500))
+    }
+    outlines = get_tile_outlines(tiles)
+    assert sum(_signed_area(ring) for polygon in outlines for ring in polygon) == len(
+        tiles
+    )
+    for polygon in outlines:
+        assert _signed_area(polygon[0]) > 0
+        assert all(_signed_area(hole) < 0 for hole in polygon[1:])
+        for ring in polygon:
+            assert ring[0].tolist() == ring[-1].tolist()
+            # Only corners are kept, so consecutive steps always change direction.
+            steps = np.diff(ring, axis=0)
+            assert np.all(np.sum(np.abs(steps[1:] * steps[:-1]), axis=1) == 0)
+
+
+def test_outline_polygons_in_lat_lon() -> None:
+    polygons = make_outline_polygons([(8000, 5000), (8001, 5000)], 14)
+    (ring,) = polygons[0]
+    assert ring[0] == pytest.approx(get_tile_upper_left_lat_lon(8000, 5000, 14))
+    assert ring[1] == pytest.approx(get_tile_upper_left_lat_lon(8002, 5000, 14))
+    feature_collection = make_outline_feature_collection(polygons)
+    coordinates = feature_collection["features"][0]["geometry"]["coordinates"]
+    assert coordinates[0][0] == pytest.approx([ring[0][1], ring[0][0]])
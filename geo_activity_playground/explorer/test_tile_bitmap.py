@@ -0,0 +1,24 @@
+import numpy as np
+
+from .tile_bitmap import TileBitmap
+
+
+def test_missing() -> None:
+    visited = {(0, 0), (1, 1), (63, 64), (64, 64), (-1, 2)}
+    bitmap = TileBitmap()
+    for tile in visited:
+        bitmap.add(tile)
+    expected = [
+        (x, y) for x in range(-2, 70) for y in range(-1, 66) if (x, y) not in visited
+    ]
+    assert bitmap.missing(-2, -1, 70, 66) == expected
+    assert bitmap.missing(5, 5, 5, 10) == []
+
+
+def test_from_tiles() -> None:
+    tiles = [(0, 0), (1, 1), (63, 64), (64, 64), (-1, 2), (1, 1)]
+    bitmap = TileBitmap.from_tiles(
+        np.array([tile[0] for tile in tiles]), np.array([tile[1] for tile in tiles])
+    )
+    assert len(bitmap) == 5
+    assert sorted(bitmap) == sorted(set(tiles))
@@ -0,0 +1,198 @@
+import os
+import types
+
+import matplotlib
+import numpy as np
+import pandas as pd
+import pytest
+
+from .tile_rendering import _cluster_hue
+from .tile_rendering import changed_tiles
+from .tile_rendering import ColorfulClusterColorStrategy
+from .tile_rendering import ExplorerTileRenderer
+from .tile_rendering import ExplorerTileTable
+from .tile_rendering import MissingColorStrategy
+from .tile_rendering import render_explorer_tile
+from .tile_rendering import SQUARE_COLOR
+from .tile_rendering import square_outline_tiles
+from .tile_rendering import UNVISITED_COLOR
+from .tile_visits import _compute_cluster_evolution
+from .tile_visits import _compute_square_history
+from .tile_visits import make_tile_state
+from .tile_visits import TileEvolutionState
+
+ZOOM = 14
+
+
+@pytest.fixture
+def tile_state() -> dict:
+    """
+    A 5×5 block of visited tiles with its upper left corner at (16, 8) and a lone tile at (30, 30).
+    """
+    tiles = [(16 + dx, 8 + dy) for dx in range(5) for dy in range(5)] + [(30, 30)]
+    history = pd.DataFrame(
+        {
+            "time": pd.date_range(
+                "2024-01-01", periods=len(tiles), freq="1h", tz="UTC"
+            ),
+            "tile_x": [tile[0] for tile in tiles],
+            "tile_y": [tile[1] for tile in tiles],
+        }
+    )
+    tile_state = make_tile_state()
+    for time, tile in zip(history["time"], tiles):
+        tile_state["tile_visits"][ZOOM][tile] = {
+            "activity_ids": {1},
+            "first_id": 1,
+            "first_time": time,
+            "last_id": 1,
+            "last_time": time,
+        }
+    evolution_state = TileEvolutionState()
+    _compute_cluster_evolution(history, evolution_state, ZOOM)
+    _compute_square_history(history, evolution_state, ZOOM)
+    tile_state["evolution_state"][ZOOM] = evolution_state
+    return tile_state
+
+
+def test_lookup(tile_state) -> None:
+    table = ExplorerTileTable(
+        tile_state["tile_visits"][ZOOM], tile_state["evolution_state"][ZOOM]
+    )
+    visited, _ = table.lookup(np.array([16, 15, 30, 31]), np.array([8, 8, 30, 30]))
+    assert list(visited) == [True, False, True, False]
+
+
+def test_zoomed_out_tile(tile_state) -> None:
+    table = ExplorerTileTable(
+        tile_state["tile_visits"][ZOOM], tile_state["evolution_state"][ZOOM]
+    )
+    evolution_state = tile_state["evolution_state"][ZOOM]
+    # At zoom 9 the map tile (0, 0) contains 32×32 explorer tiles with 8 pixels each.
+    image = render_explorer_tile(
+        table, evolution_state, ColorfulClusterColorStrategy(), ZOOM, 9, 0, 0
+    )
+    assert image.shape == (256, 256, 4)
+
+    # Interior of a cluster tile.
+    hue = _cluster_hue(evolution_state.memberships[(18, 10)])
+    np.testing.assert_allclose(
+        image[10 * 8 + 4, 18 * 8 + 4],
+        matplotlib.colormaps["hsv"](hue)[:3] + (0.5,),
+    )
+    # Visited tile outside of clusters.
+    np.testing.assert_allclose(image[30 * 8 + 4, 30 * 8 + 4], UNVISITED_COLOR)
+    # Not visited.
+    np.testing.assert_allclose(image[0, 0], 0)
+    # The square outline, left edge and bottom edge.
+    np.testing.assert_allclose(image[10 * 8 + 4, 16 * 8], SQUARE_COLOR)
+    np.testing.assert_allclose(image[13 * 8 - 1, 18 * 8 + 4], SQUARE_COLOR)
+    np.testing.assert_allclose(image[12 * 8 + 2, 18 * 8 + 4], UNVISITED_COLOR)
+
+
+def test_zoomed_in_tile(tile_state) -> None:
+    table = ExplorerTileTable(
+        tile_state["tile_visits"][ZOOM], tile_state["evolution_state"][ZOOM]
+    )
+    evolution_state = tile_state["evolution_state"][ZOOM]
+    image = render_explorer_tile(
+        table, evolution_state, MissingColorStrategy(), ZOOM, 15, 2 * 15, 2 * 8
+    )
+    np.testing.assert_allclose(image[100, 100], UNVISITED_COLOR)
+    np.testing.assert_allclose(image[0, 100], 0.5)
+
+    image = render_explorer_tile(
+        table, evolution_state, MissingColorStrategy(), ZOOM, 15, 2 * 16, 2 * 8
+    )
+    np.testing.assert_allclose(image[100, 100], 0)
+    np.testing.assert_allclose(image[100, 0], SQUARE_COLOR)
+    np.testing.assert_allclose(image[0, 100], SQUARE_COLOR)
+
+
+def test_disk_cache(tile_state, tmp_path) -> None:
+    accessor = types.SimpleNamespace(tile_state=tile_state)
+    renderer = ExplorerTileRenderer(accessor, tmp_path)
+    path = renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 0, 0)
+    assert path.read_bytes().startswith(b"\x89PNG")
+    other_path = renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 1, 0)
+    zoomed_in_path = renderer.get_tile_path(ZOOM, "colorful_cluster", 15, 32, 16)
+    assert renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 0, 0) == path
+
+    # Invalidation only removes the files that show the changed tiles.
+    tile_state["data_version"] += 1
+    renderer.invalidate(ZOOM, {(16, 8)})
+    assert not path.exists()
+    assert not zoomed_in_path.exists()
+    assert other_path.exists()
+    renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 1, 0)
+    assert other_path.exists()
+
+    # Without invalidation, a new data version drops everything.
+    tile_state["data_version"] += 1
+    renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 0, 0)
+    assert not other_path.exists()
+
+    with pytest.raises(ValueError):
+        renderer.get_tile_path(ZOOM, "unknown", 9, 0, 0)
+
+
+def test_pending_invalidation_keeps_tiles(tile_state, tmp_path) -> None:
+    accessor = types.SimpleNamespace(tile_state=tile_state)
+    renderer = ExplorerTileRenderer(accessor, tmp_path)
+    path = renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 0, 0)
+    other_path = renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 1, 0)
+
+    renderer.expect_invalidation(ZOOM)
+    tile_state["data_version"] += 1
+    renderer.get_tile_path(ZOOM, "colorful_cluster", 9, 0, 0)
+    assert other_path.exists()
+    renderer.invalidate(ZOOM, {(16, 8)})
+    renderer.end_invalidation(ZOOM)
+    assert not path.exists()
+    assert other_path.exists()
+
+
+def test_as_of_dirs_are_capped(tile_state, tmp_path) -> None:
+    accessor = types.SimpleNamespace(tile_state=tile_state)
+    renderer = ExplorerTileRenderer(accessor, tmp_path)
+    renderer.MAX_AS_OF_DIRS = 2
+    as_of_dir = tmp_path / str(ZOOM) / "as-of"
+    for i, day in enumerate(["2024-01-01", "2024-01-02", "2024-01-01"]):
+        renderer._use_as_of_dir(as_of_dir / day)
+        os.utime(as_of_dir / day, (i, i))
+    renderer._use_as_of_dir(as_of_dir / "2024-01-03")
+    assert sorted(path.name for path in as_of_dir.iterdir()) == [
+        "2024-01-01",
+        "2024-01-03",
+    ]
+
+
+def test_changed_tiles(tile_state) -> None:
+    zoom_state = tile_state["evolution_state"][ZOOM]
+    old = ExplorerTileTable(tile_state["tile_visits"][ZOOM], zoom_state)
+    tile_state["tile_visits"][ZOOM][(40, 40)] = {
+        "activity_ids": {2},
+        "first_id": 2,
+        "first_time": pd.Timestamp("2024-02-01", tz="UTC"),
+        "last_id": 2,
+        "last_time": pd.Timestamp("2024-02-01", tz="UTC"),
+    }
+    tile_state["tile_visits"][ZOOM][(16, 8)]["activity_ids"].add(2)
+    del tile_state["tile_visits"][ZOOM][(30, 30)]
+    new = ExplorerTileTable(tile_state["tile_visits"][ZOOM], zoom_state)
+    assert changed_tiles(old, new) == {(40, 40), (16, 8), (30, 30)}
+    assert changed_tiles(new, new) == set()
+
+
+def test_square_outline_tiles() -> None:
+    assert square_outline_tiles(None, None, 0) == set()
+    assert square_outline_tiles(1, 2, 3) == {
+        (1, 2),
+        (2, 2),
+        (3, 2),
+        (1, 3),
+        (3, 3),
+        (1, 4),
+        (2, 4),
+        (3, 4),
+    }
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from .clusters import TileClusters
+from .test_tile_visits import make_growing_history
+from .tile_sets import find_clusters
+from .tile_sets import find_max_square
+from .tile_sets import split_tile_keys
+from .tile_sets import tile_keys
+from .tile_visits import _compute_square_history
+from .tile_visits import TileEvolutionState
+
+
+def random_keys(seed: int, size: int = 40, num_tiles: int = 1000) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return np.unique(
+        tile_keys(rng.integers(0, size, num_tiles), rng.integers(0, size, num_tiles))
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_find_clusters_matches_incremental(seed: int) -> None:
+    keys = random_keys(seed)
+    tile_x, tile_y = split_tile_keys(keys)
+    tile_clusters = TileClusters()
+    for tile in zip(tile_x.tolist(), tile_y.tolist()):
+        tile_clusters.add_tile(tile)
+
+    is_cluster, names = find_clusters(keys)
+    tiles = list(zip(tile_x[is_cluster].tolist(), tile_y[is_cluster].tolist()))
+    assert set(tiles) == set(tile_clusters.memberships)
+    groups: dict[int, set] = {}
+    for tile, name in zip(tiles, names.tolist()):
+        groups.setdefault(name, set()).add(tile)
+    assert sorted(map(sorted, groups.values())) == sorted(
+        map(sorted, tile_clusters.clusters.values())
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_find_max_square_matches_incremental(seed: int) -> None:
+    tiles = make_growing_history(30, seed).iloc[:600]
+    s = TileEvolutionState()
+    _compute_square_history(tiles, s, 17)
+
+    keys = np.unique(tile_keys(tiles["tile_x"], tiles["tile_y"]))
+    size, square_x, square_y = find_max_square(keys)
+    assert size == s.max_square_size
+    tile_set = set(zip(tiles["tile_x"], tiles["tile_y"]))
+    assert all(
+        (square_x + dx, square_y + dy) in tile_set
+        for dx in range(size)
+        for dy in range(size)
+    )
+
+
+def test_find_max_square_edge_cases() -> None:
+    assert find_max_square(np.array([], dtype=np.int64)) == (0, 0, 0)
+    assert find_max_square(tile_keys([5], [7])) == (1, 5, 7)
+    # A long row and column only contain squares of size 1.
+    line = pd.DataFrame(
+        {"x": list(range(10)) + [0] * 9, "y": [0] * 10 + list(range(1, 10))}
+    )
+    keys = np.unique(tile_keys(line["x"], line["y"]))
+    assert find_max_square(keys)[0] == 1
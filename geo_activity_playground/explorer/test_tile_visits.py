@@ -0,0 +1,481 @@
+import datetime
+import itertools
+import os
+import time
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from . import tile_visits
+from ..core.config import Config
+from ..core.data_version import DATA_VERSION
+from ..core.tiles import interpolate_missing_tile
+from .tile_visits import _compute_cluster_evolution
+from .tile_visits import _compute_square_history
+from .tile_visits import _process_activity
+from .tile_visits import _tiles_from_points
+from .tile_visits import compute_tile_evolution
+from .tile_visits import compute_tile_visits_new
+from .tile_visits import get_evolution_state_as_of
+from .tile_visits import get_tile_visits_as_of
+from .tile_visits import get_visited_tiles
+from .tile_visits import make_tile_state
+from .tile_visits import replay_tile_evolution
+from .tile_visits import TileEvolutionState
+from .tile_visits import TileVisitAccessor
+
+
+def make_time_series(
+    start: datetime.datetime, tiles: list[tuple[float, float]]
+) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "time": pd.date_range(start, periods=len(tiles), freq="1min", tz="UTC"),
+            "x": [(tile_x + 0.5) / 2**19 for tile_x, tile_y in tiles],
+            "y": [(tile_y + 0.5) / 2**19 for tile_x, tile_y in tiles],
+            "segment_id": 0,
+        }
+    )
+
+
+class FakeRepository:
+    def __init__(self) -> None:
+        self.activities: dict[int, tuple[bool, pd.DataFrame]] = {}
+
+    def get_activity_ids(self) -> list[int]:
+        return sorted(
+            self.activities,
+            key=lambda activity_id: self.activities[activity_id][1]["time"].iloc[0],
+        )
+
+    def get_activity_by_id(self, activity_id: int) -> types.SimpleNamespace:
+        consider_for_achievements, _ = self.activities[activity_id]
+        return types.SimpleNamespace(
+            kind=types.SimpleNamespace(
+                consider_for_achievements=consider_for_achievements
+            )
+        )
+
+    def get_time_series(self, activity_id: int) -> pd.DataFrame:
+        return self.activities[activity_id][1]
+
+
+@pytest.fixture
+def repository() -> FakeRepository:
+    repository = FakeRepository()
+    repository.activities[1] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 1),
+            [(x, y) for x in range(100, 104) for y in range(200, 204)],
+        ),
+    )
+    repository.activities[2] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 2),
+            [(x, 202) for x in range(102, 110)] + [(109, y) for y in range(202, 206)],
+        ),
+    )
+    repository.activities[3] = (
+        False,
+        make_time_series(
+            datetime.datetime(2024, 1, 3), [(x, 204) for x in range(96, 106)]
+        ),
+    )
+    repository.activities[4] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 4),
+            [(x, 203) for x in range(98, 112)] + [(x, 201) for x in range(98, 112)],
+        ),
+    )
+    return repository
+
+
+def compute_from_scratch(
+    repository: FakeRepository, config: Config
+) -> TileVisitAccessor:
+    tile_visit_accessor = TileVisitAccessor()
+    tile_visit_accessor.reset()
+    compute_tile_visits_new(repository, tile_visit_accessor)
+    compute_tile_evolution(tile_visit_accessor.tile_state, config)
+    return tile_visit_accessor
+
+
+def assert_same_tile_state(
+    actual: TileVisitAccessor, expected: TileVisitAccessor
+) -> None:
+    for zoom in range(20):
+        assert dict(actual.tile_state["tile_visits"][zoom]) == dict(
+            expected.tile_state["tile_visits"][zoom]
+        )
+        assert dict(actual.tile_state["activities_per_tile"][zoom]) == dict(
+            expected.tile_state["activities_per_tile"][zoom]
+        )
+        actual_history = actual.tile_state["tile_history"][zoom].frame
+        expected_history = expected.tile_state["tile_history"][zoom].frame
+        assert list(actual_history["activity_id"]) == list(
+            expected_history["activity_id"]
+        )
+        assert list(actual_history["time"]) == list(expected_history["time"])
+    assert set(actual.tile_state["tiles_per_activity"]) == set(
+        expected.tile_state["tiles_per_activity"]
+    )
+
+
+@pytest.mark.parametrize("deleted_id", [1, 2, 3, 4])
+def test_delete_activity(
+    repository: FakeRepository, deleted_id: int, tmp_path, monkeypatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config = Config(explorer_zoom_levels=[17, 19])
+
+    incremental = compute_from_scratch(repository, config)
+    assert incremental.get_activity_revision(deleted_id) > 0
+    data_version = incremental.tile_state["data_version"]
+    compute_tile_visits_new(repository, incremental)
+    compute_tile_evolution(incremental.tile_state, config)
+    assert incremental.tile_state["data_version"] == data_version
+    del repository.activities[deleted_id]
+    compute_tile_visits_new(repository, incremental)
+    compute_tile_evolution(incremental.tile_state, config)
+    assert incremental.get_activity_revision(deleted_id) == 0
+    assert incremental.tile_state["data_version"] > data_version
+
+    expected = compute_from_scratch(repository, config)
+    assert_same_tile_state(incremental, expected)
+    for zoom in config.explorer_zoom_levels:
+        actual_evolution = incremental.tile_state["evolution_state"][zoom]
+        expected_evolution = expected.tile_state["evolution_state"][zoom]
+        assert actual_evolution.max_square_size == expected_evolution.max_square_size
+        assert actual_evolution.memberships == expected_evolution.memberships
+        np.testing.assert_array_equal(
+            actual_evolution.cluster_evolution.to_numpy(),
+            expected_evolution.cluster_evolution.to_numpy(),
+        )
+
+
+def test_save_only_when_changed(
+    repository: FakeRepository, tmp_path, monkeypatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config = Config(explorer_zoom_levels=[17])
+    compute_from_scratch(repository, config).save()
+    version, _ = DATA_VERSION.get()
+
+    # A restart and a scan without new activities don't change anything.
+    restarted = TileVisitAccessor()
+    compute_tile_visits_new(repository, restarted)
+    compute_tile_evolution(restarted.tile_state, config)
+    restarted.save()
+    assert DATA_VERSION.get()[0] == version
+
+    del repository.activities[1]
+    compute_tile_visits_new(repository, restarted)
+    assert DATA_VERSION.get()[0] == version + 1
+
+
+def reference_square_history(tiles: pd.DataFrame) -> list[tuple]:
+    """
+    The former brute force implementation that the incremental one has to reproduce.
+    """
+    visited_tiles = set()
+    max_square_size = 0
+    rows = []
+    for time, x, y in zip(tiles["time"], tiles["tile_x"], tiles["tile_y"]):
+        visited_tiles.add((x, y))
+        for square_size in itertools.count(max_square_size + 1):
+            found = None
+            for x_offset in range(square_size):
+                for y_offset in range(square_size):
+                    if all(
+                        (x + xx - x_offset, y + yy - y_offset) in visited_tiles
+                        for xx in range(square_size)
+                        for yy in range(square_size)
+                    ):
+                        found = (x - x_offset, y - y_offset)
+                        break
+                if found:
+                    break
+            if not found:
+                break
+            max_square_size = square_size
+            rows.append((time, square_size, *found))
+    return rows
+
+
+def make_growing_history(size: int, seed: int) -> pd.DataFrame:
+    """
+    Visits tiles of a square area in random order with a bias towards the center, such that squares grow over time.
+    """
+    rng = np.random.default_rng(seed)
+    xs, ys = np.meshgrid(np.arange(size), np.arange(size))
+    distance = np.hypot(xs - size / 2, ys - size / 2).flatten()
+    order = np.argsort(distance + rng.uniform(0, size / 3, distance.shape))
+    return pd.DataFrame(
+        {
+            "time": pd.date_range(
+                "2020-01-01", periods=size * size, freq="1h", tz="UTC"
+            ),
+            "tile_x": xs.flatten()[order] + 8000,
+            "tile_y": ys.flatten()[order] + 5000,
+        }
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_square_history_matches_reference(seed: int) -> None:
+    tiles = make_growing_history(24, seed)
+    rows = reference_square_history(tiles)
+
+    s = TileEvolutionState()
+    for end in [50, 300, len(tiles)]:
+        _compute_square_history(tiles.iloc[:end], s, 17)
+
+    assert (
+        list(
+            zip(
+                s.square_evolution["time"],
+                s.square_evolution["max_square_size"],
+                s.square_evolution["square_x"],
+                s.square_evolution["square_y"],
+            )
+        )
+        == rows
+    )
+    assert (s.max_square_size, s.square_x, s.square_y) == rows[-1][1:]
+
+
+def test_evolution_state_as_of(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(tile_visits, "EVOLUTION_CHECKPOINT_INTERVAL", 100)
+    monkeypatch.setattr(tile_visits, "EVOLUTION_CHECKPOINT_DIR", tmp_path)
+    config = Config(explorer_zoom_levels=[17])
+    tiles = make_growing_history(24, 0)
+    tiles["activity_id"] = 1
+    tile_state = make_tile_state()
+    tile_state["tile_history"][17].append(tiles.iloc[:250])
+    compute_tile_evolution(tile_state, config)
+    tile_state["tile_history"][17].append(tiles.iloc[250:])
+    compute_tile_evolution(tile_state, config)
+    assert sorted(path.name for path in (tmp_path / "17").iterdir()) == [
+        "100.pickle",
+        "200.pickle",
+        "300.pickle",
+        "400.pickle",
+        "500.pickle",
+    ]
+
+    # Ten days with one tile per hour.
+    evolution_state, history = get_evolution_state_as_of(
+        tile_state, 17, datetime.date(2020, 1, 10)
+    )
+    assert len(history) == 240
+    expected = TileEvolutionState()
+    _compute_cluster_evolution(tiles.iloc[:240], expected, 17)
+    _compute_square_history(tiles.iloc[:240], expected, 17)
+    assert evolution_state.memberships == expected.memberships
+    assert (
+        evolution_state.max_square_size,
+        evolution_state.square_x,
+        evolution_state.square_y,
+    ) == (expected.max_square_size, expected.square_x, expected.square_y)
+    assert len(evolution_state.square_evolution) == len(expected.square_evolution)
+    # Restoring must not modify the checkpoint.
+    again, _ = get_evolution_state_as_of(tile_state, 17, datetime.date(2020, 1, 10))
+    assert again.memberships == expected.memberships
+
+    evolution_state, history = get_evolution_state_as_of(
+        tile_state, 17, datetime.date(2030, 1, 1)
+    )
+    assert evolution_state is tile_state["evolution_state"][17]
+    assert len(history) == len(tiles)
+
+
+def test_replay_resumes_from_checkpoint(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(tile_visits, "EVOLUTION_CHECKPOINT_INTERVAL", 100)
+    monkeypatch.setattr(tile_visits, "EVOLUTION_CHECKPOINT_DIR", tmp_path)
+    tiles = make_growing_history(24, 1).iloc[:500]
+    # An interrupted replay has only written the first checkpoints.
+    replay_tile_evolution(tiles.iloc[:250], TileEvolutionState(), 17)
+
+    progress = []
+    evolution_state = replay_tile_evolution(
+        tiles,
+        TileEvolutionState(),
+        17,
+        progress=lambda done, total: progress.append((done, total)),
+    )
+    assert progress == [(300, 500), (400, 500), (500, 500)]
+    expected = TileEvolutionState()
+    _compute_cluster_evolution(tiles, expected, 17)
+    _compute_square_history(tiles, expected, 17)
+    assert evolution_state.memberships == expected.memberships
+    assert evolution_state.max_square_size == expected.max_square_size
+    assert len(evolution_state.cluster_evolution) == len(expected.cluster_evolution)
+
+    # A changed history invalidates the checkpoints after the change.
+    changed = tiles.drop(index=tiles.index[150]).reset_index(drop=True)
+    progress.clear()
+    replay_tile_evolution(
+        changed,
+        TileEvolutionState(),
+        17,
+        progress=lambda done, total: progress.append((done, total)),
+    )
+    assert progress[0] == (200, 499)
+    assert sorted(path.name for path in (tmp_path / "17").iterdir()) == [
+        "100.pickle",
+        "200.pickle",
+        "300.pickle",
+        "400.pickle",
+    ]
+
+
+def test_checkpoints_are_thinned_out(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(tile_visits, "EVOLUTION_CHECKPOINT_INTERVAL", 100)
+    monkeypatch.setattr(tile_visits, "EVOLUTION_CHECKPOINT_DIR", tmp_path)
+    tiles = make_growing_history(40, 2)
+    evolution_state = replay_tile_evolution(tiles, TileEvolutionState(), 17)
+    assert sorted(int(path.stem) for path in (tmp_path / "17").iterdir()) == [
+        100,
+        200,
+        400,
+        800,
+        1300,
+        1400,
+        1500,
+        1600,
+    ]
+
+    tile_state = make_tile_state()
+    tile_state["tile_history"][17].append(tiles.assign(activity_id=1))
+    tile_state["evolution_state"][17] = evolution_state
+    restored, history = get_evolution_state_as_of(
+        tile_state, 17, tiles["time"].iloc[1199].date()
+    )
+    expected = TileEvolutionState()
+    _compute_cluster_evolution(history, expected, 17)
+    _compute_square_history(history, expected, 17)
+    assert restored.memberships == expected.memberships
+    assert restored.max_square_size == expected.max_square_size
+
+
+def test_visited_tiles_without_evolution_state() -> None:
+    tiles = make_growing_history(4, 0)
+    tiles["activity_id"] = 1
+    tile_state = make_tile_state()
+    tile_state["tile_history"][17].append(tiles.iloc[:10])
+    visited_tiles = get_visited_tiles(tile_state, 17)
+    assert set(visited_tiles) == set(zip(tiles["tile_x"][:10], tiles["tile_y"][:10]))
+    assert 17 not in tile_state["evolution_state"]
+
+    compute_tile_evolution(tile_state, Config(explorer_zoom_levels=[17]))
+    assert (
+        get_visited_tiles(tile_state, 17)
+        is tile_state["evolution_state"][17].visited_tiles
+    )
+    # A history that has grown since is not covered by the evolution state yet.
+    tile_state["tile_history"][17].append(tiles.iloc[10:])
+    assert len(get_visited_tiles(tile_state, 17)) == len(tiles)
+
+    assert len(get_visited_tiles(tile_state, 14)) == 0
+    assert 14 not in tile_state["tile_history"]
+    assert 14 not in tile_state["evolution_state"]
+
+
+def test_tile_visits_as_of(repository: FakeRepository, tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    tile_visit_accessor = compute_from_scratch(repository, Config())
+    tile_state = tile_visit_accessor.tile_state
+    tile_visits = get_tile_visits_as_of(tile_state, 19, datetime.date(2024, 1, 1))
+    assert set(tile_visits) == {
+        (x, y) for x in range(100, 104) for y in range(200, 204)
+    }
+    assert tile_visits[(102, 202)]["activity_ids"] == {1}
+    assert tile_visits[(102, 202)]["last_id"] == 1
+    assert tile_state["tile_visits"][19][(102, 202)]["activity_ids"] == {1, 2}
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks."
+)
+def test_benchmark_square_history() -> None:
+    tiles = make_growing_history(400, 0)
+    s = TileEvolutionState()
+    start = time.perf_counter()
+    _compute_square_history(tiles, s, 17)
+    duration = time.perf_counter() - start
+    print(f"Square evolution for {len(tiles)} tiles took {duration:.1f} s.")
+    assert s.max_square_size == 400
+
+
+def reference_tiles_from_points(time_series: pd.DataFrame, zoom: int) -> list[tuple]:
+    """
+    The former generator that the vectorized rasterization has to reproduce.
+    """
+    xf = time_series["x"] * 2**zoom
+    yf = time_series["y"] * 2**zoom
+    result = []
+    for t1, x1, y1, x2, y2, s1, s2 in zip(
+        time_series["time"],
+        xf,
+        yf,
+        xf.shift(1),
+        yf.shift(1),
+        time_series["segment_id"],
+        time_series["segment_id"].shift(1),
+    ):
+        result.append((t1, int(x1), int(y1)))
+        if s1 == s2:
+            interpolated = interpolate_missing_tile(x1, y1, x2, y2)
+            if interpolated is not None:
+                result.append((t1,) + interpolated)
+    return result
+
+
+def make_random_walk(num_points: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 1.0, (num_points, 2)) / 2**19
+    return pd.DataFrame(
+        {
+            "time": pd.date_range(
+                "2024-01-01", periods=num_points, freq="1s", tz="UTC"
+            ),
+            "x": 0.52 + np.cumsum(steps[:, 0]),
+            "y": 0.34 + np.cumsum(steps[:, 1]),
+            "segment_id": np.arange(num_points) // 300,
+        }
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_tiles_from_points_matches_reference(seed: int) -> None:
+    time_series = make_random_walk(2000, seed)
+    expected = reference_tiles_from_points(time_series, 19)
+    actual = _tiles_from_points(time_series, 19)
+    assert list(zip(actual["time"], actual["tile_x"], actual["tile_y"])) == expected
+
+
+def test_tiles_from_points_localizes_time() -> None:
+    time_series = make_random_walk(10, 0)
+    time_series["time"] = time_series["time"].dt.tz_localize(None)
+    assert _tiles_from_points(time_series, 19)["time"].dt.tz is not None
+
+
+@pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks."
+)
+def test_benchmark_process_activity() -> None:
+    repository = FakeRepository()
+    repository.activities[1] = (True, make_random_walk(20_000, 0))
+    tile_state = make_tile_state()
+    start = time.perf_counter()
+    _process_activity(repository, tile_state, 1)
+    duration = time.perf_counter() - start
+    print(f"Processing an activity with 20000 points took {duration * 1000:.0f} ms.")
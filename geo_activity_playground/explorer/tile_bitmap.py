@@ -0,0 +1,100 @@
+from collections.abc import Iterator
+
+import numpy as np
+
+
+class TileBitmap:
+    """
+    Sparse set of tiles stored as a bitmap split into square blocks.
+
+    Only blocks that contain at least one tile are allocated, such that a few far away tiles don't blow up the memory. Rectangular windows can be extracted as boolean arrays, which allows to answer questions about whole areas with array operations.
+    """
+
+    BLOCK_SIZE = 64
+
+    def __init__(self) -> None:
+        self._blocks: dict[tuple[int, int], np.ndarray] = {}
+        self._count = 0
+
+    @classmethod
+    def from_tiles(cls, tile_x: np.ndarray, tile_y: np.ndarray) -> "TileBitmap":
+        bitmap = cls()
+        tile_x = np.asarray(tile_x, dtype=np.int64)
+        tile_y = np.asarray(tile_y, dtype=np.int64)
+        block_x = tile_x // cls.BLOCK_SIZE
+        block_y = tile_y // cls.BLOCK_SIZE
+        blocks, block_index = np.unique(
+            np.column_stack([block_x, block_y]), axis=0, return_inverse=True
+        )
+        block_index = block_index.reshape(-1)
+        for i, (bx, by) in enumerate(blocks.tolist()):
+            in_block = block_index == i
+            block = np.zeros((cls.BLOCK_SIZE, cls.BLOCK_SIZE), dtype=bool)
+            block[
+                tile_y[in_block] % cls.BLOCK_SIZE, tile_x[in_block] % cls.BLOCK_SIZE
+            ] = True
+            bitmap._blocks[(bx, by)] = block
+            bitmap._count += int(block.sum())
+        return bitmap
+
+    def __contains__(self, tile: tuple[int, int]) -> bool:
+        x, y = tile
+        block = self._blocks.get((x // self.BLOCK_SIZE, y // self.BLOCK_SIZE), None)
+        if block is None:
+            return False
+        return bool(block[y % self.BLOCK_SIZE, x % self.BLOCK_SIZE])
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        for (block_x, block_y), block in self._blocks.items():
+            ys, xs = np.nonzero(block)
+            for x, y in zip(xs, ys):
+                yield (
+                    int(block_x * self.BLOCK_SIZE + x),
+                    int(block_y * self.BLOCK_SIZE + y),
+                )
+
+    def add(self, tile: tuple[int, int]) -> None:
+        x, y = tile
+        key = (x // self.BLOCK_SIZE, y // self.BLOCK_SIZE)
+        block = self._blocks.get(key, None)
+        if block is None:
+            block = np.zeros((self.BLOCK_SIZE, self.BLOCK_SIZE), dtype=bool)
+            self._blocks[key] = block
+        if not block[y % self.BLOCK_SIZE, x % self.BLOCK_SIZE]:
+            block[y % self.BLOCK_SIZE, x % self.BLOCK_SIZE] = True
+            self._count += 1
+
+    def window(self, x_min: int, y_min: int, x_max: int, y_max: int) -> np.ndarray:
+        """
+        Returns the tiles in the half-open rectangle as a boolean array indexed by `[y - y_min, x - x_min]`.
+        """
+        result = np.zeros((max(y_max - y_min, 0), max(x_max - x_min, 0)), dtype=bool)
+        if result.size == 0:
+            return result
+        b = self.BLOCK_SIZE
+        for block_y in range(y_min // b, (y_max - 1) // b + 1):
+            for block_x in range(x_min // b, (x_max - 1) // b + 1):
+                block = self._blocks.get((block_x, block_y), None)
+                if block is None:
+                    continue
+                x0 = max(x_min, block_x * b)
+                x1 = min(x_max, (block_x + 1) * b)
+                y0 = max(y_min, block_y * b)
+                y1 = min(y_max, (block_y + 1) * b)
+                result[y0 - y_min : y1 - y_min, x0 - x_min : x1 - x_min] = block[
+                    y0 - block_y * b : y1 - block_y * b,
+                    x0 - block_x * b : x1 - block_x * b,
+                ]
+        return result
+
+    def missing(
+        self, x_min: int, y_min: int, x_max: int, y_max: int
+    ) -> list[tuple[int, int]]:
+        """
+        Returns the tiles in the half-open rectangle that are not in the set, ordered by x and then y.
+        """
+        xs, ys = np.nonzero(~self.window(x_min, y_min, x_max, y_max).T)
+        return list(zip((xs + x_min).tolist(), (ys + y_min).tolist()))
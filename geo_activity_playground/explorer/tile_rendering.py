@@ -0,0 +1,604 @@
+import abc
+import collections
+import datetime
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import shutil
+import threading
+from typing import Optional
+from typing import Union
+
+import matplotlib
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from ..core.paths import atomic_open
+from ..core.paths import explorer_tiles_dir
+from ..core.raster_map import OSM_TILE_SIZE
+from ..core.tasks import get_state
+from ..core.tasks import set_state
+from .footprints import FilteredExplorerState
+from .footprints import FootprintIndex
+from .tile_sets import lookup_tiles
+from .tile_sets import split_tile_keys
+from .tile_sets import tile_keys
+from .tile_visits import get_evolution_state_as_of
+from .tile_visits import get_tile_visits_as_of
+from .tile_visits import TileEvolutionState
+from .tile_visits import TileInfo
+from .tile_visits import TileVisitAccessor
+
+logger = logging.getLogger(__name__)
+
+SQUARE_LINE_WIDTH = 3
+SQUARE_COLOR = np.array([228, 26, 28, 255]) / 256
+GRID_COLOR = 0.5
+UNVISITED_COLOR = np.array([0, 0, 0, 70]) / 255
+
+
+class ExplorerTileTable:
+    """
+    Columnar snapshot of the explorer tiles at one zoom level.
+
+    The tiles are sorted by a combined integer key, such that the attributes of a whole block of tiles can be looked up with a single `np.searchsorted`.
+    """
+
+    def __init__(
+        self,
+        tile_visits: dict[tuple[int, int], TileInfo],
+        evolution_state: TileEvolutionState,
+    ) -> None:
+        tiles = list(tile_visits)
+        visits = [tile_visits[tile] for tile in tiles]
+        keys = tile_keys(
+            np.array([tile[0] for tile in tiles], dtype=np.int64),
+            np.array([tile[1] for tile in tiles], dtype=np.int64),
+        )
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.first_time = self._nanoseconds(
+            [visit.get("first_time", None) for visit in visits]
+        )[order]
+        self.last_time = self._nanoseconds(
+            [visit.get("last_time", None) for visit in visits]
+        )[order]
+        self.num_visits = np.array(
+            [len(visit.get("activity_ids", ())) for visit in visits], dtype=np.int64
+        )[order]
+        self._set_clusters([tiles[index] for index in order], evolution_state)
+
+    @classmethod
+    def from_filtered_state(cls, state: FilteredExplorerState) -> "ExplorerTileTable":
+        table = cls.__new__(cls)
+        table.keys = state.keys
+        table.first_time = state.first_time
+        table.last_time = state.last_time
+        table.num_visits = state.num_visits
+        tile_x, tile_y = split_tile_keys(state.keys)
+        table._set_clusters(list(zip(tile_x.tolist(), tile_y.tolist())), state)
+        return table
+
+    def _set_clusters(
+        self,
+        tiles: list[tuple[int, int]],
+        evolution_state: Union[TileEvolutionState, FilteredExplorerState],
+    ) -> None:
+        # Position of the cluster hue in [0, 1) and whether the tile is part of the biggest cluster.
+        memberships = evolution_state.memberships
+        clusters = evolution_state.clusters
+        max_cluster_name = max(
+            clusters, key=lambda name: len(clusters[name]), default=None
+        )
+        hues = {name: _cluster_hue(name) for name in clusters}
+        names = [memberships.get(tile, None) for tile in tiles]
+        self.cluster_hue = np.array(
+            [np.nan if name is None else hues[name] for name in names],
+            dtype=np.float64,
+        )
+        self.in_max_cluster = np.array(
+            [name is not None and name == max_cluster_name for name in names],
+            dtype=bool,
+        )
+
+    def lookup(
+        self, tile_x: np.ndarray, tile_y: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns which of the given tiles have been visited and their index into the columns.
+        """
+        return lookup_tiles(self.keys, tile_x, tile_y)
+
+    @staticmethod
+    def _nanoseconds(times: list) -> np.ndarray:
+        return np.fromiter(
+            (
+                (
+                    pd.NaT.value
+                    if time is None or pd.isna(time)
+                    else pd.Timestamp(time).value
+                )
+                for time in times
+            ),
+            dtype=np.int64,
+            count=len(times),
+        )
+
+
+def _cluster_hue(cluster_name: tuple[int, int]) -> float:
+    m = hashlib.sha256()
+    m.update(str(cluster_name).encode())
+    return int(m.hexdigest(), base=16) / (256.0**m.digest_size)
+
+
+class ColorStrategy(abc.ABC):
+    """
+    Colors a block of explorer tiles at once.
+
+    The result has the shape of the tile coordinates with an additional RGBA axis. Tiles that should not be colored have all zeros.
+    """
+
+    def colors(
+        self, table: ExplorerTileTable, tile_x: np.ndarray, tile_y: np.ndarray
+    ) -> np.ndarray:
+        visited, index = table.lookup(tile_x, tile_y)
+        result = np.zeros(visited.shape + (4,), dtype=np.float64)
+        self._colors(table, visited, index, result)
+        return result
+
+    @abc.abstractmethod
+    def _colors(
+        self,
+        table: ExplorerTileTable,
+        visited: np.ndarray,
+        index: np.ndarray,
+        result: np.ndarray,
+    ) -> None:
+        pass
+
+
+class MaxClusterColorStrategy(ColorStrategy):
+    def _colors(self, table, visited, index, result) -> None:
+        in_cluster = visited & ~np.isnan(table.cluster_hue[index])
+        in_max_cluster = visited & table.in_max_cluster[index]
+        result[visited] = UNVISITED_COLOR
+        result[in_cluster] = np.array([77, 175, 74, 70]) / 255
+        result[in_max_cluster] = np.array([55, 126, 184, 70]) / 255
+
+
+class ColorfulClusterColorStrategy(ColorStrategy):
+    def _colors(self, table, visited, index, result) -> None:
+        hue = table.cluster_hue[index]
+        in_cluster = visited & ~np.isnan(hue)
+        result[visited] = UNVISITED_COLOR
+        result[in_cluster] = matplotlib.colormaps["hsv"](hue[in_cluster])
+        result[in_cluster, 3] = 0.5
+
+
+class VisitTimeColorStrategy(ColorStrategy):
+    def __init__(self, use_first: bool = True) -> None:
+        self.use_first = use_first
+
+    def _colors(self, table, visited, index, result) -> None:
+        times = (table.first_time if self.use_first else table.last_time)[index]
+        has_time = visited & (times != pd.NaT.value)
+        today = datetime.date.today().toordinal()
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        age_days = today - (epoch + times[has_time] // (86400 * 10**9))
+        result[visited] = UNVISITED_COLOR
+        result[has_time] = matplotlib.colormaps["plasma"](
+            np.maximum(1 - age_days / (2 * 365), 0.0)
+        )
+        result[has_time, 3] = 0.5
+
+
+class NumVisitsColorStrategy(ColorStrategy):
+    def _colors(self, table, visited, index, result) -> None:
+        result[visited] = matplotlib.colormaps["viridis"](
+            np.minimum(table.num_visits[index][visited] / 50, 1.0)
+        )
+        result[visited, 3] = 0.5
+
+
+class MissingColorStrategy(ColorStrategy):
+    def _colors(self, table, visited, index, result) -> None:
+        result[~visited] = UNVISITED_COLOR
+
+
+COLOR_STRATEGIES = {
+    "max_cluster": MaxClusterColorStrategy,
+    "colorful_cluster": ColorfulClusterColorStrategy,
+    "first": lambda: VisitTimeColorStrategy(use_first=True),
+    "last": lambda: VisitTimeColorStrategy(use_first=False),
+    "visits": NumVisitsColorStrategy,
+    "missing": MissingColorStrategy,
+}
+
+
+def render_explorer_tile(
+    table: ExplorerTileTable,
+    evolution_state: Union[TileEvolutionState, FilteredExplorerState],
+    color_strategy: ColorStrategy,
+    zoom: int,
+    z: int,
+    x: int,
+    y: int,
+) -> np.ndarray:
+    """
+    Renders the explorer tiles of `zoom` into the map tile (z, x, y) as an RGBA float image.
+    """
+    result = np.zeros((OSM_TILE_SIZE, OSM_TILE_SIZE, 4), dtype=np.float64)
+    square_x = evolution_state.square_x
+    square_y = evolution_state.square_y
+    square_size = evolution_state.max_square_size
+    w = SQUARE_LINE_WIDTH
+
+    if z >= zoom:
+        # The map tile is part of a single explorer tile.
+        factor = 2 ** (z - zoom)
+        tile_x = x // factor
+        tile_y = y // factor
+        result[:] = color_strategy.colors(
+            table, np.array([tile_x]), np.array([tile_y])
+        )[0]
+        if x % factor == 0:
+            result[:, 0, :] = GRID_COLOR
+        if y % factor == 0:
+            result[0, :, :] = GRID_COLOR
+
+        if square_x is not None and square_y is not None:
+            within_y = square_y <= tile_y < square_y + square_size
+            within_x = square_x <= tile_x < square_x + square_size
+            if x % factor == 0 and tile_x == square_x and within_y:
+                result[:, :w] = SQUARE_COLOR
+            if y % factor == 0 and tile_y == square_y and within_x:
+                result[:w, :] = SQUARE_COLOR
+            if (
+                (x + 1) % factor == 0
+                and (x + 1) // factor == square_x + square_size
+                and within_y
+            ):
+                result[:, -w:] = SQUARE_COLOR
+            if (
+                (y + 1) % factor == 0
+                and (y + 1) // factor == square_y + square_size
+                and within_x
+            ):
+                result[-w:, :] = SQUARE_COLOR
+        return result
+
+    factor = 2 ** (zoom - z)
+    width = OSM_TILE_SIZE // factor
+    if width == 0:
+        # Explorer tiles would be smaller than a pixel.
+        return result
+
+    offsets = np.arange(factor)
+    tile_xs, tile_ys = np.meshgrid(x * factor + offsets, y * factor + offsets)
+    colors = color_strategy.colors(table, tile_xs, tile_ys)
+    result[:] = np.repeat(np.repeat(colors, width, axis=0), width, axis=1)
+
+    if square_x is not None and square_y is not None:
+        # The square in explorer tiles relative to this map tile, clipped to it.
+        left = square_x - x * factor
+        top = square_y - y * factor
+        right = left + square_size
+        bottom = top + square_size
+        row_range = slice(max(top, 0) * width, min(bottom, factor) * width)
+        column_range = slice(max(left, 0) * width, min(right, factor) * width)
+        if 0 <= left < factor:
+            result[row_range, left * width : left * width + w] = SQUARE_COLOR
+        if 0 <= top < factor:
+            result[top * width : top * width + w, column_range] = SQUARE_COLOR
+        if 0 < right <= factor:
+            result[row_range, max(right * width - w, 0) : right * width] = SQUARE_COLOR
+        if 0 < bottom <= factor:
+            result[max(bottom * width - w, 0) : bottom * width, column_range] = (
+                SQUARE_COLOR
+            )
+
+    if width >= 64:
+        result[::width, :, :] = GRID_COLOR
+        result[:, ::width, :] = GRID_COLOR
+    return result
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """
+    Encodes an RGBA float image with values in [0, 1] as PNG.
+
+    Pillow with a low compression level is much faster than `matplotlib.pyplot.imsave` and the tiles are mostly flat colors anyway.
+    """
+    rgba = (np.clip(image, 0.0, 1.0) * 255).astype(np.uint8)
+    f = io.BytesIO()
+    Image.fromarray(rgba).save(f, format="PNG", compress_level=1)
+    return f.getvalue()
+
+
+def changed_tiles(
+    old: ExplorerTileTable, new: ExplorerTileTable
+) -> set[tuple[int, int]]:
+    """
+    Returns the explorer tiles whose color might differ between two snapshots of the same zoom level.
+    """
+    _, old_index, new_index = np.intersect1d(
+        old.keys, new.keys, assume_unique=True, return_indices=True
+    )
+    differs = (
+        (old.first_time[old_index] != new.first_time[new_index])
+        | (old.last_time[old_index] != new.last_time[new_index])
+        | (old.num_visits[old_index] != new.num_visits[new_index])
+        | (old.in_max_cluster[old_index] != new.in_max_cluster[new_index])
+        | ~(
+            (old.cluster_hue[old_index] == new.cluster_hue[new_index])
+            | (
+                np.isnan(old.cluster_hue[old_index])
+                & np.isnan(new.cluster_hue[new_index])
+            )
+        )
+    )
+    keys = np.concatenate(
+        [
+            np.setxor1d(old.keys, new.keys, assume_unique=True),
+            new.keys[new_index[differs]],
+        ]
+    )
+    return {(int(key >> 32), int(key & 0xFFFFFFFF)) for key in keys}
+
+
+def square_outline_tiles(
+    square_x: Optional[int], square_y: Optional[int], size: int
+) -> set[tuple[int, int]]:
+    """
+    Returns the explorer tiles that have a part of the square outline drawn onto them.
+    """
+    if square_x is None or square_y is None or size == 0:
+        return set()
+    result = set()
+    for i in range(size):
+        result.add((square_x + i, square_y))
+        result.add((square_x + i, square_y + size - 1))
+        result.add((square_x, square_y + i))
+        result.add((square_x + size - 1, square_y + i))
+    return result
+
+
+class ExplorerTileRenderer:
+    """
+    Renders explorer overlay tiles and keeps them as PNG files on disk.
+
+    The files are stored per zoom and color strategy next to a version file, which records the data version of the tile state they have been rendered from. When the tile state changes, `invalidate` removes the files that show changed explorer tiles and marks the rest as current. If a changed data version is seen without that, all files of the strategy are dropped, unless an invalidation of the zoom level has been announced with `expect_invalidation` and not ended yet. Strategies that depend on the current date also include the date in their version.
+
+    With `as_of`, the tiles show the explorer state at the end of that day. These snapshots are kept in separate directories, of which only the most recently used ones are kept. With `activity_ids`, only the tiles of these activities are shown. Such filtered tiles are not stored on disk because the selection of activities can change without a change of the tile state.
+    """
+
+    # Number of snapshots at earlier dates or for filtered activities that are kept in memory.
+    MAX_EXTRA_SNAPSHOTS = 4
+    # Number of directories with tiles at earlier dates that are kept on disk per zoom level.
+    MAX_AS_OF_DIRS = 8
+
+    def __init__(
+        self,
+        tile_visit_accessor: TileVisitAccessor,
+        base_dir: Optional[pathlib.Path] = None,
+    ) -> None:
+        self.tile_visit_accessor = tile_visit_accessor
+        self._base_dir = base_dir
+        self.footprint_index = FootprintIndex(tile_visit_accessor)
+        self._snapshots: dict[
+            tuple[int, Optional[datetime.date], Optional[frozenset[int]]],
+            tuple[
+                int,
+                ExplorerTileTable,
+                Union[TileEvolutionState, FilteredExplorerState],
+            ],
+        ] = {}
+        # Number of announced invalidations per zoom level that have not ended yet.
+        self._pending_invalidations: collections.Counter[int] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def get_tile_path(
+        self,
+        zoom: int,
+        color_strategy_name: str,
+        z: int,
+        x: int,
+        y: int,
+        as_of: Optional[datetime.date] = None,
+    ) -> pathlib.Path:
+        if color_strategy_name not in COLOR_STRATEGIES:
+            raise ValueError("Unsupported color strategy.")
+        strategy_dir = self._strategy_dir(zoom, color_strategy_name, as_of)
+        with self._lock:
+            if as_of is not None:
+                self._use_as_of_dir(strategy_dir.parent)
+            version_path = strategy_dir / "version.json"
+            current_version = self._version_key(color_strategy_name)
+            if (
+                get_state(version_path, None) != current_version
+                and not self._pending_invalidations[zoom]
+            ):
+                shutil.rmtree(strategy_dir, ignore_errors=True)
+                set_state(version_path, current_version)
+
+        path = strategy_dir / str(z) / str(x) / f"{y}.png"
+        if path.exists():
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(path, "wb") as f:
+            f.write(self.render_png(zoom, color_strategy_name, z, x, y, as_of))
+        return path
+
+    def render_png(
+        self,
+        zoom: int,
+        color_strategy_name: str,
+        z: int,
+        x: int,
+        y: int,
+        as_of: Optional[datetime.date] = None,
+        activity_ids: Optional[frozenset[int]] = None,
+    ) -> bytes:
+        table, evolution_state = self.get_snapshot(zoom, as_of, activity_ids)
+        image = render_explorer_tile(
+            table,
+            evolution_state,
+            COLOR_STRATEGIES[color_strategy_name](),
+            zoom,
+            z,
+            x,
+            y,
+        )
+        return encode_png(image)
+
+    def expect_invalidation(self, zoom: int) -> None:
+        """
+        Keeps the files of a zoom level until `end_invalidation`, such that `invalidate` can remove only the changed ones after the tile state has changed.
+        """
+        with self._lock:
+            self._pending_invalidations[zoom] += 1
+
+    def end_invalidation(self, zoom: int) -> None:
+        with self._lock:
+            self._pending_invalidations[zoom] -= 1
+
+    def invalidate(self, zoom: int, explorer_tiles: set[tuple[int, int]]) -> None:
+        """
+        Removes the cached files that show any of the given explorer tiles and marks the remaining ones as current.
+        """
+        coarse_tiles: dict[int, set[tuple[int, int]]] = {}
+        for color_strategy_name in COLOR_STRATEGIES:
+            strategy_dir = self._strategy_dir(zoom, color_strategy_name)
+            with self._lock:
+                for path in strategy_dir.glob("*/*/*.png"):
+                    z, x, y = (
+                        int(path.parent.parent.name),
+                        int(path.parent.name),
+                        int(path.stem),
+                    )
+                    if _overlaps(zoom, z, x, y, explorer_tiles, coarse_tiles):
+                        path.unlink(missing_ok=True)
+                if strategy_dir.exists():
+                    set_state(
+                        strategy_dir / "version.json",
+                        self._version_key(color_strategy_name),
+                    )
+
+    def get_table(self, zoom: int) -> ExplorerTileTable:
+        return self.get_snapshot(zoom)[0]
+
+    def get_cached_table(self, zoom: int) -> Optional[ExplorerTileTable]:
+        """
+        The table of the current tile state if it has already been built, without building it.
+        """
+        with self._lock:
+            cached = self._snapshots.get((zoom, None, None), None)
+        if (
+            cached is None
+            or cached[0] != self.tile_visit_accessor.tile_state["data_version"]
+        ):
+            return None
+        return cached[1]
+
+    def get_snapshot(
+        self,
+        zoom: int,
+        as_of: Optional[datetime.date] = None,
+        activity_ids: Optional[frozenset[int]] = None,
+    ) -> tuple[ExplorerTileTable, Union[TileEvolutionState, FilteredExplorerState]]:
+        tile_state = self.tile_visit_accessor.tile_state
+        data_version = tile_state["data_version"]
+        snapshot_key = (zoom, as_of, activity_ids)
+        with self._lock:
+            cached = self._snapshots.get(snapshot_key, None)
+            if cached is None or cached[0] != data_version:
+                if as_of is not None or activity_ids is not None:
+                    extra = [
+                        key
+                        for key in self._snapshots
+                        if key[1] is not None or key[2] is not None
+                    ]
+                    for key in extra[: len(extra) - self.MAX_EXTRA_SNAPSHOTS + 1]:
+                        del self._snapshots[key]
+                evolution_state: Union[TileEvolutionState, FilteredExplorerState]
+                if activity_ids is not None:
+                    evolution_state = self.footprint_index.filtered_state(
+                        zoom, activity_ids, as_of
+                    )
+                    table = ExplorerTileTable.from_filtered_state(evolution_state)
+                elif as_of is not None:
+                    evolution_state, _ = get_evolution_state_as_of(
+                        tile_state, zoom, as_of
+                    )
+                    table = ExplorerTileTable(
+                        get_tile_visits_as_of(tile_state, zoom, as_of),
+                        evolution_state,
+                    )
+                else:
+                    evolution_state = tile_state["evolution_state"][zoom]
+                    table = ExplorerTileTable(
+                        tile_state["tile_visits"][zoom], evolution_state
+                    )
+                self._snapshots[snapshot_key] = (data_version, table, evolution_state)
+            return self._snapshots[snapshot_key][1:]
+
+    def _use_as_of_dir(self, as_of_dir: pathlib.Path) -> None:
+        """
+        Marks the directory of a date as used and deletes the least recently used directories of other dates.
+        """
+        as_of_dir.mkdir(parents=True, exist_ok=True)
+        os.utime(as_of_dir)
+        by_last_use = sorted(
+            as_of_dir.parent.iterdir(),
+            key=lambda path: path.stat().st_mtime_ns,
+            reverse=True,
+        )
+        for path in by_last_use[self.MAX_AS_OF_DIRS :]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _version_key(self, color_strategy_name: str) -> str:
+        key = str(self.tile_visit_accessor.tile_state["data_version"])
+        if color_strategy_name in ["first", "last"]:
+            key += f"-{datetime.date.today().isoformat()}"
+        return key
+
+    def _strategy_dir(
+        self,
+        zoom: int,
+        color_strategy_name: str,
+        as_of: Optional[datetime.date] = None,
+    ) -> pathlib.Path:
+        base_dir = (
+            self._base_dir if self._base_dir is not None else explorer_tiles_dir()
+        )
+        if as_of is not None:
+            return (
+                base_dir / str(zoom) / "as-of" / as_of.isoformat() / color_strategy_name
+            )
+        return base_dir / str(zoom) / color_strategy_name
+
+
+def _overlaps(
+    zoom: int,
+    z: int,
+    x: int,
+    y: int,
+    explorer_tiles: set[tuple[int, int]],
+    coarse_tiles: dict[int, set[tuple[int, int]]],
+) -> bool:
+    """
+    Whether the map tile (z, x, y) shows any of the explorer tiles at `zoom`.
+
+    `coarse_tiles` caches the explorer tiles reduced to the coarser zoom levels.
+    """
+    if z >= zoom:
+        return (x >> (z - zoom), y >> (z - zoom)) in explorer_tiles
+    if z not in coarse_tiles:
+        shift = zoom - z
+        coarse_tiles[z] = {
+            (tile_x >> shift, tile_y >> shift) for tile_x, tile_y in explorer_tiles
+        }
+    return (x, y) in coarse_tiles[z]
@@ -0,0 +1,131 @@
+"""
+Array algorithms on sets of tiles.
+
+A set of tiles is given as a sorted array of unique keys that combine the x and y coordinate into a single 64-bit integer, see `tile_keys`. Looking up many tiles at once is then a single `np.searchsorted`.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+# Neighbors of a tile in the order right, down, left, up.
+NEIGHBOR_OFFSETS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+
+def tile_keys(tile_x: np.ndarray, tile_y: np.ndarray) -> np.ndarray:
+    return (np.asarray(tile_x, dtype=np.int64) << 32) | np.asarray(
+        tile_y, dtype=np.int64
+    )
+
+
+def split_tile_keys(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+def lookup_tiles(
+    keys: np.ndarray, tile_x: np.ndarray, tile_y: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns which of the given tiles are in the set and their index into `keys`.
+    """
+    wanted = tile_keys(tile_x, tile_y)
+    if len(keys) == 0:
+        return np.zeros(wanted.shape, dtype=bool), np.zeros(wanted.shape, dtype=int)
+    index = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    return keys[index] == wanted, index
+
+
+def label_components(
+    num_tiles: int, neighbors: list[tuple[np.ndarray, np.ndarray]]
+) -> np.ndarray:
+    """
+    Labels connected components by hooking neighbors onto the smaller label and pointer jumping until nothing changes anymore.
+
+    `neighbors` contains pairs of a mask of the tiles that have a neighbor in some direction and the index of that neighbor, as returned by `lookup_tiles`. The label of each component is the smallest index of its tiles.
+    """
+    labels = np.arange(num_tiles)
+    if num_tiles == 0:
+        return labels
+    a = np.concatenate([np.nonzero(has_neighbor)[0] for has_neighbor, _ in neighbors])
+    b = np.concatenate([neighbor[has_neighbor] for has_neighbor, neighbor in neighbors])
+    while True:
+        label_a = labels[a]
+        label_b = labels[b]
+        differ = label_a != label_b
+        if not np.any(differ):
+            return labels
+        low = np.minimum(label_a[differ], label_b[differ])
+        high = np.maximum(label_a[differ], label_b[differ])
+        np.minimum.at(labels, high, low)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def find_clusters(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the cluster tiles, which are the tiles whose four neighbors are in the set as well.
+
+    Returns the mask of cluster tiles and, for each of them, the index of the tile that the cluster is named after.
+    """
+    tile_x, tile_y = split_tile_keys(keys)
+    is_cluster = np.ones(len(keys), dtype=bool)
+    for dx, dy in NEIGHBOR_OFFSETS:
+        is_cluster &= lookup_tiles(keys, tile_x + dx, tile_y + dy)[0]
+    cluster_keys = keys[is_cluster]
+    cluster_x, cluster_y = split_tile_keys(cluster_keys)
+    neighbors = [
+        lookup_tiles(cluster_keys, cluster_x + dx, cluster_y + dy)
+        for dx, dy in NEIGHBOR_OFFSETS[:2]
+    ]
+    labels = label_components(len(cluster_keys), neighbors)
+    return is_cluster, np.flatnonzero(is_cluster)[labels]
+
+
+def find_max_square(keys: np.ndarray) -> tuple[int, int, int]:
+    """
+    Finds the biggest square of tiles and returns its size and upper left corner.
+
+    For every tile the length of the vertical run of tiles that ends there is the height of the biggest column ending in it. A square of size k exists if k adjacent tiles in a row all have a height of at least k. This condition is monotonic in k, therefore a binary search over the size only needs a logarithmic number of vectorized passes.
+    """
+    if len(keys) == 0:
+        return 0, 0, 0
+    tile_x, tile_y = split_tile_keys(keys)
+    height = _run_lengths(keys)
+    row_keys = tile_keys(tile_y, tile_x)
+    row_order = np.argsort(row_keys)
+
+    def find(size: int) -> Optional[tuple[int, int]]:
+        selection = row_order[height[row_order] >= size]
+        if len(selection) < size:
+            return None
+        width = _run_lengths(row_keys[selection])
+        best = int(np.argmax(width))
+        if width[best] < size:
+            return None
+        index = selection[best]
+        return int(tile_x[index]) - size + 1, int(tile_y[index]) - size + 1
+
+    low, corner = 1, find(1)
+    high = int(min(height.max(), np.sqrt(len(keys)))) + 1
+    while high - low > 1:
+        middle = (low + high) // 2
+        found = find(middle)
+        if found is None:
+            high = middle
+        else:
+            low, corner = middle, found
+    assert corner is not None
+    return low, corner[0], corner[1]
+
+
+def _run_lengths(sorted_keys: np.ndarray) -> np.ndarray:
+    """
+    Length of the run of consecutive keys up to and including each key.
+    """
+    breaks = np.ones(len(sorted_keys), dtype=bool)
+    breaks[1:] = np.diff(sorted_keys) != 1
+    starts = np.flatnonzero(breaks)
+    return np.arange(len(sorted_keys)) - starts[np.cumsum(breaks) - 1] + 1
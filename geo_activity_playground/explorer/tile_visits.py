@@ -1,27 +1,33 @@
 import collections
 import datetime
-import itertools
+import hashlib
 import logging
 import pathlib
 import pickle
+import threading
+import time
 import zoneinfo
-from typing import Iterator
+from collections.abc import Callable
 from typing import Optional
 from typing import TypedDict
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from ..core.activities import ActivityRepository
 from ..core.config import Config
+from ..core.data_version import DATA_VERSION
 from ..core.datamodel import Activity
 from ..core.datamodel import DB
 from ..core.paths import atomic_open
 from ..core.tasks import try_load_pickle
 from ..core.tasks import work_tracker_path
-from ..core.tasks import WorkTracker
-from ..core.tiles import adjacent_to
-from ..core.tiles import interpolate_missing_tile
+from ..core.tiles import interpolate_missing_tiles
+from .clusters import TileClusters
+from .columnar_buffer import ColumnarBuffer
+from .columnar_buffer import UTC_TIME
+from .tile_bitmap import TileBitmap
 
 # import sqlalchemy as sa
 
@@ -75,28 +81,62 @@ class TileHistoryRow(TypedDict):
 
 class TileEvolutionState:
     def __init__(self) -> None:
-        self.num_neighbors: dict[tuple[int, int], int] = {}
-        self.memberships: dict[tuple[int, int], tuple[int, int]] = {}
-        self.clusters: dict[tuple[int, int], list[tuple[int, int]]] = {}
-        self.cluster_evolution = pd.DataFrame()
+        self.tile_clusters = TileClusters()
+        self.cluster_evolution_buffer = ColumnarBuffer(
+            {"time": UTC_TIME, "max_cluster_size": "int64"}
+        )
         self.square_start = 0
         self.cluster_start = 0
         self.max_square_size = 0
-        self.visited_tiles: set[tuple[int, int]] = set()
-        self.square_evolution = pd.DataFrame()
+        self.visited_tiles = TileBitmap()
+        self.square_evolution_buffer = ColumnarBuffer(
+            {
+                "time": UTC_TIME,
+                "max_square_size": "int64",
+                "square_x": "int64",
+                "square_y": "int64",
+            }
+        )
         self.square_x: Optional[int] = None
         self.square_y: Optional[int] = None
 
+    @property
+    def cluster_evolution(self) -> pd.DataFrame:
+        return self.cluster_evolution_buffer.frame
+
+    @property
+    def square_evolution(self) -> pd.DataFrame:
+        return self.square_evolution_buffer.frame
+
+    @property
+    def num_neighbors(self) -> dict[tuple[int, int], int]:
+        return self.tile_clusters.num_neighbors
+
+    @property
+    def memberships(self) -> dict[tuple[int, int], tuple[int, int]]:
+        return self.tile_clusters.memberships
+
+    @property
+    def clusters(self) -> dict[tuple[int, int], list[tuple[int, int]]]:
+        return self.tile_clusters.clusters
+
 
 class TileState(TypedDict):
     tile_visits: dict[int, dict[tuple[int, int], TileInfo]]
-    tile_history: dict[int, pd.DataFrame]
+    # The first visit of every tile in chronological order, with columns activity_id, time, tile_x and tile_y.
+    tile_history: dict[int, ColumnarBuffer]
     activities_per_tile: dict[int, dict[tuple[int, int], set[int]]]
+    # Reverse index, the tiles of each activity with columns zoom, tile_x, tile_y and time of the first visit.
+    tiles_per_activity: dict[int, pd.DataFrame]
+    # When the tiles of each activity have last been computed, such that caches of single activities can be invalidated.
+    activity_revisions: dict[int, int]
     evolution_state: dict[int, TileEvolutionState]
+    # Changes whenever activities are added or removed, such that derived caches can be invalidated.
+    data_version: int
     version: int
 
 
-TILE_STATE_VERSION = 2
+TILE_STATE_VERSION = 7
 
 
 class TileVisitAccessor:
@@ -104,19 +144,39 @@ class TileVisitAccessor:
 
     def __init__(self) -> None:
         self.tile_state: TileState = try_load_pickle(self.PATH)
+        # Data version of the tile state on disk.
+        self._saved_data_version: Optional[int] = None
         if (
             self.tile_state is None
             or self.tile_state.get("version", None) != TILE_STATE_VERSION
         ):
             self.tile_state = make_tile_state()
-            # TODO: Reset work tracker
+        else:
+            self._saved_data_version = self.tile_state["data_version"]
+        self.tile_state.setdefault("activity_revisions", {})
+        # Held while the tile state is changed or saved. The importer, the background jobs and requests all change it.
+        self.lock = threading.RLock()
+        # Activities used to be tracked separately, the tile state now knows them itself.
+        work_tracker_path("tile-state").unlink(missing_ok=True)
 
     def reset(self) -> None:
-        self.tile_state = make_tile_state()
+        with self.lock:
+            self.tile_state = make_tile_state()
+
+    def get_activity_revision(self, activity_id: int) -> int:
+        return self.tile_state["activity_revisions"].get(activity_id, 0)
 
     def save(self) -> None:
-        with atomic_open(self.PATH, "wb") as f:
-            pickle.dump(self.tile_state, f)
+        """
+        Writes the tile state and bumps the data version, unless nothing has changed since the last save.
+        """
+        with self.lock:
+            if self.tile_state["data_version"] == self._saved_data_version:
+                return
+            with atomic_open(self.PATH, "wb") as f:
+                pickle.dump(self.tile_state, f)
+            self._saved_data_version = self.tile_state["data_version"]
+        DATA_VERSION.bump()
 
 
 def make_defaultdict_dict():
@@ -127,91 +187,114 @@ def make_defaultdict_set():
     return collections.defaultdict(set)
 
 
+def make_tile_history() -> ColumnarBuffer:
+    return ColumnarBuffer(
+        {
+            "activity_id": "int64",
+            "time": UTC_TIME,
+            "tile_x": "int64",
+            "tile_y": "int64",
+        }
+    )
+
+
 def make_tile_state() -> TileState:
     tile_state: TileState = {
         "tile_visits": collections.defaultdict(make_defaultdict_dict),
-        "tile_history": collections.defaultdict(pd.DataFrame),
+        "tile_history": collections.defaultdict(make_tile_history),
         "activities_per_tile": collections.defaultdict(make_defaultdict_set),
+        "tiles_per_activity": {},
+        "activity_revisions": {},
         "evolution_state": collections.defaultdict(TileEvolutionState),
+        "data_version": time.time_ns(),
         "version": TILE_STATE_VERSION,
     }
     return tile_state
 
 
-def _consistency_check(
-    repository: ActivityRepository, tile_visit_accessor: TileVisitAccessor
-) -> bool:
-    present_activity_ids = set(repository.get_activity_ids())
-
-    for zoom, activities_per_tile in tile_visit_accessor.tile_state[
-        "activities_per_tile"
-    ].items():
-        for tile, tile_activity_ids in activities_per_tile.items():
-            deleted_activity_ids = tile_activity_ids - present_activity_ids
-            if deleted_activity_ids:
-                logger.info(f"Activities {deleted_activity_ids} have been deleted.")
-                return False
-
-    for zoom, tile_visits in tile_visit_accessor.tile_state["tile_visits"].items():
-        for tile, meta in tile_visits.items():
-            if not pd.isna(meta["first_time"]) and meta["first_time"].tzinfo is None:
-                logger.info("Tile visits are stored without time zone.")
-                return False
-            if meta["first_id"] not in present_activity_ids:
-                logger.info(f"Activity {meta['first_id']} have been deleted.")
-                return False
-            if meta["last_id"] not in present_activity_ids:
-                logger.info(f"Activity {meta['last_id']} have been deleted.")
-                return False
-
-    return True
+def update_tile_state(
+    repository: ActivityRepository,
+    tile_visit_accessor: TileVisitAccessor,
+    config: Config,
+) -> None:
+    """
+    Adds new activities to the tile state, removes deleted ones, brings the explorer evolution up to date and saves it, all under the lock of the tile state.
+    """
+    with tile_visit_accessor.lock:
+        compute_tile_visits_new(repository, tile_visit_accessor)
+        compute_tile_evolution(tile_visit_accessor.tile_state, config)
+        tile_visit_accessor.save()
+
+
+def mark_tile_state_changed(tile_state: TileState) -> None:
+    """
+    Gives the tile state a new data version. Called after a change is complete, such that nothing is cached for the new version while the change is under way.
+    """
+    tile_state["data_version"] = max(time.time_ns(), tile_state["data_version"] + 1)
 
 
 def compute_tile_visits_new(
     repository: ActivityRepository, tile_visit_accessor: TileVisitAccessor
 ) -> None:
-    work_tracker = WorkTracker(work_tracker_path("tile-state"))
-
-    if not _consistency_check(repository, tile_visit_accessor):
-        logger.warning("Need to recompute Explorer Tiles due to deleted activities.")
-        tile_visit_accessor.reset()
-        work_tracker.reset()
-
-    for activity_id in tqdm(
-        work_tracker.filter(repository.get_activity_ids()), desc="Tile visits", delay=1
-    ):
-        _process_activity(repository, tile_visit_accessor.tile_state, activity_id)
-        work_tracker.mark_done(activity_id)
-
-    for zoom in reversed(range(20)):
+    with tile_visit_accessor.lock:
         tile_state = tile_visit_accessor.tile_state
-        if (
-            len(tile_state["tile_history"][zoom])
-            and not (
-                tile_state["tile_history"][zoom]["time"].dropna().diff().dropna()
-                >= datetime.timedelta(seconds=0)
-            ).all()
+        present_activity_ids = repository.get_activity_ids()
+
+        present_activity_id_set = set(present_activity_ids)
+        deleted_activity_ids = [
+            activity_id
+            for activity_id in tile_state["tiles_per_activity"]
+            if activity_id not in present_activity_id_set
+        ]
+        for activity_id in tqdm(
+            deleted_activity_ids, desc="Remove deleted activities from tiles", delay=1
         ):
-            logger.warning(
-                f"The order of the tile history at {zoom=} is not chronological, resetting."
-            )
-            new_tile_history_soa: dict[str, list] = {
-                "activity_id": [],
-                "time": [],
-                "tile_x": [],
-                "tile_y": [],
-            }
-            for tile, visit in tile_state["tile_visits"][zoom].items():
-                new_tile_history_soa["activity_id"].append(visit["first_id"])
-                new_tile_history_soa["time"].append(visit["first_time"])
-                new_tile_history_soa["tile_x"].append(tile[0])
-                new_tile_history_soa["tile_y"].append(tile[1])
-            tile_state["tile_history"][zoom] = pd.DataFrame(new_tile_history_soa)
-            tile_state["tile_history"][zoom].sort_values("time", inplace=True)
-            # Reset the evolution state.
-            tile_state["evolution_state"] = collections.defaultdict(TileEvolutionState)
-    tile_visit_accessor.save()
-    work_tracker.close()
+            logger.info(f"Activity {activity_id} has been deleted, removing its tiles.")
+            remove_activity_from_tile_state(tile_state, activity_id)
+
+        for activity_id in tqdm(
+            [
+                activity_id
+                for activity_id in present_activity_ids
+                if activity_id not in tile_state["tiles_per_activity"]
+            ],
+            desc="Tile visits",
+            delay=1,
+        ):
+            _process_activity(repository, tile_state, activity_id)
+
+        for zoom in reversed(range(20)):
+            tile_history = tile_state["tile_history"][zoom]
+            if (
+                len(tile_history)
+                and not (
+                    tile_history.frame["time"].dropna().diff().dropna()
+                    >= datetime.timedelta(seconds=0)
+                ).all()
+            ):
+                logger.warning(
+                    f"The order of the tile history at {zoom=} is not chronological, resetting."
+                )
+                tile_history.replace(
+                    pd.DataFrame(
+                        [
+                            {
+                                "activity_id": visit["first_id"],
+                                "time": visit["first_time"],
+                                "tile_x": tile[0],
+                                "tile_y": tile[1],
+                            }
+                            for tile, visit in tile_state["tile_visits"][zoom].items()
+                        ],
+                        columns=["activity_id", "time", "tile_x", "tile_y"],
+                    ).sort_values("time")
+                )
+                # Reset the evolution state.
+                tile_state["evolution_state"] = collections.defaultdict(
+                    TileEvolutionState
+                )
+                mark_tile_state_changed(tile_state)
+        tile_visit_accessor.save()
 
 
 def _process_activity(
@@ -220,191 +303,542 @@ def _process_activity(
     activity = repository.get_activity_by_id(activity_id)
     time_series = repository.get_time_series(activity_id)
 
-    activity_tiles = pd.DataFrame(
-        _tiles_from_points(time_series, 19), columns=["time", "tile_x", "tile_y"]
-    )
+    activity_tiles = _tiles_from_points(time_series, 19)
+    tile_x = activity_tiles["tile_x"].to_numpy()
+    tile_y = activity_tiles["tile_y"].to_numpy()
+    times = activity_tiles["time"]
+    footprints = []
     for zoom in reversed(range(20)):
-        activities_per_tile = tile_state["activities_per_tile"][zoom]
+        # Keep the first visit of every tile, the order of the tiles is preserved.
+        _, first = np.unique((tile_x << 32) | tile_y, return_index=True)
+        first.sort()
+        tile_x, tile_y, times = tile_x[first], tile_y[first], times.iloc[first]
+        footprint = pd.DataFrame(
+            {"zoom": zoom, "tile_x": tile_x, "tile_y": tile_y, "time": times.array}
+        )
+        _apply_footprint(
+            tile_state,
+            activity_id,
+            zoom,
+            footprint,
+            activity.kind.consider_for_achievements,
+        )
+        footprints.append(footprint)
+
+        # Move up one layer in the quad-tree.
+        tile_x = tile_x >> 1
+        tile_y = tile_y >> 1
+
+    tile_state["tiles_per_activity"][activity_id] = pd.concat(
+        footprints, ignore_index=True
+    )
+    tile_state["activity_revisions"][activity_id] = time.time_ns()
+    mark_tile_state_changed(tile_state)
+
+
+def _apply_footprint(
+    tile_state: TileState,
+    activity_id: int,
+    zoom: int,
+    footprint: pd.DataFrame,
+    consider_for_achievements: bool,
+) -> None:
+    """
+    Adds the tiles of one activity at a single zoom level to the tile state.
+    """
+    tiles = list(zip(footprint["tile_x"].tolist(), footprint["tile_y"].tolist()))
+
+    activities_per_tile = tile_state["activities_per_tile"][zoom]
+    for tile in tiles:
+        activities_per_tile[tile].add(activity_id)
+
+    if not consider_for_achievements:
+        return
+
+    tile_visits = tile_state["tile_visits"][zoom]
+    is_new = np.fromiter(
+        (tile not in tile_visits for tile in tiles), dtype=bool, count=len(tiles)
+    )
+    times = footprint["time"].array
+    for index, time in zip(np.flatnonzero(is_new).tolist(), times[is_new].tolist()):
+        tile_visits[tiles[index]] = {
+            "activity_ids": {activity_id},
+            "first_id": activity_id,
+            "first_time": time,
+            "last_id": activity_id,
+            "last_time": time,
+        }
+
+    # Compare the times of the known tiles as integers and only create timestamps for the tiles that change.
+    nanoseconds = times.asi8.tolist()
+    for index in np.flatnonzero(~is_new).tolist():
+        tile_visit = tile_visits[tiles[index]]
+        tile_visit.setdefault("activity_ids", set()).add(activity_id)
+        time_ns = nanoseconds[index]
+        if time_ns == pd.NaT.value:
+            continue
+        first_time = tile_visit.get("first_time", None)
+        if first_time is None or (
+            first_time is not pd.NaT and time_ns < first_time.value
+        ):
+            tile_visit["first_id"] = activity_id
+            tile_visit["first_time"] = times[index]
+        last_time = tile_visit.get("last_time", None)
+        if last_time is None or (last_time is not pd.NaT and time_ns > last_time.value):
+            tile_visit["last_id"] = activity_id
+            tile_visit["last_time"] = times[index]
+
+    if is_new.any():
+        new_tiles = footprint.loc[is_new]
+        tile_state["tile_history"][zoom].append(
+            {
+                "activity_id": np.full(len(new_tiles), activity_id),
+                "time": new_tiles["time"],
+                "tile_x": new_tiles["tile_x"],
+                "tile_y": new_tiles["tile_y"],
+            }
+        )
+
+
+def remove_activity_from_tile_state(tile_state: TileState, activity_id: int) -> None:
+    """
+    Subtracts the contributions of a single activity from the tile state.
+
+    The tile history of every zoom level that changes gets patched and its evolution state is dropped, such that `compute_tile_evolution` replays it from the tile history.
+    """
+    activity_tiles = tile_state["tiles_per_activity"].pop(activity_id, None)
+    tile_state["activity_revisions"].pop(activity_id, None)
+    if activity_tiles is None:
+        return
 
+    changed_tiles: dict[int, set[tuple[int, int]]] = collections.defaultdict(set)
+    needs_first_last: list[tuple[int, tuple[int, int]]] = []
+    for zoom, tile_x, tile_y in zip(
+        activity_tiles["zoom"], activity_tiles["tile_x"], activity_tiles["tile_y"]
+    ):
+        zoom = int(zoom)
+        tile = (int(tile_x), int(tile_y))
+
+        activities_per_tile = tile_state["activities_per_tile"][zoom]
+        if tile in activities_per_tile:
+            activities_per_tile[tile].discard(activity_id)
+            if not activities_per_tile[tile]:
+                del activities_per_tile[tile]
+
+        tile_visits = tile_state["tile_visits"][zoom]
+        tile_visit = tile_visits.get(tile, None)
+        if not tile_visit or activity_id not in tile_visit["activity_ids"]:
+            continue
+        tile_visit["activity_ids"].discard(activity_id)
+        if not tile_visit["activity_ids"]:
+            del tile_visits[tile]
+            changed_tiles[zoom].add(tile)
+        elif activity_id in (tile_visit["first_id"], tile_visit["last_id"]):
+            needs_first_last.append((zoom, tile))
+
+    visit_times = _get_visit_times(tile_state, needs_first_last)
+    for zoom, tile in needs_first_last:
+        tile_visit = tile_state["tile_visits"][zoom][tile]
+        candidates = visit_times[(zoom, tile)]
+        if not candidates:
+            # The other activities predate the reverse index, so we cannot do better than dropping the activity.
+            candidates = [(pd.NaT, other) for other in tile_visit["activity_ids"]]
+        valid = [(time, other) for time, other in candidates if not pd.isna(time)]
+        if valid:
+            first_time, first_id = min(valid, key=lambda pair: pair[0])
+            last_time, last_id = max(valid, key=lambda pair: pair[0])
+        else:
+            first_time, first_id = candidates[0]
+            last_time, last_id = candidates[0]
+        if tile_visit["first_id"] == activity_id:
+            changed_tiles[zoom].add(tile)
+        tile_visit["first_id"] = first_id
+        tile_visit["first_time"] = first_time
+        tile_visit["last_id"] = last_id
+        tile_visit["last_time"] = last_time
+
+    for zoom, tiles in changed_tiles.items():
+        tile_history = tile_state["tile_history"][zoom].frame
+        if len(tile_history):
+            tile_history = tile_history.loc[
+                [
+                    tile not in tiles
+                    for tile in zip(tile_history["tile_x"], tile_history["tile_y"])
+                ]
+            ]
         new_tile_history_soa: dict[str, list] = {
             "activity_id": [],
             "time": [],
             "tile_x": [],
             "tile_y": [],
         }
-
-        activity_tiles = activity_tiles.groupby(["tile_x", "tile_y"]).head(1)
-
-        for time, tile in zip(
-            activity_tiles["time"],
-            zip(activity_tiles["tile_x"], activity_tiles["tile_y"]),
+        for tile in tiles:
+            if tile in tile_state["tile_visits"][zoom]:
+                visit = tile_state["tile_visits"][zoom][tile]
+                new_tile_history_soa["activity_id"].append(visit["first_id"])
+                new_tile_history_soa["time"].append(visit["first_time"])
+                new_tile_history_soa["tile_x"].append(tile[0])
+                new_tile_history_soa["tile_y"].append(tile[1])
+        if new_tile_history_soa["activity_id"]:
+            tile_history = pd.concat(
+                [tile_history, pd.DataFrame(new_tile_history_soa)]
+            ).sort_values("time", kind="stable")
+        tile_state["tile_history"][zoom].replace(tile_history)
+        # The evolution cannot be rewound, it gets replayed from the patched history.
+        tile_state["evolution_state"].pop(zoom, None)
+    mark_tile_state_changed(tile_state)
+
+
+def _get_visit_times(
+    tile_state: TileState, tiles: list[tuple[int, tuple[int, int]]]
+) -> dict[tuple[int, tuple[int, int]], list[tuple[pd.Timestamp, int]]]:
+    """
+    Looks up when the remaining activities have visited the given tiles, using the reverse index.
+    """
+    result: dict[tuple[int, tuple[int, int]], list[tuple[pd.Timestamp, int]]] = {
+        zoom_tile: [] for zoom_tile in tiles
+    }
+    if not tiles:
+        return result
+    keys = np.array(
+        [_tile_key(zoom, tile_x, tile_y) for zoom, (tile_x, tile_y) in tiles],
+        dtype=np.int64,
+    )
+    candidate_ids = set()
+    for zoom, tile in tiles:
+        candidate_ids.update(tile_state["tile_visits"][zoom][tile]["activity_ids"])
+    for other_id in candidate_ids:
+        other_tiles = tile_state["tiles_per_activity"].get(other_id, None)
+        if other_tiles is None:
+            continue
+        other_keys = _tile_key(
+            other_tiles["zoom"].to_numpy(np.int64),
+            other_tiles["tile_x"].to_numpy(np.int64),
+            other_tiles["tile_y"].to_numpy(np.int64),
+        )
+        selection = other_tiles.loc[np.isin(other_keys, keys)]
+        for zoom, tile_x, tile_y, time in zip(
+            selection["zoom"],
+            selection["tile_x"],
+            selection["tile_y"],
+            selection["time"],
         ):
-            if activity.kind.consider_for_achievements:
-                if time is not None and time.tz is None:
-                    time = time.tz_localize("UTC")
-                if tile not in tile_state["tile_visits"][zoom]:
-                    new_tile_history_soa["activity_id"].append(activity_id)
-                    new_tile_history_soa["time"].append(time)
-                    new_tile_history_soa["tile_x"].append(tile[0])
-                    new_tile_history_soa["tile_y"].append(tile[1])
-
-                tile_visit = tile_state["tile_visits"][zoom][tile]
-                if not tile_visit:
-                    tile_visit["activity_ids"] = {activity_id}
-                else:
-                    tile_visit["activity_ids"].add(activity_id)
-
-                first_time = tile_visit.get("first_time", None)
-                last_time = tile_visit.get("last_time", None)
-                if first_time is not None and first_time.tz is None:
-                    first_time = first_time.tz_localize("UTC")
-                if last_time is not None and last_time.tz is None:
-                    last_time = last_time.tz_localize("UTC")
-                try:
-                    if first_time is None or time < first_time:
-                        tile_visit["first_id"] = activity_id
-                        tile_visit["first_time"] = time
-                    if last_time is None or time > last_time:
-                        tile_visit["last_id"] = activity_id
-                        tile_visit["last_time"] = time
-                except TypeError as e:
-                    raise TypeError(
-                        f"Mismatch in timezone awareness: {time=}, {first_time=}, {last_time=}"
-                    ) from e
-
-            activities_per_tile[tile].add(activity_id)
+            zoom_tile = (int(zoom), (int(tile_x), int(tile_y)))
+            if (
+                other_id
+                in tile_state["tile_visits"][zoom_tile[0]][zoom_tile[1]]["activity_ids"]
+            ):
+                result[zoom_tile].append((time, other_id))
+    return result
 
-        if new_tile_history_soa["activity_id"]:
-            tile_state["tile_history"][zoom] = pd.concat(
-                [tile_state["tile_history"][zoom], pd.DataFrame(new_tile_history_soa)]
-            )
 
-        # Move up one layer in the quad-tree.
-        activity_tiles["tile_x"] //= 2
-        activity_tiles["tile_y"] //= 2
+def _tile_key(zoom, tile_x, tile_y):
+    return (zoom << 48) | (tile_x << 24) | tile_y
+
 
+def _tiles_from_points(time_series: pd.DataFrame, zoom: int) -> pd.DataFrame:
+    """
+    Rasterizes a track into the sequence of tiles that it passes through.
 
-def _tiles_from_points(
-    time_series: pd.DataFrame, zoom: int
-) -> Iterator[tuple[datetime.datetime, int, int]]:
+    Every point yields its tile. Where two consecutive points of the same segment are in diagonally adjacent tiles, the tile that the straight line between them passes through is inserted after the second point.
+    """
+    time_series = time_series.loc[
+        np.isfinite(time_series["x"]) & np.isfinite(time_series["y"])
+    ]
+    times = time_series["time"]
     # XXX Some people haven't localized their time series yet. This breaks the tile history part. Just assume that it is UTC, should be good enough for tiles.
-    if time_series["time"].dt.tz is None:
-        time_series = time_series.copy()
-        time_series["time"].dt.tz_localize(zoneinfo.ZoneInfo("UTC"))
-    xf = time_series["x"] * 2**zoom
-    yf = time_series["y"] * 2**zoom
-    for t1, x1, y1, x2, y2, s1, s2 in zip(
-        time_series["time"],
-        xf,
-        yf,
-        xf.shift(1),
-        yf.shift(1),
-        time_series["segment_id"],
-        time_series["segment_id"].shift(1),
-    ):
-        yield (t1, int(x1), int(y1))
-        # We don't want to interpolate over segment boundaries.
-        if s1 == s2:
-            interpolated = interpolate_missing_tile(x1, y1, x2, y2)
-            if interpolated is not None:
-                yield (t1,) + interpolated
+    if times.dt.tz is None:
+        times = times.dt.tz_localize(zoneinfo.ZoneInfo("UTC"))
+    xf = time_series["x"].to_numpy(dtype=np.float64) * 2**zoom
+    yf = time_series["y"].to_numpy(dtype=np.float64) * 2**zoom
+    segment_id = time_series["segment_id"].to_numpy()
+
+    x_before = np.concatenate([[np.nan], xf])[:-1]
+    y_before = np.concatenate([[np.nan], yf])[:-1]
+    mask, interpolated_x, interpolated_y = interpolate_missing_tiles(
+        xf, yf, x_before, y_before
+    )
+    # We don't want to interpolate over segment boundaries.
+    mask[1:] &= segment_id[1:] == segment_id[:-1]
+    mask[:1] = False
+
+    # Each point is followed by its interpolated tile, if there is one.
+    point_positions = np.arange(len(xf)) + np.cumsum(mask) - mask
+    interpolated_positions = point_positions[mask] + 1
+    size = len(xf) + int(mask.sum())
+    source = np.empty(size, dtype=np.int64)
+    tile_x = np.empty(size, dtype=np.int64)
+    tile_y = np.empty(size, dtype=np.int64)
+    source[point_positions] = np.arange(len(xf))
+    tile_x[point_positions] = xf.astype(np.int64)
+    tile_y[point_positions] = yf.astype(np.int64)
+    source[interpolated_positions] = np.flatnonzero(mask)
+    tile_x[interpolated_positions] = interpolated_x[mask]
+    tile_y[interpolated_positions] = interpolated_y[mask]
+    return pd.DataFrame(
+        {"time": times.iloc[source].array, "tile_x": tile_x, "tile_y": tile_y}
+    )
+
+
+# The evolution state is checkpointed to disk every this many tiles of the tile history, such that the state at an earlier date only needs to replay the tiles since the last checkpoint.
+EVOLUTION_CHECKPOINT_INTERVAL = 10_000
+EVOLUTION_CHECKPOINT_DIR = pathlib.Path("Cache/Explorer Checkpoints")
+# Older checkpoints are thinned out to those at a power of two times the interval, such that their number only grows logarithmically with the tile history.
+MAX_RECENT_EVOLUTION_CHECKPOINTS = 4
 
 
 def compute_tile_evolution(tile_state: TileState, config: Config) -> None:
+    changed = False
     for zoom in config.explorer_zoom_levels:
-        _compute_cluster_evolution(
-            tile_state["tile_history"][zoom],
-            tile_state["evolution_state"][zoom],
-            zoom,
-        )
-        _compute_square_history(
-            tile_state["tile_history"][zoom],
-            tile_state["evolution_state"][zoom],
-            zoom,
+        tiles = tile_state["tile_history"][zoom].frame
+        evolution_state = tile_state["evolution_state"][zoom]
+        start = min(evolution_state.cluster_start, evolution_state.square_start)
+        if start < len(tiles):
+            tile_state["evolution_state"][zoom] = replay_tile_evolution(
+                tiles, evolution_state, zoom
+            )
+            changed = True
+    if changed:
+        mark_tile_state_changed(tile_state)
+
+
+def replay_tile_evolution(
+    tiles: pd.DataFrame,
+    evolution_state: TileEvolutionState,
+    zoom: int,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> TileEvolutionState:
+    """
+    Brings the evolution state of a zoom level up to date with its tile history.
+
+    The tiles are replayed in chunks and a checkpoint is written after each full chunk. A replay from scratch continues from the latest checkpoint that matches the history, such that an interrupted replay doesn't start over. After each chunk `progress` is called with the number of replayed tiles and the total.
+    """
+    start = min(evolution_state.cluster_start, evolution_state.square_start)
+    if start == 0:
+        restored = _load_evolution_checkpoint(tiles, zoom, len(tiles), prune=True)
+        if restored is not None:
+            evolution_state = restored
+            start = min(evolution_state.cluster_start, evolution_state.square_start)
+    interval = EVOLUTION_CHECKPOINT_INTERVAL
+    ends = range((start // interval + 1) * interval, len(tiles) + 1, interval)
+    for end in sorted({*ends, len(tiles)}):
+        _compute_cluster_evolution(tiles.iloc[:end], evolution_state, zoom)
+        _compute_square_history(tiles.iloc[:end], evolution_state, zoom)
+        if end > start and end % interval == 0:
+            _save_evolution_checkpoint(tiles, evolution_state, zoom)
+        if progress is not None:
+            progress(end, len(tiles))
+    return evolution_state
+
+
+def get_tile_history(tile_state: TileState, zoom: int) -> pd.DataFrame:
+    """
+    The tile history of a zoom level, without adding the zoom level to the tile state.
+    """
+    tile_history = tile_state["tile_history"].get(zoom, None)
+    if tile_history is None:
+        tile_history = make_tile_history()
+    return tile_history.frame
+
+
+def get_visited_tiles(tile_state: TileState, zoom: int) -> TileBitmap:
+    """
+    The visited tiles of a zoom level.
+
+    They are taken from the evolution state if it is up to date with the tile history and built from the history otherwise. The zoom level is not added to the tile state.
+    """
+    tiles = get_tile_history(tile_state, zoom)
+    evolution_state = tile_state["evolution_state"].get(zoom, None)
+    if evolution_state is not None and evolution_state.square_start == len(tiles):
+        return evolution_state.visited_tiles
+    return TileBitmap.from_tiles(tiles["tile_x"].to_numpy(), tiles["tile_y"].to_numpy())
+
+
+def get_evolution_state_as_of(
+    tile_state: TileState, zoom: int, as_of: datetime.date
+) -> tuple[TileEvolutionState, pd.DataFrame]:
+    """
+    Evolution state and tile history of a zoom level at the end of the given day in UTC.
+
+    The state is restored from the closest checkpoint before that day and only the remaining tiles are replayed.
+    """
+    tiles = get_tile_history(tile_state, zoom)
+    end = _history_end(tiles, as_of)
+    evolution_state = tile_state["evolution_state"].get(zoom, None)
+    if (
+        end == len(tiles)
+        and evolution_state is not None
+        and min(evolution_state.cluster_start, evolution_state.square_start) == end
+    ):
+        return evolution_state, tiles
+
+    evolution_state = _load_evolution_checkpoint(tiles, zoom, end)
+    if evolution_state is None:
+        evolution_state = TileEvolutionState()
+
+    _compute_cluster_evolution(tiles.iloc[:end], evolution_state, zoom)
+    _compute_square_history(tiles.iloc[:end], evolution_state, zoom)
+    return evolution_state, tiles.iloc[:end]
+
+
+def get_tile_visits_as_of(
+    tile_state: TileState, zoom: int, as_of: datetime.date
+) -> dict[tuple[int, int], TileInfo]:
+    """
+    The tile visits of a zoom level at the end of the given day in UTC.
+    """
+    tiles = tile_state["tile_history"][zoom].frame
+    end = _history_end(tiles, as_of)
+    tile_visits = tile_state["tile_visits"][zoom]
+    if end == len(tiles):
+        return dict(tile_visits)
+
+    cutoff = _as_of_cutoff(as_of)
+    result: dict[tuple[int, int], TileInfo] = {}
+    later: list[tuple[int, tuple[int, int]]] = []
+    for tile_x, tile_y in zip(
+        tiles["tile_x"].iloc[:end].tolist(), tiles["tile_y"].iloc[:end].tolist()
+    ):
+        tile = (tile_x, tile_y)
+        tile_visit = tile_visits.get(tile, None)
+        if tile_visit is None:
+            continue
+        if pd.isna(tile_visit["last_time"]) or tile_visit["last_time"] < cutoff:
+            result[tile] = tile_visit
+        else:
+            later.append((zoom, tile))
+
+    # Tiles that have been visited again afterwards need their visits up to that day.
+    visit_times = _get_visit_times(tile_state, later)
+    for _, tile in later:
+        tile_visit = tile_visits[tile]
+        valid = [
+            (time, activity_id)
+            for time, activity_id in visit_times[(zoom, tile)]
+            if not pd.isna(time) and time < cutoff
+        ]
+        if valid:
+            last_time, last_id = max(valid, key=lambda pair: pair[0])
+            activity_ids = {activity_id for _, activity_id in valid}
+        else:
+            last_time, last_id = tile_visit["first_time"], tile_visit["first_id"]
+            activity_ids = {tile_visit["first_id"]}
+        result[tile] = {
+            "activity_ids": activity_ids,
+            "first_id": tile_visit["first_id"],
+            "first_time": tile_visit["first_time"],
+            "last_id": last_id,
+            "last_time": last_time,
+        }
+    return result
+
+
+def _as_of_cutoff(as_of: datetime.date) -> pd.Timestamp:
+    return pd.Timestamp(as_of + datetime.timedelta(days=1), tz="UTC")
+
+
+def _history_end(tiles: pd.DataFrame, as_of: datetime.date) -> int:
+    """
+    Number of tile history rows up to the end of the given day.
+    """
+    before = (tiles["time"] < _as_of_cutoff(as_of)).to_numpy()
+    if not before.any():
+        return 0
+    return len(before) - int(np.argmax(before[::-1]))
+
+
+def history_fingerprint(tiles: pd.DataFrame, end: int) -> str:
+    """
+    Hash of the first `end` rows of a tile history, which tells whether one history starts with another.
+    """
+    digest = hashlib.sha1(str(end).encode())
+    for column in ["time", "tile_x", "tile_y"]:
+        values = tiles[column].iloc[:end]
+        if column == "time":
+            values = values.array.asi8
+        digest.update(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _load_evolution_checkpoint(
+    tiles: pd.DataFrame, zoom: int, end: int, prune: bool = False
+) -> Optional[TileEvolutionState]:
+    """
+    Loads the latest checkpoint of at most `end` tiles that matches the tile history.
+
+    With `prune` the checkpoints after it are deleted, they belong to a different or longer history.
+    """
+    checkpoint_dir = EVOLUTION_CHECKPOINT_DIR / str(zoom)
+    candidates = sorted(
+        (int(path.stem) for path in checkpoint_dir.glob("*.pickle")), reverse=True
+    )
+    for candidate in candidates:
+        if candidate > end:
+            continue
+        checkpoint = try_load_pickle(checkpoint_dir / f"{candidate}.pickle")
+        if checkpoint is not None and checkpoint["fingerprint"] == history_fingerprint(
+            tiles, candidate
+        ):
+            break
+        if prune:
+            (checkpoint_dir / f"{candidate}.pickle").unlink()
+    else:
+        candidate = 0
+        checkpoint = None
+    if prune:
+        for later in candidates:
+            if later > candidate:
+                (checkpoint_dir / f"{later}.pickle").unlink(missing_ok=True)
+    return checkpoint["evolution_state"] if checkpoint is not None else None
+
+
+def _save_evolution_checkpoint(
+    tiles: pd.DataFrame, evolution_state: TileEvolutionState, zoom: int
+) -> None:
+    end = evolution_state.square_start
+    checkpoint_dir = EVOLUTION_CHECKPOINT_DIR / str(zoom)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    with atomic_open(checkpoint_dir / f"{end}.pickle", "wb") as f:
+        pickle.dump(
+            {
+                "fingerprint": history_fingerprint(tiles, end),
+                "evolution_state": evolution_state,
+            },
+            f,
         )
+    _prune_evolution_checkpoints(checkpoint_dir)
+
+
+def _prune_evolution_checkpoints(checkpoint_dir: pathlib.Path) -> None:
+    ends = sorted(
+        (int(path.stem) for path in checkpoint_dir.glob("*.pickle")), reverse=True
+    )
+    for end in ends[MAX_RECENT_EVOLUTION_CHECKPOINTS:]:
+        index = end // EVOLUTION_CHECKPOINT_INTERVAL
+        if index & (index - 1) != 0:
+            (checkpoint_dir / f"{end}.pickle").unlink(missing_ok=True)
 
 
 def _compute_cluster_evolution(
     tiles: pd.DataFrame, s: TileEvolutionState, zoom: int
 ) -> None:
-    if len(s.cluster_evolution) > 0:
-        max_cluster_so_far = s.cluster_evolution["max_cluster_size"].iloc[-1]
-    else:
-        max_cluster_so_far = 0
+    tile_clusters = s.tile_clusters
+    max_cluster_so_far = tile_clusters.max_cluster_size
 
     rows = []
-    for index, row in tqdm(
-        tiles.iloc[s.cluster_start :].iterrows(),
+    new_tiles = tiles.iloc[s.cluster_start :]
+    for time, tile_x, tile_y in tqdm(
+        zip(new_tiles["time"], new_tiles["tile_x"], new_tiles["tile_y"]),
         desc=f"Cluster evolution for {zoom=}",
         delay=1,
+        total=len(new_tiles),
     ):
-        new_clusters = False
-        # Current tile.
-        tile = (row["tile_x"], row["tile_y"])
-
-        # This tile is new, therefore it doesn't have an entries in the neighbor list yet.
-        s.num_neighbors[tile] = 0
-
-        # Go through the adjacent tile and check whether there are neighbors.
-        for other in adjacent_to(tile):
-            if other in s.num_neighbors:
-                # The other tile is already visited. That means that the current tile has a neighbor.
-                s.num_neighbors[tile] += 1
-                # Alto the other tile has gained a neighbor.
-                s.num_neighbors[other] += 1
-
-        # If the current tile has all neighbors, make it it's own cluster.
-        if s.num_neighbors[tile] == 4:
-            s.clusters[tile] = [tile]
-            s.memberships[tile] = tile
-
-        # Also make the adjacent tiles their own clusters, if they are full.
-        this_and_neighbors = [tile] + list(adjacent_to(tile))
-        for other in this_and_neighbors:
-            if s.num_neighbors.get(other, 0) == 4:
-                s.clusters[other] = [other]
-                s.memberships[other] = other
-
-        for candidate in this_and_neighbors:
-            # If the the candidate is not a cluster tile, skip.
-            if candidate not in s.memberships:
-                continue
-            # The candidate is a cluster tile. Let's see whether any of the neighbors are also cluster tiles but with a different cluster. Then we need to join them.
-            for other in adjacent_to(candidate):
-                if other not in s.memberships:
-                    continue
-                # The other tile is also a cluster tile.
-                if s.memberships[candidate] == s.memberships[other]:
-                    continue
-                # The two clusters are not the same. We add the other's cluster tile to this tile.
-                this_cluster = s.clusters[s.memberships[candidate]]
-                assert isinstance(other, tuple), other
-                assert isinstance(s.memberships[other], tuple), s.memberships[other]
-                other_cluster = s.clusters[s.memberships[other]]
-                other_cluster_name = s.memberships[other]
-                this_cluster.extend(other_cluster)
-                # Update the other cluster tiles that they now point to the new cluster. This also updates the other tile.
-                for member in other_cluster:
-                    s.memberships[member] = s.memberships[candidate]
-                del s.clusters[other_cluster_name]
-                new_clusters = True
-
-        if new_clusters:
-            max_cluster_size = max(
-                (len(members) for members in s.clusters.values()),
-                default=0,
-            )
-            if max_cluster_size > max_cluster_so_far:
-                rows.append(
-                    {
-                        "time": row["time"],
-                        "max_cluster_size": max_cluster_size,
-                    }
-                )
-                max_cluster_size = max_cluster_so_far
+        new_clusters = tile_clusters.add_tile((int(tile_x), int(tile_y)))
+        if new_clusters and tile_clusters.max_cluster_size > max_cluster_so_far:
+            max_cluster_so_far = tile_clusters.max_cluster_size
+            rows.append({"time": time, "max_cluster_size": max_cluster_so_far})
 
-    new_cluster_evolution = pd.DataFrame(rows)
-    s.cluster_evolution = pd.concat([s.cluster_evolution, new_cluster_evolution])
+    s.cluster_evolution_buffer.append(rows)
     s.cluster_start = len(tiles)
 
 
@@ -412,48 +846,88 @@ def _compute_square_history(
     tiles: pd.DataFrame, s: TileEvolutionState, zoom: int
 ) -> None:
     rows = []
-    for index, row in tqdm(
-        tiles.iloc[s.square_start :].iterrows(),
+    new_tiles = tiles.iloc[s.square_start :]
+    for time, tile_x, tile_y in tqdm(
+        zip(new_tiles["time"], new_tiles["tile_x"], new_tiles["tile_y"]),
         desc=f"Square evolution for {zoom=}",
         delay=1,
+        total=len(new_tiles),
     ):
-        tile = (row["tile_x"], row["tile_y"])
-        x, y = tile
-        s.visited_tiles.add(tile)
-        for square_size in itertools.count(s.max_square_size + 1):
-            this_tile_size_viable = False
-            for x_offset in range(square_size):
-                for y_offset in range(square_size):
-                    this_offset_viable = True
-                    for xx in range(square_size):
-                        for yy in range(square_size):
-                            if (
-                                x + xx - x_offset,
-                                y + yy - y_offset,
-                            ) not in s.visited_tiles:
-                                this_offset_viable = False
-                                break
-                        if not this_offset_viable:
-                            break
-                    if this_offset_viable:
-                        s.max_square_size = square_size
-                        s.square_x = x - x_offset
-                        s.square_y = y - y_offset
-                        rows.append(
-                            {
-                                "time": row["time"],
-                                "max_square_size": square_size,
-                                "square_x": s.square_x,
-                                "square_y": s.square_y,
-                            }
-                        )
-                        this_tile_size_viable = True
-                        break
-                if this_tile_size_viable:
-                    break
-            if not this_tile_size_viable:
-                break
-
-    new_square_history = pd.DataFrame(rows)
-    s.square_evolution = pd.concat([s.square_evolution, new_square_history])
+        x, y = int(tile_x), int(tile_y)
+        s.visited_tiles.add((x, y))
+        # A new tile can only enlarge the maximum square if it is part of it. Therefore we only need to look at squares that contain the new tile.
+        while (
+            corner := _find_square_containing(
+                s.visited_tiles, x, y, s.max_square_size + 1
+            )
+        ) is not None:
+            s.max_square_size += 1
+            s.square_x, s.square_y = corner
+            rows.append(
+                {
+                    "time": time,
+                    "max_square_size": s.max_square_size,
+                    "square_x": s.square_x,
+                    "square_y": s.square_y,
+                }
+            )
+
+    s.square_evolution_buffer.append(rows)
     s.square_start = len(tiles)
+
+
+def _find_square_containing(
+    visited_tiles: TileBitmap, x: int, y: int, size: int
+) -> Optional[tuple[int, int]]:
+    """
+    Finds a fully visited square of the given size that contains the tile (x, y).
+
+    Returns the upper left corner. If there are multiple squares, the one with the right-most and then bottom-most corner is chosen.
+    """
+    # Cheap rejection: The row and the column through the tile must be long enough. Also the square has to lie within these runs.
+    left, right = _run_around_center(
+        visited_tiles.window(x - size + 1, y, x + size, y + 1)[0], size - 1
+    )
+    if left + right + 1 < size:
+        return None
+    up, down = _run_around_center(
+        visited_tiles.window(x, y - size + 1, x + 1, y + size)[:, 0], size - 1
+    )
+    if up + down + 1 < size:
+        return None
+
+    # Summed-area table over all tiles that can be part of such a square.
+    x_min = x - left
+    y_min = y - up
+    window = visited_tiles.window(x_min, y_min, x + right + 1, y + down + 1)
+    table = np.zeros((window.shape[0] + 1, window.shape[1] + 1), dtype=np.int32)
+    np.cumsum(np.cumsum(window, axis=0), axis=1, out=table[1:, 1:])
+    # Number of visited tiles in the square with upper left corner at window position [i, j].
+    counts = (
+        table[size:, size:]
+        - table[:-size, size:]
+        - table[size:, :-size]
+        + table[:-size, :-size]
+    )
+    # The first index is the offset in x direction from the tile to the left edge of the square, the second one the offset in y direction.
+    viable = (counts == size * size)[::-1, ::-1].T
+    candidates = np.argwhere(viable)
+    if len(candidates) == 0:
+        return None
+    x_offset, y_offset = candidates[0]
+    # Translate the offsets from the far corner of the window back to the tile.
+    square_x = x_min + counts.shape[1] - 1 - int(x_offset)
+    square_y = y_min + counts.shape[0] - 1 - int(y_offset)
+    return square_x, square_y
+
+
+def _run_around_center(line: np.ndarray, center: int) -> tuple[int, int]:
+    """
+    Number of consecutive visited tiles before and after the center of the line.
+    """
+    gaps = np.flatnonzero(~line)
+    before = gaps[gaps < center]
+    after = gaps[gaps > center]
+    num_before = center - before[-1] - 1 if len(before) else center
+    num_after = after[0] - center - 1 if len(after) else len(line) - center - 1
+    return int(num_before), int(num_after)
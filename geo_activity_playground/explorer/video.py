@@ -13,6 +13,7 @@ from PIL import Image
 from PIL import ImageEnhance
 from tqdm import tqdm
 
+from ..core.config import ConfigAccessor
 from ..core.raster_map import get_tile
 
 # import scipy.interpolate
@@ -22,6 +23,7 @@ def build_image(
     center_x: float,
     center_y: float,
     explored: Set[Tuple[int, int]],
+    map_tile_url: str,
     brightness: float = 1.0,
     width: int = 1920,
     height: int = 1080,
@@ -45,7 +47,7 @@ def build_image(
     for i in range(0, int(width / tile_pixels + 2)):
         for j in range(0, int(width / tile_pixels + 2)):
             tile = (min_tile_x + i, min_tile_y + j)
-            sprite = get_tile(14, tile[0], tile[1])
+            sprite = Image.fromarray(get_tile(14, tile[0], tile[1], map_tile_url))
             if tile not in explored:
                 enhancer = ImageEnhance.Brightness(sprite)
                 sprite = enhancer.enhance(0.3)
@@ -109,6 +111,7 @@ def animate_chunk(
 def explorer_video_main():
     tile_df = pd.read_json(cache_dir / "tiles.json", date_unit="ns").sort_values("Time")
     chunks = chunk_tiles(tile_df)
+    map_tile_url = ConfigAccessor()().map_tile_url
     frame_counter = 0
     explored = set()
     for chunk in tqdm(chunks, desc="Chunk"):
@@ -119,6 +122,7 @@ def explorer_video_main():
                         frame.center_x,
                         frame.center_y,
                         explored - set(chunk[0]),
+                        map_tile_url,
                         brightness,
                         frame_counter=frame_counter,
                     )
@@ -127,6 +131,7 @@ def explorer_video_main():
                 frame.center_x,
                 frame.center_y,
                 frame.explored,
+                map_tile_url,
                 frame.brightness,
                 frame_counter=frame_counter,
             )
@@ -136,6 +141,7 @@ def explorer_video_main():
                 frame.center_x,
                 frame.center_y,
                 explored,
+                map_tile_url,
                 brightness,
                 frame_counter=frame_counter,
             )
@@ -1,27 +1,199 @@
 import collections
+import concurrent.futures
+import datetime
 import os
 import pathlib
+import shutil
+import subprocess
+from typing import Iterator
+from typing import Optional
 
 import matplotlib.pyplot as pl
 import numpy as np
 import pandas as pd
 from PIL import Image
-from PIL import ImageDraw
 from tqdm import tqdm
 
 from .core.activities import ActivityRepository
 from .core.config import ConfigAccessor
+from .core.paths import atomic_open
 from .core.raster_map import convert_to_grayscale
 from .core.raster_map import map_image_from_tile_bounds
 from .core.raster_map import OSM_TILE_SIZE
 from .core.raster_map import tile_bounds_around_center
+from .core.rasterization import concatenate_polylines
+from .core.rasterization import heatmap_line_width
+from .core.rasterization import polylines_from_time_series
+from .core.rasterization import rasterize_polylines
 from .core.tiles import compute_tile_float
 
+# Frames that are queued for or being rendered per worker process. Every one holds a copy of the counts.
+FRAMES_IN_FLIGHT_PER_PROCESS = 2
+
+
+class FrameRenderer:
+    """
+    Colors the counts of a frame and blends them with the inverted grayscale background.
+
+    The buffers are reused for every frame, so every worker process has a renderer of its own.
+    """
+
+    def __init__(self, background: np.ndarray, color_scheme: str) -> None:
+        self.inverse_background = np.subtract(
+            1, background / np.float32(255), dtype=np.float32
+        )
+        self.cmap = pl.get_cmap(color_scheme)
+        self._tile_counts = np.empty(background.shape[:2], np.float32)
+        self._data_color = np.empty(background.shape, np.float32)
+        self._rendered = np.empty(background.shape, np.float32)
+        self._frame = np.empty(background.shape, np.uint8)
+
+    def render(self, running_counts: np.ndarray) -> np.ndarray:
+        tile_counts = self._tile_counts
+        np.sqrt(running_counts, out=tile_counts)
+        tile_counts /= 5
+        np.minimum(tile_counts, 1.0, out=tile_counts)
+
+        data_color = self._data_color
+        np.multiply(
+            self.cmap(tile_counts, bytes=True)[:, :, :3], 1 / 255, out=data_color
+        )
+        data_color[tile_counts == 0] = 0.0  # remove background color
+
+        # (1 - color) · background + color = 1 - (1 - color) · (1 - background)
+        rendered = self._rendered
+        np.subtract(1, data_color, out=rendered)
+        rendered *= self.inverse_background
+        np.subtract(1, rendered, out=rendered)
+        rendered *= 255
+        np.copyto(self._frame, rendered, casting="unsafe")
+        return self._frame
+
+
+_frame_renderer: Optional[FrameRenderer] = None
+
+
+def _init_worker(background: np.ndarray, color_scheme: str) -> None:
+    global _frame_renderer
+    _frame_renderer = FrameRenderer(background, color_scheme)
+
+
+def _render_frame(
+    running_counts: np.ndarray, path: Optional[pathlib.Path]
+) -> Optional[bytes]:
+    """
+    Renders a frame in a worker process and saves it as PNG, or returns its raw RGB pixels without a path.
+    """
+    frame = _frame_renderer.render(running_counts)
+    if path is None:
+        return frame.tobytes()
+    # Written under a temporary name, such that `resume` never skips a truncated frame.
+    with atomic_open(path, "wb") as f:
+        Image.fromarray(frame, "RGB").save(f, format="png")
+    return None
+
+
+def accumulate_counts(
+    days: pd.DatetimeIndex,
+    rasterize_day,
+    shape: tuple[int, int],
+    decay: float,
+) -> Iterator[tuple[datetime.date, np.ndarray]]:
+    """
+    Adds up the counts of every day with the decay of the previous days and yields a copy for every day.
+
+    `rasterize_day(day, counts)` adds the counts of the activities on a day. This has to be done in order, so it stays in the main process.
+    """
+    running_counts = np.zeros(shape, np.float32)
+    day_counts = np.empty(shape, np.int32)
+    for current_day in days:
+        day_counts.fill(0)
+        rasterize_day(current_day.date(), day_counts)
+        running_counts += day_counts
+        yield current_day.date(), running_counts.copy()
+        running_counts *= 1 - decay
+
+
+def render_frames(
+    frames: Iterator[tuple[datetime.date, np.ndarray]],
+    background: np.ndarray,
+    color_scheme: str,
+    num_processes: int,
+    output_dir: Optional[pathlib.Path],
+    video_input=None,
+    resume: bool = False,
+) -> None:
+    """
+    Renders the frames in a pool of processes.
+
+    Frames are either saved as PNG into `output_dir` or written as raw RGB pixels to `video_input` in order. With `resume`, frames that already have a PNG are skipped.
+    """
+    in_flight = collections.deque()
+
+    def finish_oldest() -> None:
+        pixels = in_flight.popleft().result()
+        if video_input is not None:
+            video_input.write(pixels)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        num_processes, initializer=_init_worker, initargs=(background, color_scheme)
+    ) as executor:
+        for current_day, running_counts in frames:
+            if output_dir is None:
+                path = None
+            else:
+                path = output_dir / f"{current_day}.png"
+                if resume and path.exists():
+                    continue
+            in_flight.append(executor.submit(_render_frame, running_counts, path))
+            if len(in_flight) >= num_processes * FRAMES_IN_FLIGHT_PER_PROCESS:
+                finish_oldest()
+        while in_flight:
+            finish_oldest()
+
+
+def start_ffmpeg(
+    output_path: pathlib.Path, width: int, height: int, framerate: int
+) -> subprocess.Popen:
+    """
+    Starts ffmpeg such that it encodes raw RGB frames from its standard input into a video.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("Writing a video needs ffmpeg, which is not installed.")
+    return subprocess.Popen(
+        [
+            ffmpeg,
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(framerate),
+            "-i",
+            "-",
+            # Most players need chroma subsampling, which needs even dimensions.
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-pix_fmt",
+            "yuv420p",
+            str(output_path),
+        ],
+        stdin=subprocess.PIPE,
+    )
+
 
 def main_heatmap_video(options) -> None:
     zoom: int = options.zoom
     print(options)
     video_size = options.video_width, options.video_height
+    if options.ffmpeg:
+        options.ffmpeg = options.ffmpeg.resolve()
     os.chdir(options.basedir)
 
     repository = ActivityRepository()
@@ -34,7 +206,7 @@ def main_heatmap_video(options) -> None:
     background = map_image_from_tile_bounds(tile_bounds, config_accessor())
 
     background = convert_to_grayscale(background)
-    background = 1.0 - background  # invert colors
+    np.subtract(255, background, out=background)  # invert colors
 
     activities_per_day = collections.defaultdict(set)
     for activity in tqdm(
@@ -42,51 +214,56 @@ def main_heatmap_video(options) -> None:
     ):
         activities_per_day[activity["start"].date()].add(activity["id"])
 
-    running_counts = np.zeros(background.shape[:2], np.float64)
-
-    output_dir = pathlib.Path("Heatmap Video")
-    output_dir.mkdir(exist_ok=True)
+    def rasterize_day(day: datetime.date, day_counts: np.ndarray) -> None:
+        xy, offsets = concatenate_polylines(
+            [
+                polylines_from_time_series(repository.get_time_series(activity_id))
+                for activity_id in activities_per_day[day]
+            ]
+        )
+        rasterize_polylines(
+            day_counts,
+            (xy * 2**zoom - center_xy) * OSM_TILE_SIZE
+            + (options.video_width / 2, options.video_height / 2),
+            offsets,
+            heatmap_line_width(zoom),
+        )
 
     first_day = min(activities_per_day)
     last_day = max(activities_per_day)
     days = pd.date_range(first_day, last_day)
-    for current_day in tqdm(days, desc="Generate video frames"):
-        for activity_id in activities_per_day[current_day.date()]:
-            im = Image.new("L", video_size)
-            draw = ImageDraw.Draw(im)
-
-            time_series = repository.get_time_series(activity_id)
-            for _, group in time_series.groupby("segment_id"):
-                tile_xz = group["x"] * 2**zoom
-                tile_yz = group["y"] * 2**zoom
-
-                xy_pixels = list(
-                    zip(
-                        (tile_xz - center_xy[0]) * OSM_TILE_SIZE
-                        + options.video_width / 2,
-                        (tile_yz - center_xy[1]) * OSM_TILE_SIZE
-                        + options.video_height / 2,
-                    )
-                )
-                pixels = [int(value) for t in xy_pixels for value in t]
-                draw.line(pixels, fill=1, width=max(3, 6 * (zoom - 17)))
-                aim = np.array(im)
-                running_counts += aim
-
-        tile_counts = np.sqrt(running_counts) / 5
-        tile_counts[tile_counts > 1.0] = 1.0
-
-        cmap = pl.get_cmap(config_accessor().color_scheme_for_heatmap)
-        data_color = cmap(tile_counts)
-        data_color[data_color == cmap(0.0)] = 0.0  # remove background color
-
-        rendered = np.zeros_like(background)
-        for c in range(3):
-            rendered[:, :, c] = (1.0 - data_color[:, :, c]) * background[
-                :, :, c
-            ] + data_color[:, :, c]
-
-        img = Image.fromarray((rendered * 255).astype("uint8"), "RGB")
-        img.save(output_dir / f"{current_day.date()}.png", format="png")
-
-        running_counts *= 1 - options.decay
+    frames = tqdm(
+        accumulate_counts(days, rasterize_day, background.shape[:2], options.decay),
+        desc="Generate video frames",
+        total=len(days),
+    )
+    num_processes = options.processes or os.cpu_count() or 1
+
+    if options.ffmpeg:
+        height, width = background.shape[:2]
+        ffmpeg = start_ffmpeg(options.ffmpeg, width, height, options.framerate)
+        try:
+            render_frames(
+                frames,
+                background,
+                config_accessor().color_scheme_for_heatmap,
+                num_processes,
+                None,
+                video_input=ffmpeg.stdin,
+            )
+        finally:
+            ffmpeg.stdin.close()
+            returncode = ffmpeg.wait()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {returncode}.")
+    else:
+        output_dir = pathlib.Path("Heatmap Video")
+        output_dir.mkdir(exist_ok=True)
+        render_frames(
+            frames,
+            background,
+            config_accessor().color_scheme_for_heatmap,
+            num_processes,
+            output_dir,
+            resume=options.resume,
+        )
@@ -14,9 +14,8 @@ from ..core.datamodel import DEFAULT_UNKNOWN_NAME
 from ..core.datamodel import get_or_make_equipment
 from ..core.datamodel import get_or_make_kind
 from ..core.enrichment import update_and_commit
-from ..explorer.tile_visits import compute_tile_evolution
-from ..explorer.tile_visits import compute_tile_visits_new
 from ..explorer.tile_visits import TileVisitAccessor
+from ..explorer.tile_visits import update_tile_state
 from .activity_parsers import ActivityParseError
 from .activity_parsers import read_activity
 
@@ -108,9 +107,7 @@ def import_from_file(
     update_and_commit(activity, time_series, config)
 
     if len(repository) > 0 and i % 50 == 0:
-        compute_tile_visits_new(repository, tile_visit_accessor)
-        compute_tile_evolution(tile_visit_accessor.tile_state, config)
-        tile_visit_accessor.save()
+        update_tile_state(repository, tile_visit_accessor, config)
 
 
 def _get_metadata_from_path(
@@ -27,9 +27,8 @@ from ..core.paths import strava_api_dir
 from ..core.paths import strava_last_activity_date_path
 from ..core.tasks import get_state
 from ..core.tasks import set_state
-from ..explorer.tile_visits import compute_tile_evolution
-from ..explorer.tile_visits import compute_tile_visits_new
 from ..explorer.tile_visits import TileVisitAccessor
+from ..explorer.tile_visits import update_tile_state
 
 
 logger = logging.getLogger(__name__)
@@ -199,9 +198,7 @@ def try_import_strava(
 
                 update_and_commit(activity, time_series, config)
                 logger.info(f"Added activity '{activity.name}' from Strava.")
-                compute_tile_visits_new(repository, tile_visit_accessor)
-                compute_tile_evolution(tile_visit_accessor.tile_state, config)
-                tile_visit_accessor.save()
+                update_tile_state(repository, tile_visit_accessor, config)
 
             if strava_begin is None and strava_end is None:
                 set_state(
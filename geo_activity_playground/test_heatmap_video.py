@@ -0,0 +1,68 @@
+import io
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from .heatmap_video import accumulate_counts
+from .heatmap_video import FrameRenderer
+from .heatmap_video import render_frames
+
+SHAPE = (4, 6)
+
+
+def rasterize_day(day, day_counts) -> None:
+    # One more pixel is visited every day.
+    day_counts.flat[: day.day] = 1
+
+
+def make_frames(num_days: int):
+    days = pd.date_range("2024-01-01", periods=num_days)
+    return accumulate_counts(days, rasterize_day, SHAPE, decay=0.5)
+
+
+def test_accumulate_counts() -> None:
+    frames = list(make_frames(3))
+    assert [str(day) for day, _ in frames] == ["2024-01-01", "2024-01-02", "2024-01-03"]
+    assert frames[-1][1].flat[:4].tolist() == [1.75, 1.5, 1.0, 0.0]
+    # Every frame keeps its own counts.
+    assert frames[0][1].flat[:2].tolist() == [1.0, 0.0]
+
+
+def test_frame_renderer() -> None:
+    background = np.full(SHAPE + (3,), 100, np.uint8)
+    counts = np.zeros(SHAPE, np.float32)
+    counts[0, 0] = 25
+    frame = FrameRenderer(background, "hot").render(counts)
+    assert frame.dtype == np.uint8
+    # Pixels without counts show the background, up to rounding.
+    assert np.abs(frame[1, 1].astype(int) - 100).max() <= 1
+    # The top of the color scale is white, which covers the background.
+    assert frame[0, 0].tolist() == [255, 255, 255]
+
+
+def test_render_frames(tmp_path) -> None:
+    background = np.full(SHAPE + (3,), 50, np.uint8)
+    video_input = io.BytesIO()
+    render_frames(make_frames(5), background, "hot", 2, None, video_input=video_input)
+    raw = np.frombuffer(video_input.getvalue(), np.uint8).reshape((5,) + SHAPE + (3,))
+
+    render_frames(make_frames(5), background, "hot", 2, tmp_path)
+    for i, day in enumerate(pd.date_range("2024-01-01", periods=5)):
+        png = np.array(Image.open(tmp_path / f"{day.date()}.png"))
+        assert np.array_equal(png, raw[i])
+
+
+def test_resume(tmp_path) -> None:
+    background = np.zeros(SHAPE + (3,), np.uint8)
+    render_frames(make_frames(2), background, "hot", 1, tmp_path)
+    first = tmp_path / "2024-01-01.png"
+    first.write_bytes(b"kept")
+    (tmp_path / "2024-01-02.png").unlink()
+    render_frames(make_frames(3), background, "hot", 1, tmp_path, resume=True)
+    assert first.read_bytes() == b"kept"
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "2024-01-01.png",
+        "2024-01-02.png",
+        "2024-01-03.png",
+    ]
@@ -31,12 +31,16 @@ from ..core.datamodel import Kind
 from ..core.datamodel import Photo
 from ..core.datamodel import Tag
 from ..core.heart_rate import HeartRateZoneComputer
+from ..core.heatmap_counts import HeatmapCountStore
+from ..core.paths import heatmap_counts_dir
 from ..core.paths import TIME_SERIES_DIR
 from ..core.raster_map import GrayscaleImageTransform
 from ..core.raster_map import IdentityImageTransform
 from ..core.raster_map import InverseGrayscaleImageTransform
 from ..core.raster_map import PastelImageTransform
+from ..core.raster_map import TILE_FETCHER
 from ..core.raster_map import TileGetter
+from ..explorer.tile_rendering import ExplorerTileRenderer
 from ..explorer.tile_visits import TileVisitAccessor
 from .authenticator import Authenticator
 from .blueprints.activity_blueprint import make_activity_blueprint
@@ -61,7 +65,10 @@ from .blueprints.time_zone_fixer_blueprint import make_time_zone_fixer_blueprint
 from .blueprints.upload_blueprint import make_upload_blueprint
 from .blueprints.upload_blueprint import scan_for_activities
 from .flasher import FlaskFlasher
+from .prerender import Prerenderer
 from .search_util import SearchQueryHistory
+from .tile_updates import TileStateUpdates
+from .zoom_backfill import ZoomBackfill
 
 
 logger = logging.getLogger(__name__)
@@ -87,10 +94,16 @@ def importer_thread(
     config: Config,
     strava_begin: Optional[str],
     strava_end: Optional[str],
+    prerenderer: Prerenderer,
 ) -> None:
     with app.app_context():
         scan_for_activities(
-            repository, tile_visit_accessor, config, strava_begin, strava_end
+            repository,
+            tile_visit_accessor,
+            config,
+            strava_begin,
+            strava_end,
+            prerenderer=prerenderer,
         )
     logger.info("Importer thread is done.")
 
@@ -133,6 +146,22 @@ def web_ui_main(
     config_accessor = ConfigAccessor()
     import_old_config(config_accessor)
     import_old_strava_config(config_accessor)
+    explorer_tile_renderer = ExplorerTileRenderer(tile_visit_accessor)
+    heatmap_counts = HeatmapCountStore(
+        heatmap_counts_dir(), tile_visit_accessor.get_activity_revision
+    )
+    prerenderer = Prerenderer(
+        repository,
+        tile_visit_accessor,
+        config_accessor,
+        explorer_tile_renderer,
+        heatmap_counts,
+        app,
+    )
+    zoom_backfill = ZoomBackfill(tile_visit_accessor, config_accessor)
+    tile_state_updates = TileStateUpdates(
+        repository, tile_visit_accessor, config_accessor, app
+    )
 
     with app.app_context():
         for activity in DB.session.scalars(sqlalchemy.select(Activity)).all():
@@ -159,9 +188,12 @@ def web_ui_main(
                 config_accessor(),
                 strava_begin,
                 strava_end,
+                prerenderer,
             ),
         )
         thread.start()
+    zoom_backfill.resume()
+    tile_state_updates.resume()
 
     app.config["UPLOAD_FOLDER"] = "Activities"
     app.secret_key = get_secret_key()
@@ -196,6 +228,7 @@ def web_ui_main(
     search_query_history = SearchQueryHistory(config_accessor, authenticator)
     config = config_accessor()
     tile_getter = TileGetter(config.map_tile_url)
+    TILE_FETCHER.max_bytes = config.map_tile_cache_max_mb * 10**6
     image_transforms = {
         "color": IdentityImageTransform(),
         "grayscale": GrayscaleImageTransform(),
@@ -214,6 +247,7 @@ def web_ui_main(
             tile_visit_accessor,
             config,
             heart_rate_zone_computer,
+            tile_state_updates,
         ),
         "/auth": make_auth_blueprint(authenticator),
         "/bubble-chart": make_bubble_chart_blueprint(repository),
@@ -226,11 +260,19 @@ def web_ui_main(
             config_accessor,
             tile_getter,
             image_transforms,
+            explorer_tile_renderer,
+            prerenderer,
+            zoom_backfill,
         ),
         "/export": make_export_blueprint(authenticator),
         "/hall-of-fame": make_hall_of_fame_blueprint(repository, search_query_history),
         "/heatmap": make_heatmap_blueprint(
-            repository, tile_visit_accessor, config_accessor(), search_query_history
+            repository,
+            tile_visit_accessor,
+            config_accessor(),
+            search_query_history,
+            prerenderer,
+            heatmap_counts,
         ),
         "/photo": make_photo_blueprint(config_accessor, authenticator, flasher),
         "/plot-builder": make_plot_builder_blueprint(
@@ -247,7 +289,12 @@ def web_ui_main(
             authenticator, config, tile_visit_accessor
         ),
         "/upload": make_upload_blueprint(
-            repository, tile_visit_accessor, config_accessor(), authenticator, flasher
+            repository,
+            tile_visit_accessor,
+            config_accessor(),
+            authenticator,
+            flasher,
+            prerenderer,
         ),
     }
 
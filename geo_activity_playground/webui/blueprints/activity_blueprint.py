@@ -45,6 +45,7 @@ from ...explorer.tile_visits import TileVisitAccessor
 from ..authenticator import Authenticator
 from ..authenticator import needs_authentication
 from ..columns import TIME_SERIES_COLUMNS
+from ..tile_updates import TileStateUpdates
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +56,7 @@ def make_activity_blueprint(
     tile_visit_accessor: TileVisitAccessor,
     config: Config,
     heart_rate_zone_computer: HeartRateZoneComputer,
+    tile_state_updates: TileStateUpdates,
 ) -> Blueprint:
     blueprint = Blueprint("activity", __name__, template_folder="templates")
 
@@ -108,22 +110,22 @@ def make_activity_blueprint(
 
         new_tiles = {
             zoom: sum(
-                tile_visit_accessor.tile_state["tile_history"][zoom]["activity_id"]
+                tile_visit_accessor.tile_state["tile_history"][zoom].frame[
+                    "activity_id"
+                ]
                 == activity.id
             )
             for zoom in sorted(config.explorer_zoom_levels)
-            if not tile_visit_accessor.tile_state["tile_history"][zoom].empty
+            if len(tile_visit_accessor.tile_state["tile_history"][zoom])
         }
 
         new_tiles_geojson = {}
         new_tiles_per_zoom = {}
         for zoom in sorted(config.explorer_zoom_levels):
-            if tile_visit_accessor.tile_state["tile_history"][zoom].empty:
+            tile_history = tile_visit_accessor.tile_state["tile_history"][zoom].frame
+            if tile_history.empty:
                 continue
-            new_tiles = tile_visit_accessor.tile_state["tile_history"][zoom].loc[
-                tile_visit_accessor.tile_state["tile_history"][zoom]["activity_id"]
-                == activity.id
-            ]
+            new_tiles = tile_history.loc[tile_history["activity_id"] == activity.id]
             if len(new_tiles):
                 points = make_grid_points(
                     (
@@ -342,6 +344,7 @@ def make_activity_blueprint(
                 activity.equipment = DB.session.get_one(Equipment, int(form_equipment))
 
             form_kind = request.form.get("kind")
+            old_kind = activity.kind
             if form_kind == "null":
                 activity.kind = None
             else:
@@ -353,6 +356,10 @@ def make_activity_blueprint(
             ]
 
             DB.session.commit()
+            if bool(old_kind and old_kind.consider_for_achievements) != bool(
+                activity.kind and activity.kind.consider_for_achievements
+            ):
+                tile_state_updates.schedule(activity.id)
             return redirect(url_for(".show", id=activity.id))
 
         return render_template(
@@ -381,6 +388,7 @@ def make_activity_blueprint(
 
             time_series = activity.time_series
             update_and_commit(activity, time_series, config)
+            tile_state_updates.schedule(activity.id)
 
         cmap = matplotlib.colormaps["turbo"]
         num_points = len(activity.time_series)
@@ -438,6 +446,7 @@ def make_activity_blueprint(
         activity.delete_data()
         DB.session.delete(activity)
         DB.session.commit()
+        tile_state_updates.schedule(int(id))
         return redirect(url_for("index"))
 
     @blueprint.route("/download-original/<id>")
@@ -657,7 +666,7 @@ def make_sharepic_base(time_series_list: list[pd.DataFrame], config: Config):
     tile_bounds.y2 += footer_height / OSM_TILE_SIZE
     background = map_image_from_tile_bounds(tile_bounds, config)
 
-    img = Image.fromarray((background * 255).astype("uint8"), "RGB")
+    img = Image.fromarray(background, "RGB")
     draw = ImageDraw.Draw(img, mode="RGBA")
 
     for time_series in time_series_list:
@@ -1,24 +1,22 @@
-import abc
 import datetime
-import hashlib
-import io
 import logging
 from collections.abc import Iterable
 from typing import Optional
+from typing import TYPE_CHECKING
 from typing import Union
 
 import altair as alt
 import geojson
-import matplotlib
-import matplotlib.pyplot as pl
 import numpy as np
 import pandas as pd
+from flask import abort
 from flask import Blueprint
 from flask import flash
 from flask import redirect
 from flask import render_template
 from flask import request
 from flask import Response
+from flask import send_file
 from flask import url_for
 from flask.typing import ResponseReturnValue
 
@@ -27,19 +25,31 @@ from ...core.coordinates import Bounds
 from ...core.datamodel import Activity
 from ...core.datamodel import DB
 from ...core.raster_map import ImageTransform
-from ...core.raster_map import OSM_TILE_SIZE
 from ...core.raster_map import TileGetter
 from ...core.tiles import compute_tile
 from ...core.tiles import get_tile_upper_left_lat_lon
-from ...explorer.grid_file import get_border_tiles
+from ...explorer.footprints import FilteredExplorerState
 from ...explorer.grid_file import make_grid_file_geojson
 from ...explorer.grid_file import make_grid_file_gpx
 from ...explorer.grid_file import make_grid_points
-from ...explorer.tile_visits import compute_tile_evolution
+from ...explorer.grid_file import make_outline_file_geojson
+from ...explorer.grid_file import make_outline_file_gpx
+from ...explorer.grid_file import make_outline_polygons
+from ...explorer.tile_rendering import ExplorerTileRenderer
+from ...explorer.tile_visits import get_evolution_state_as_of
+from ...explorer.tile_visits import get_tile_history
+from ...explorer.tile_visits import get_visited_tiles
 from ...explorer.tile_visits import TileEvolutionState
 from ...explorer.tile_visits import TileVisitAccessor
 from ..authenticator import Authenticator
 from ..authenticator import needs_authentication
+from ..http_cache import conditional_on_data_version
+from ..search_util import search_query_from_form
+from ..search_util import SearchResultCache
+
+if TYPE_CHECKING:
+    from ..prerender import Prerenderer
+    from ..zoom_backfill import ZoomBackfill
 
 alt.data_transformers.enable("vegafusion")
 
@@ -52,129 +62,36 @@ def blend_color(
     return (1 - opacity) * base + opacity * addition
 
 
-class ColorStrategy(abc.ABC):
-    @abc.abstractmethod
-    def _color(self, tile_xy: tuple[int, int]) -> Optional[np.ndarray]:
-        pass
-
-
-class MaxClusterColorStrategy(ColorStrategy):
-    def __init__(self, evolution_state, tile_visits):
-        self.evolution_state = evolution_state
-        self.tile_visits = tile_visits
-        self.max_cluster_members = max(
-            evolution_state.clusters.values(),
-            key=len,
-        )
-
-    def _color(self, tile_xy: tuple[int, int]) -> Optional[np.ndarray]:
-        if tile_xy in self.max_cluster_members:
-            return np.array([[[55, 126, 184, 70]]]) / 255
-        elif tile_xy in self.evolution_state.memberships:
-            return np.array([[[77, 175, 74, 70]]]) / 255
-        elif tile_xy in self.tile_visits:
-            return np.array([[[0, 0, 0, 70]]]) / 255
-        else:
-            return None
-
-
-class ColorfulClusterColorStrategy(ColorStrategy):
-    def __init__(self, evolution_state: TileEvolutionState, tile_visits):
-        self.evolution_state = evolution_state
-        self.tile_visits = tile_visits
-        self.max_cluster_members = max(
-            evolution_state.clusters.values(),
-            key=len,
-        )
-        self._cmap = matplotlib.colormaps["hsv"]
-
-    def _color(self, tile_xy: tuple[int, int]) -> Optional[np.ndarray]:
-        if tile_xy in self.evolution_state.memberships:
-            cluster_id = self.evolution_state.memberships[tile_xy]
-            m = hashlib.sha256()
-            m.update(str(cluster_id).encode())
-            d = int(m.hexdigest(), base=16) / (256.0**m.digest_size)
-            return np.array([[self._cmap(d)[:3] + (0.5,)]])
-        elif tile_xy in self.tile_visits:
-            return np.array([[[0, 0, 0, 70]]]) / 255
-        else:
-            return None
-
-
-class VisitTimeColorStrategy(ColorStrategy):
-    def __init__(self, tile_visits, use_first=True):
-        self.tile_visits = tile_visits
-        self.use_first = use_first
-
-    def _color(self, tile_xy: tuple[int, int]) -> Optional[np.ndarray]:
-        if tile_xy in self.tile_visits:
-            today = datetime.date.today()
-            cmap = matplotlib.colormaps["plasma"]
-            tile_info = self.tile_visits[tile_xy]
-            relevant_time = (
-                tile_info["first_time"] if self.use_first else tile_info["last_time"]
-            )
-            if pd.isna(relevant_time):
-                color = np.array([[[0, 0, 0, 70]]]) / 255
-            else:
-                last_age_days = (today - relevant_time.date()).days
-                color = cmap(max(1 - last_age_days / (2 * 365), 0.0))
-                color = np.array([[color[:3] + (0.5,)]])
-            return color
-        else:
-            return None
-
-
-class NumVisitsColorStrategy(ColorStrategy):
-    def __init__(self, tile_visits):
-        self.tile_visits = tile_visits
-
-    def _color(self, tile_xy: tuple[int, int]) -> Optional[np.ndarray]:
-        if tile_xy in self.tile_visits:
-            cmap = matplotlib.colormaps["viridis"]
-            tile_info = self.tile_visits[tile_xy]
-            color = cmap(min(len(tile_info["activity_ids"]) / 50, 1.0))
-            return np.array([[color[:3] + (0.5,)]])
-        else:
-            return None
-
-
-class MissingColorStrategy(ColorStrategy):
-    def __init__(self, tile_visits):
-        self.tile_visits = tile_visits
-
-    def _color(self, tile_xy: tuple[int, int]) -> Optional[np.ndarray]:
-        if tile_xy in self.tile_visits:
-            return None
-        else:
-            return np.array([[[0, 0, 0, 70]]]) / 255
-
-
 def make_explorer_blueprint(
     authenticator: Authenticator,
     tile_visit_accessor: TileVisitAccessor,
     config_accessor: ConfigAccessor,
     tile_getter: TileGetter,
     image_transforms: dict[str, ImageTransform],
+    tile_renderer: ExplorerTileRenderer,
+    prerenderer: "Prerenderer",
+    zoom_backfill: "ZoomBackfill",
 ) -> Blueprint:
     blueprint = Blueprint("explorer", __name__, template_folder="templates")
+    search_results = SearchResultCache()
 
     @blueprint.route("/enable-zoom-level/<int:zoom>")
     @needs_authentication(authenticator)
     def enable_zoom_level(zoom: int) -> ResponseReturnValue:
         if 0 <= zoom <= 19:
-            config_accessor().explorer_zoom_levels.append(zoom)
-            config_accessor().explorer_zoom_levels.sort()
-            config_accessor.save()
-            compute_tile_evolution(tile_visit_accessor.tile_state, config_accessor())
-            flash(f"Enabled {zoom=} for explorer tiles.", category="success")
+            zoom_backfill.schedule(zoom)
+            flash(
+                f"Computing explorer tiles for {zoom=} in the background.",
+                category="success",
+            )
         else:
             flash(f"{zoom=} is not valid, must be between 0 and 19.", category="danger")
-        return redirect(url_for(".map", zoom=zoom))
+        return redirect(url_for(".server_side", zoom=zoom))
 
     @blueprint.route(
         "/<int:zoom>/<float(signed=True):north>/<float(signed=True):east>/<float(signed=True):south>/<float(signed=True):west>/missing.<suffix>"
     )
+    @conditional_on_data_version
     def download_missing(
         zoom: int, north: float, east: float, south: float, west: float, suffix: str
     ) -> ResponseReturnValue:
@@ -182,13 +99,21 @@ def make_explorer_blueprint(
         x2, y2 = compute_tile(south, east, zoom)
         tile_bounds = Bounds(x1, y1, x2 + 2, y2 + 2)
 
-        tile_histories = tile_visit_accessor.tile_state["tile_history"]
-        tiles = tile_histories[zoom]
-        points = get_border_tiles(tiles, zoom, tile_bounds)
-        if suffix == "geojson":
-            result = make_grid_file_geojson(points)
-        elif suffix == "gpx":
-            result = make_grid_file_gpx(points)
+        if _get_activity_ids(search_results) is None and _get_as_of() is None:
+            visited_tiles = get_visited_tiles(tile_visit_accessor.tile_state, zoom)
+        else:
+            visited_tiles = _get_evolution_state(zoom)[0].visited_tiles
+        result = _make_tile_file(
+            visited_tiles.missing(
+                tile_bounds.x_min,
+                tile_bounds.y_min,
+                tile_bounds.x_max,
+                tile_bounds.y_max,
+            ),
+            zoom,
+            suffix,
+            request.args.get("mode", "tiles"),
+        )
 
         mimetypes = {"geojson": "application/json", "gpx": "application/xml"}
         return Response(
@@ -200,6 +125,7 @@ def make_explorer_blueprint(
     @blueprint.route(
         "/<int:zoom>/<float(signed=True):north>/<float(signed=True):east>/<float(signed=True):south>/<float(signed=True):west>/explored.<suffix>"
     )
+    @conditional_on_data_version
     def download_explored(
         zoom: int, north: float, east: float, south: float, west: float, suffix: str
     ) -> ResponseReturnValue:
@@ -207,15 +133,17 @@ def make_explorer_blueprint(
         x2, y2 = compute_tile(south, east, zoom)
         tile_bounds = Bounds(x1, y1, x2 + 2, y2 + 2)
 
-        tile_visits = tile_visit_accessor.tile_state["tile_visits"]
-        tiles = tile_visits[zoom]
-        points = make_grid_points(
-            (tile for tile in tiles.keys() if tile_bounds.contains(*tile)), zoom
+        tiles = _get_evolution_state(zoom)[1]
+        result = _make_tile_file(
+            (
+                tile
+                for tile in zip(tiles["tile_x"].tolist(), tiles["tile_y"].tolist())
+                if tile_bounds.contains(*tile)
+            ),
+            zoom,
+            suffix,
+            request.args.get("mode", "tiles"),
         )
-        if suffix == "geojson":
-            result = make_grid_file_geojson(points)
-        elif suffix == "gpx":
-            result = make_grid_file_gpx(points)
 
         mimetypes = {"geojson": "application/json", "gpx": "application/xml"}
         return Response(
@@ -227,12 +155,19 @@ def make_explorer_blueprint(
     @blueprint.route("/<int:zoom>/server-side")
     def server_side(zoom: int) -> ResponseReturnValue:
         if zoom not in config_accessor().explorer_zoom_levels:
-            return {"zoom_level_not_generated": zoom}
-
-        tile_evolution_state = tile_visit_accessor.tile_state["evolution_state"][zoom]
-        tile_history = tile_visit_accessor.tile_state["tile_history"][zoom]
-
-        medians = tile_history[["tile_x", "tile_y"]].median()
+            context = {"zoom": zoom, "zoom_level_not_generated": zoom}
+            if zoom_backfill.is_pending(zoom):
+                context["backfill_progress"] = zoom_backfill.get_progress(zoom)
+            return render_template("explorer/server-side.html.j2", **context)
+
+        tile_evolution_state, tile_history = _get_evolution_state(zoom)
+        query = search_query_from_form(request.args)
+        filtered = isinstance(tile_evolution_state, FilteredExplorerState)
+
+        # The map is centered on all tiles, also when looking at an earlier state.
+        medians = get_tile_history(tile_visit_accessor.tile_state, zoom)[
+            ["tile_x", "tile_y"]
+        ].median()
         median_lat, median_lon = get_tile_upper_left_lat_lon(
             medians["tile_x"], medians["tile_y"], zoom
         )
@@ -249,12 +184,19 @@ def make_explorer_blueprint(
                     else {}
                 ),
             },
-            "plot_tile_evolution": plot_tile_evolution(tile_history),
-            "plot_cluster_evolution": plot_cluster_evolution(
-                tile_evolution_state.cluster_evolution
+            # Filtered tiles are analyzed as a whole and don't have a history.
+            "plot_tile_evolution": (
+                "" if filtered else plot_tile_evolution(tile_history)
             ),
-            "plot_square_evolution": plot_square_evolution(
-                tile_evolution_state.square_evolution
+            "plot_cluster_evolution": (
+                ""
+                if filtered
+                else plot_cluster_evolution(tile_evolution_state.cluster_evolution)
+            ),
+            "plot_square_evolution": (
+                ""
+                if filtered
+                else plot_square_evolution(tile_evolution_state.square_evolution)
             ),
             "zoom": zoom,
             "num_tiles": len(tile_history),
@@ -262,174 +204,44 @@ def make_explorer_blueprint(
             "square_x": tile_evolution_state.square_x,
             "square_y": tile_evolution_state.square_y,
             "square_size": tile_evolution_state.max_square_size,
-            "max_cluster_size": max(map(len, tile_evolution_state.clusters.values())),
+            "max_cluster_size": max(
+                map(len, tile_evolution_state.clusters.values()), default=0
+            ),
+            "as_of": _get_as_of(),
+            "query": query.to_jinja(),
+            "extra_args": query.to_url_str(),
         }
         return render_template("explorer/server-side.html.j2", **context)
 
     @blueprint.route("/<int:zoom>/tile/<int:z>/<int:x>/<int:y>.png")
+    @conditional_on_data_version
     def tile(zoom: int, z: int, x: int, y: int) -> ResponseReturnValue:
-        tile_visits = tile_visit_accessor.tile_state["tile_visits"][zoom]
-        evolution_state = tile_visit_accessor.tile_state["evolution_state"][zoom]
-
-        # map_tile = np.array(tile_getter.get_tile(z, x, y)) / 255
-        # grayscale = image_transforms["grayscale"].transform_image(map_tile)
-        grayscale = np.zeros((OSM_TILE_SIZE, OSM_TILE_SIZE, 4), dtype=np.float32)
-        square_line_width = 3
-        square_color = np.array([[[228, 26, 28, 255]]]) / 256
-
         color_strategy_name = request.args.get("color_strategy", "colorful_cluster")
         if color_strategy_name == "default":
             color_strategy_name = config_accessor().cluster_color_strategy
-        match color_strategy_name:
-            case "max_cluster":
-                color_strategy = MaxClusterColorStrategy(evolution_state, tile_visits)
-            case "colorful_cluster":
-                color_strategy = ColorfulClusterColorStrategy(
-                    evolution_state, tile_visits
-                )
-            case "first":
-                color_strategy = VisitTimeColorStrategy(tile_visits, use_first=True)
-            case "last":
-                color_strategy = VisitTimeColorStrategy(tile_visits, use_first=False)
-            case "visits":
-                color_strategy = NumVisitsColorStrategy(tile_visits)
-            case "missing":
-                color_strategy = MissingColorStrategy(tile_visits)
-            case _:
-                raise ValueError("Unsupported color strategy.")
-
-        if z >= zoom:
-            factor = 2 ** (z - zoom)
-            tile_x = x // factor
-            tile_y = y // factor
-            tile_xy = (tile_x, tile_y)
-            color = color_strategy._color(tile_xy)
-            if color is None:
-                result = grayscale
-            else:
-                result = np.broadcast_to(color, grayscale.shape).copy()
-
-            if x % factor == 0:
-                result[:, 0, :] = 0.5
-            if y % factor == 0:
-                result[0, :, :] = 0.5
-
-            if (
-                evolution_state.square_x is not None
-                and evolution_state.square_y is not None
-            ):
-                if (
-                    x % factor == 0
-                    and tile_x == evolution_state.square_x
-                    and evolution_state.square_y
-                    <= tile_y
-                    < evolution_state.square_y + evolution_state.max_square_size
-                ):
-                    result[:, 0:square_line_width] = square_color
-                if (
-                    y % factor == 0
-                    and tile_y == evolution_state.square_y
-                    and evolution_state.square_x
-                    <= tile_x
-                    < evolution_state.square_x + evolution_state.max_square_size
-                ):
-                    result[0:square_line_width, :] = square_color
-                if (
-                    (x + 1) % factor == 0
-                    and (x + 1) // factor
-                    == evolution_state.square_x + evolution_state.max_square_size
-                    and evolution_state.square_y
-                    <= tile_y
-                    < evolution_state.square_y + evolution_state.max_square_size
-                ):
-                    result[:, -square_line_width:] = square_color
-                if (
-                    (y + 1) % factor == 0
-                    and (y + 1) // factor
-                    == evolution_state.square_y + evolution_state.max_square_size
-                    and evolution_state.square_x
-                    <= tile_x
-                    < evolution_state.square_x + evolution_state.max_square_size
-                ):
-                    result[-square_line_width:, :] = square_color
-        else:
-            result = grayscale
-            factor = 2 ** (zoom - z)
-            width = 256 // factor
-            for xo in range(factor):
-                for yo in range(factor):
-                    tile_x = x * factor + xo
-                    tile_y = y * factor + yo
-                    tile_xy = (tile_x, tile_y)
-                    color = color_strategy._color(tile_xy)
-                    if color is not None:
-                        result[
-                            yo * width : (yo + 1) * width, xo * width : (xo + 1) * width
-                        ] = color
-
-                    if (
-                        evolution_state.square_x is not None
-                        and evolution_state.square_y is not None
-                    ):
-                        if (
-                            tile_x == evolution_state.square_x
-                            and evolution_state.square_y
-                            <= tile_y
-                            < evolution_state.square_y + evolution_state.max_square_size
-                        ):
-                            result[
-                                yo * width : (yo + 1) * width,
-                                xo * width : xo * width + square_line_width,
-                            ] = square_color
-                        if (
-                            tile_y == evolution_state.square_y
-                            and evolution_state.square_x
-                            <= tile_x
-                            < evolution_state.square_x + evolution_state.max_square_size
-                        ):
-                            result[
-                                yo * width : yo * width + square_line_width,
-                                xo * width : (xo + 1) * width,
-                            ] = square_color
-
-                        if (
-                            tile_x + 1
-                            == evolution_state.square_x
-                            + evolution_state.max_square_size
-                            and evolution_state.square_y
-                            <= tile_y
-                            < evolution_state.square_y + evolution_state.max_square_size
-                        ):
-                            result[
-                                yo * width : (yo + 1) * width,
-                                (xo + 1) * width - square_line_width : (xo + 1) * width,
-                            ] = square_color
-
-                        if (
-                            tile_y + 1
-                            == evolution_state.square_y
-                            + evolution_state.max_square_size
-                            and evolution_state.square_x
-                            <= tile_x
-                            < evolution_state.square_x + evolution_state.max_square_size
-                        ):
-                            result[
-                                (yo + 1) * width - square_line_width : (yo + 1) * width,
-                                xo * width : (xo + 1) * width,
-                            ] = square_color
-                    if width >= 64:
-                        result[yo * width, :, :] = 0.5
-                        result[:, xo * width, :] = 0.5
-        f = io.BytesIO()
-        pl.imsave(f, result, format="png")
-        return Response(bytes(f.getbuffer()), mimetype="image/png")
+        activity_ids = _get_activity_ids(search_results)
+        if activity_ids is not None:
+            return Response(
+                tile_renderer.render_png(
+                    zoom, color_strategy_name, z, x, y, _get_as_of(), activity_ids
+                ),
+                mimetype="image/png",
+            )
+        prerenderer.record_view(z, x, y)
+        path = tile_renderer.get_tile_path(
+            zoom, color_strategy_name, z, x, y, _get_as_of()
+        )
+        # The validators come from the data version, not from the file.
+        return send_file(path.absolute(), mimetype="image/png", conditional=False)
 
     @blueprint.route(
         "/<int:zoom>/info/<float(signed=True):latitude>/<float(signed=True):longitude>"
     )
     def info(zoom: int, latitude: float, longitude: float) -> dict:
         tile_visits = tile_visit_accessor.tile_state["tile_visits"][zoom]
-        evolution_state = tile_visit_accessor.tile_state["evolution_state"][zoom]
+        evolution_state = tile_visit_accessor.tile_state["evolution_state"].get(
+            zoom, TileEvolutionState()
+        )
         tile_xy = compute_tile(latitude, longitude, zoom)
         if tile_xy in tile_visits:
             tile_info = tile_visits[tile_xy]
@@ -455,9 +267,74 @@ def make_explorer_blueprint(
             result = {}
         return result
 
+    def _get_evolution_state(
+        zoom: int,
+    ) -> tuple[Union[TileEvolutionState, FilteredExplorerState], pd.DataFrame]:
+        """
+        Explorer state of the zoom level and its tiles, taking the activity filter and the `as_of` date into account.
+        """
+        tile_state = tile_visit_accessor.tile_state
+        as_of = _get_as_of()
+        activity_ids = _get_activity_ids(search_results)
+        if activity_ids is not None:
+            filtered_state = tile_renderer.footprint_index.filtered_state(
+                zoom, activity_ids, as_of
+            )
+            return filtered_state, filtered_state.tiles
+        if as_of is None:
+            return (
+                tile_state["evolution_state"].get(zoom, TileEvolutionState()),
+                get_tile_history(tile_state, zoom),
+            )
+        return get_evolution_state_as_of(tile_state, zoom, as_of)
+
     return blueprint
 
 
+def _get_as_of() -> Optional[datetime.date]:
+    """
+    The date from the `as_of` query parameter, which selects an earlier state of the explorer.
+    """
+    as_of = request.args.get("as_of", "")
+    if not as_of:
+        return None
+    try:
+        return datetime.date.fromisoformat(as_of)
+    except ValueError:
+        abort(400, f"Invalid date {as_of=}.")
+
+
+def _get_activity_ids(search_results: SearchResultCache) -> Optional[frozenset[int]]:
+    """
+    The activities that match the activity filter in the query parameters, or `None` without a filter.
+    """
+    query = search_query_from_form(request.args)
+    if not query.active:
+        return None
+    return search_results.get_activity_ids(query)
+
+
+def _make_tile_file(
+    tiles: Iterable[tuple[int, int]], zoom: int, suffix: str, mode: str
+) -> str:
+    """
+    Writes the tiles either as one square per tile or, in the `merged` mode, as the outlines of the regions that they cover.
+    """
+    if mode == "merged":
+        polygons = make_outline_polygons(tiles, zoom)
+        if suffix == "geojson":
+            return make_outline_file_geojson(polygons)
+        elif suffix == "gpx":
+            return make_outline_file_gpx(polygons)
+    elif mode == "tiles":
+        points = make_grid_points(tiles, zoom)
+        if suffix == "geojson":
+            return make_grid_file_geojson(points)
+        elif suffix == "gpx":
+            return make_grid_file_gpx(points)
+    raise ValueError(f"Unsupported {suffix=} or {mode=}.")
+
+
 def bounding_box_for_biggest_cluster(
     clusters: Iterable[list[tuple[int, int]]], zoom: int
 ) -> str:
@@ -1,41 +1,78 @@
+import concurrent.futures
+import dataclasses
 import io
 import logging
-import pathlib
+from collections.abc import Iterable
+from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Union
 
 import matplotlib.pylab as pl
 import numpy as np
+from flask import abort
 from flask import Blueprint
+from flask import current_app
+from flask import redirect
 from flask import render_template
 from flask import request
 from flask import Response
-from PIL import Image
-from PIL import ImageDraw
+from flask import send_file
+from flask import url_for
 
 from ...core.activities import ActivityRepository
 from ...core.config import Config
-from ...core.meta_search import apply_search_query
-from ...core.meta_search import SearchQuery
+from ...core.data_version import DATA_VERSION
+from ...core.heatmap_counts import downsample_counts
+from ...core.heatmap_counts import HeatmapCountStore
+from ...core.heatmap_counts import is_rasterized_zoom
+from ...core.heatmap_footprints import HeatmapFootprintCache
+from ...core.heatmap_layers import ActivityCalendar
+from ...core.heatmap_layers import HeatmapLayers
+from ...core.heatmap_layers import TimeSlices
+from ...core.paths import heatmap_downloads_dir
+from ...core.paths import heatmap_footprints_dir
+from ...core.paths import heatmap_layers_dir
 from ...core.raster_map import convert_to_grayscale
 from ...core.raster_map import GeoBounds
 from ...core.raster_map import get_sensible_zoom_level
 from ...core.raster_map import get_tile
 from ...core.raster_map import OSM_TILE_SIZE
 from ...core.raster_map import PixelBounds
-from ...core.tasks import work_tracker
+from ...core.rasterization import concatenate_polylines
+from ...core.rasterization import heatmap_line_width
+from ...core.rasterization import polylines_from_time_series
+from ...core.rasterization import rasterize_polylines
 from ...core.tiles import get_tile_upper_left_lat_lon
+from ...explorer.tile_visits import TileState
 from ...explorer.tile_visits import TileVisitAccessor
+from ..heatmap_download import encode_png_stream
+from ..heatmap_download import HeatmapDownloadJobs
+from ..heatmap_download import render_tile_strips
+from ..http_cache import conditional_on_data_version
 from ..search_util import search_query_from_form
 from ..search_util import SearchQueryHistory
+from ..search_util import SearchResultCache
+
+if TYPE_CHECKING:
+    from ..prerender import Prerenderer
 from .explorer_blueprint import bounding_box_for_biggest_cluster
 
 logger = logging.getLogger(__name__)
 
+# Downloads with more tiles are rendered in the background and polled for.
+ASYNC_DOWNLOAD_TILES = 64
+
+# All activities, the activities matching a filter, or the activities of a range of dates.
+HeatmapSelection = Union[None, frozenset[int], TimeSlices]
+
 
 def make_heatmap_blueprint(
     repository: ActivityRepository,
     tile_visit_accessor: TileVisitAccessor,
     config: Config,
     search_query_history: SearchQueryHistory,
+    prerenderer: "Prerenderer",
+    heatmap_counts: HeatmapCountStore,
 ) -> Blueprint:
     blueprint = Blueprint("heatmap", __name__, template_folder="templates")
 
@@ -43,6 +80,29 @@ def make_heatmap_blueprint(
     tile_evolution_states = tile_visit_accessor.tile_state["evolution_state"]
     tile_visits = tile_visit_accessor.tile_state["tile_visits"]
     activities_per_tile = tile_visit_accessor.tile_state["activities_per_tile"]
+    search_results = SearchResultCache()
+    download_executor = concurrent.futures.ThreadPoolExecutor(
+        thread_name_prefix="heatmap-download"
+    )
+    download_jobs = HeatmapDownloadJobs(heatmap_downloads_dir(), download_executor)
+    heatmap_footprints = HeatmapFootprintCache(
+        heatmap_footprints_dir(),
+        lambda activity_id, z: _rasterize_footprint(
+            activity_id, z, repository, tile_visit_accessor.tile_state
+        ),
+        tile_visit_accessor.get_activity_revision,
+    )
+    heatmap_layers = HeatmapLayers(
+        heatmap_layers_dir(), tile_visit_accessor.get_activity_revision
+    )
+    calendar: Optional[tuple[int, ActivityCalendar]] = None
+
+    def _get_calendar() -> ActivityCalendar:
+        nonlocal calendar
+        version, _ = DATA_VERSION.get()
+        if calendar is None or calendar[0] != version:
+            calendar = (version, ActivityCalendar(repository.meta))
+        return calendar[1]
 
     @blueprint.route("/")
     def index():
@@ -50,7 +110,7 @@ def make_heatmap_blueprint(
         search_query_history.register_query(query)
 
         zoom = 14
-        tiles = tile_histories[zoom]
+        tiles = tile_histories[zoom].frame
         medians = tiles[["tile_x", "tile_y"]].median(skipna=True)
         median_lat, median_lon = get_tile_upper_left_lat_lon(
             medians["tile_x"], medians["tile_y"], zoom
@@ -71,17 +131,42 @@ def make_heatmap_blueprint(
             },
             "extra_args": query.to_url_str(),
             "query": query.to_jinja(),
+            "years": _get_calendar().years,
         }
 
         return render_template("heatmap/index.html.j2", **context)
 
+    def _get_selection() -> HeatmapSelection:
+        query = search_query_from_form(request.args)
+        if not query.active:
+            return None
+        if not dataclasses.replace(query, start_begin=None, start_end=None).active:
+            return TimeSlices.from_date_range(
+                _get_calendar(), query.start_begin, query.start_end
+            )
+        return search_results.get_activity_ids(query)
+
     @blueprint.route("/tile/<int:z>/<int:x>/<int:y>.png")
+    @conditional_on_data_version
     def tile(x: int, y: int, z: int):
-        query = search_query_from_form(request.args)
+        selection = _get_selection()
+        if selection is None:
+            prerenderer.record_view(z, x, y)
         f = io.BytesIO()
         pl.imsave(
             f,
-            _render_tile_image(x, y, z, query, config, repository, activities_per_tile),
+            _render_tile_image(
+                x,
+                y,
+                z,
+                selection,
+                config,
+                repository,
+                activities_per_tile,
+                heatmap_counts,
+                heatmap_footprints,
+                heatmap_layers,
+            ),
             format="png",
         )
         return Response(
@@ -90,116 +175,226 @@ def make_heatmap_blueprint(
         )
 
     @blueprint.route(
-        "/download/<float:north>/<float:east>/<float:south>/<float:west>/heatmap.png"
+        "/download/<float(signed=True):north>/<float(signed=True):east>/<float(signed=True):south>/<float(signed=True):west>/heatmap.png"
     )
     def download(north: float, east: float, south: float, west: float):
-        query = search_query_from_form(request.args)
+        selection = _get_selection()
         geo_bounds = GeoBounds(south, west, north, east)
         tile_bounds = get_sensible_zoom_level(geo_bounds, (4000, 4000))
         pixel_bounds = PixelBounds.from_tile_bounds(tile_bounds)
 
-        background = np.zeros((*pixel_bounds.shape, 3))
-        for x in range(tile_bounds.x1, tile_bounds.x2):
-            for y in range(tile_bounds.y1, tile_bounds.y2):
-                i = y - tile_bounds.y1
-                j = x - tile_bounds.x1
-
-                background[
-                    i * OSM_TILE_SIZE : (i + 1) * OSM_TILE_SIZE,
-                    j * OSM_TILE_SIZE : (j + 1) * OSM_TILE_SIZE,
-                    :,
-                ] = _render_tile_image(
+        app = current_app._get_current_object()
+
+        def render_tile(x: int, y: int) -> np.ndarray:
+            # The tiles are rendered in worker threads, which need their own context for the database.
+            with app.app_context():
+                image = _render_tile_image(
                     x,
                     y,
                     tile_bounds.zoom,
-                    query,
+                    selection,
                     config,
                     repository,
                     activities_per_tile,
+                    heatmap_counts,
+                    heatmap_footprints,
+                    heatmap_layers,
                 )
+            return np.round(image * 255).astype(np.uint8)
+
+        if tile_bounds.width * tile_bounds.height > ASYNC_DOWNLOAD_TILES:
+            job_id = download_jobs.start(tile_bounds, render_tile)
+            return redirect(url_for(".download_job", job_id=job_id))
 
-        f = io.BytesIO()
-        pl.imsave(f, background, format="png")
         return Response(
-            bytes(f.getbuffer()),
+            encode_png_stream(
+                render_tile_strips(tile_bounds, render_tile, download_executor),
+                pixel_bounds.width,
+                pixel_bounds.height,
+            ),
             mimetype="image/png",
             headers={"Content-disposition": 'attachment; filename="heatmap.png"'},
         )
 
+    @blueprint.route("/download-job/<job_id>")
+    def download_job(job_id: str):
+        progress = download_jobs.get_progress(job_id)
+        if progress is None:
+            abort(404)
+        return render_template(
+            "heatmap/download_job.html.j2",
+            job_id=job_id,
+            progress=progress,
+            ready=download_jobs.is_ready(job_id),
+            failed=download_jobs.is_failed(job_id),
+        )
+
+    @blueprint.route("/download-job/<job_id>/heatmap.png")
+    def download_job_image(job_id: str):
+        if not download_jobs.is_ready(job_id):
+            abort(404)
+        return send_file(
+            download_jobs.get_path(job_id).resolve(),
+            mimetype="image/png",
+            as_attachment=True,
+            download_name="heatmap.png",
+        )
+
     return blueprint
 
 
+def prerender_heatmap_tile(
+    x: int,
+    y: int,
+    z: int,
+    repository: ActivityRepository,
+    activities_per_tile: dict[int, dict[tuple[int, int], set[int]]],
+    heatmap_counts: HeatmapCountStore,
+) -> None:
+    """
+    Brings the cached counts of an unfiltered heatmap tile up to date.
+    """
+    _get_pyramid_counts(x, y, z, repository, activities_per_tile, heatmap_counts)
+
+
 def _get_counts(
     x: int,
     y: int,
     z: int,
-    query: SearchQuery,
+    selection: HeatmapSelection,
     repository: ActivityRepository,
     activities_per_tile: dict[int, dict[tuple[int, int], set[int]]],
+    heatmap_counts: HeatmapCountStore,
+    heatmap_footprints: HeatmapFootprintCache,
+    heatmap_layers: HeatmapLayers,
 ) -> np.ndarray:
-    tile_pixels = (OSM_TILE_SIZE, OSM_TILE_SIZE)
-    tile_counts = np.zeros(tile_pixels, dtype=np.int32)
-    if not query.active:
-        tile_count_cache_path = pathlib.Path(f"Cache/Heatmap/{z}/{x}/{y}.npy")
-        if tile_count_cache_path.exists():
-            try:
-                tile_counts = np.load(tile_count_cache_path)
-            except ValueError:
-                logger.warning(
-                    f"Heatmap count file {tile_count_cache_path} is corrupted, deleting."
-                )
-                tile_count_cache_path.unlink()
-                tile_counts = np.zeros(tile_pixels, dtype=np.int32)
-        tile_count_cache_path.parent.mkdir(parents=True, exist_ok=True)
-        activity_ids = activities_per_tile[z].get((x, y), set())
-
-        with work_tracker(
-            tile_count_cache_path.with_suffix(".json")
-        ) as parsed_activities:
-            if parsed_activities - activity_ids:
-                logger.warning(
-                    f"Resetting heatmap cache for {x=}/{y=}/{z=} because activities have been removed."
-                )
-                tile_counts = np.zeros(tile_pixels, dtype=np.int32)
-                parsed_activities.clear()
-            for activity_id in list(activity_ids):
-                if activity_id in parsed_activities:
-                    continue
-                parsed_activities.add(activity_id)
-                time_series = repository.get_time_series(activity_id)
-                for _, group in time_series.groupby("segment_id"):
-                    xy_pixels = (
-                        np.array([group["x"] * 2**z - x, group["y"] * 2**z - y]).T
-                        * OSM_TILE_SIZE
+    """
+    Counts of a tile with all activities, only the activities matching a filter or the activities of a range of dates.
+
+    A range of dates is summed up from the stored layers of its whole years and months, only the activities of the remaining days are added from their footprints. The layers are summed up from footprints as well and are only stored for the requested tiles.
+    """
+    if selection is None:
+        return _get_pyramid_counts(
+            x, y, z, repository, activities_per_tile, heatmap_counts
+        )
+    tile_activity_ids = activities_per_tile[z].get((x, y), set())
+    if isinstance(selection, TimeSlices):
+        counts = heatmap_footprints.get_counts(
+            x, y, z, tile_activity_ids & selection.remainder
+        )
+        for name, layer_activity_ids in selection.layers:
+            if not tile_activity_ids & layer_activity_ids:
+                continue
+            counts += heatmap_layers.get_store(name).get_counts(
+                x,
+                y,
+                z,
+                tile_activity_ids & layer_activity_ids,
+                lambda new_ids: heatmap_footprints.get_counts(x, y, z, new_ids),
+            )
+        return counts
+    return heatmap_footprints.get_counts(x, y, z, tile_activity_ids & selection)
+
+
+def _get_pyramid_counts(
+    x: int,
+    y: int,
+    z: int,
+    repository: ActivityRepository,
+    activities_per_tile: dict[int, dict[tuple[int, int], set[int]]],
+    heatmap_counts: HeatmapCountStore,
+) -> np.ndarray:
+    """
+    Counts of all activities, rasterized at the rasterized zoom levels of the pyramid and summed up from the children in between.
+    """
+    activity_ids = set(activities_per_tile[z].get((x, y), set()))
+    if is_rasterized_zoom(z):
+        return heatmap_counts.get_counts(
+            x,
+            y,
+            z,
+            activity_ids,
+            lambda new_ids: _rasterize_activities(x, y, z, new_ids, repository),
+        )
+    return heatmap_counts.get_derived_counts(
+        x,
+        y,
+        z,
+        activity_ids,
+        lambda: downsample_counts(
+            [
+                [
+                    _get_pyramid_counts(
+                        2 * x + dx,
+                        2 * y + dy,
+                        z + 1,
+                        repository,
+                        activities_per_tile,
+                        heatmap_counts,
                     )
-                    im = Image.new("L", tile_pixels)
-                    draw = ImageDraw.Draw(im)
-                    pixels = list(map(int, xy_pixels.flatten()))
-                    draw.line(pixels, fill=1, width=max(3, 6 * (z - 17)))
-                    aim = np.array(im)
-                    tile_counts += aim
-        tmp_path = tile_count_cache_path.with_suffix(".tmp.npy")
-        np.save(tmp_path, tile_counts)
-        tile_count_cache_path.unlink(missing_ok=True)
-        tmp_path.rename(tile_count_cache_path)
+                    for dx in range(2)
+                ]
+                for dy in range(2)
+            ]
+        ),
+    )
+
+
+def _rasterize_activities(
+    x: int,
+    y: int,
+    z: int,
+    activity_ids: Iterable[int],
+    repository: ActivityRepository,
+) -> np.ndarray:
+    xy, offsets = concatenate_polylines(
+        [
+            polylines_from_time_series(repository.get_time_series(activity_id))
+            for activity_id in activity_ids
+        ]
+    )
+    return _draw_polylines(xy, offsets, x, y, z)
+
+
+def _rasterize_footprint(
+    activity_id: int,
+    z: int,
+    repository: ActivityRepository,
+    tile_state: TileState,
+) -> dict[tuple[int, int], np.ndarray]:
+    """
+    Counts of a single activity in all the map tiles that it touches.
+    """
+    tiles_per_activity = tile_state["tiles_per_activity"].get(activity_id, None)
+    if tiles_per_activity is not None:
+        at_zoom = tiles_per_activity.loc[tiles_per_activity["zoom"] == z]
+        tiles = set(
+            zip(
+                at_zoom["tile_x"].astype(int).tolist(),
+                at_zoom["tile_y"].astype(int).tolist(),
+            )
+        )
     else:
-        activities = apply_search_query(query)
-        activity_ids = activities_per_tile[z].get((x, y), set())
-        for activity_id in activity_ids:
-            if activity_id not in activities["id"]:
-                continue
-            time_series = repository.get_time_series(activity_id)
-            for _, group in time_series.groupby("segment_id"):
-                xy_pixels = (
-                    np.array([group["x"] * 2**z - x, group["y"] * 2**z - y]).T
-                    * OSM_TILE_SIZE
-                )
-                im = Image.new("L", tile_pixels)
-                draw = ImageDraw.Draw(im)
-                pixels = list(map(int, xy_pixels.flatten()))
-                draw.line(pixels, fill=1, width=max(3, 6 * (z - 17)))
-                aim = np.array(im)
-                tile_counts += aim
+        # The activity predates the reverse index.
+        tiles = {
+            tile
+            for tile, activity_ids in tile_state["activities_per_tile"][z].items()
+            if activity_id in activity_ids
+        }
+    xy, offsets = polylines_from_time_series(repository.get_time_series(activity_id))
+    return {tile: _draw_polylines(xy, offsets, *tile, z) for tile in tiles}
+
+
+def _draw_polylines(
+    xy: np.ndarray, offsets: np.ndarray, x: int, y: int, z: int
+) -> np.ndarray:
+    tile_counts = np.zeros((OSM_TILE_SIZE, OSM_TILE_SIZE), dtype=np.int32)
+    rasterize_polylines(
+        tile_counts,
+        (xy * 2**z - (x, y)) * OSM_TILE_SIZE,
+        offsets,
+        heatmap_line_width(z),
+    )
     return tile_counts
 
 
@@ -207,14 +402,27 @@ def _render_tile_image(
     x: int,
     y: int,
     z: int,
-    query: SearchQuery,
+    selection: HeatmapSelection,
     config: Config,
     repository: ActivityRepository,
     activities_per_tile: dict[int, dict[tuple[int, int], set[int]]],
+    heatmap_counts: HeatmapCountStore,
+    heatmap_footprints: HeatmapFootprintCache,
+    heatmap_layers: HeatmapLayers,
 ) -> np.ndarray:
     tile_pixels = (OSM_TILE_SIZE, OSM_TILE_SIZE)
     tile_counts = np.zeros(tile_pixels)
-    tile_counts += _get_counts(x, y, z, query, repository, activities_per_tile)
+    tile_counts += _get_counts(
+        x,
+        y,
+        z,
+        selection,
+        repository,
+        activities_per_tile,
+        heatmap_counts,
+        heatmap_footprints,
+        heatmap_layers,
+    )
 
     tile_counts = np.sqrt(tile_counts) / 5
     tile_counts[tile_counts > 1.0] = 1.0
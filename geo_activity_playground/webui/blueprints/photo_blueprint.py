@@ -24,6 +24,7 @@ from ..authenticator import Authenticator
 from ..authenticator import needs_authentication
 from ..flasher import Flasher
 from ..flasher import FlashTypes
+from ..http_cache import conditional_on_data_version
 
 
 def make_photo_blueprint(
@@ -32,6 +33,7 @@ def make_photo_blueprint(
     blueprint = Blueprint("photo", __name__, template_folder="templates")
 
     @blueprint.route("/get/<int:id>/<int:size>.webp")
+    @conditional_on_data_version
     def get(id: int, size: int) -> Response:
         assert size < 5000
         photo = DB.session.get_one(Photo, id)
@@ -55,6 +57,7 @@ def make_photo_blueprint(
         return render_template("photo/map.html.j2")
 
     @blueprint.route("/map-for-all/photos.geojson")
+    @conditional_on_data_version
     def map_for_all() -> Response:
         photos = DB.session.scalars(sqlalchemy.select(Photo)).all()
         fc = geojson.FeatureCollection(
@@ -77,6 +80,7 @@ def make_photo_blueprint(
         )
 
     @blueprint.route("/map-for-activity/<int:activity_id>/photos.geojson")
+    @conditional_on_data_version
     def map_for_activity(activity_id: int) -> Response:
         activity = DB.session.get_one(Activity, activity_id)
         fc = geojson.FeatureCollection(
@@ -22,6 +22,9 @@ from ...core.datamodel import Kind
 from ...core.datamodel import Tag
 from ...core.enrichment import update_and_commit
 from ...core.heart_rate import HeartRateZoneComputer
+from ...core.raster_map import DECODED_TILE_CACHE
+from ...core.raster_map import TILE_FETCHER
+from ...core.tile_archives import archive_path
 from ..authenticator import Authenticator
 from ..authenticator import needs_authentication
 from ..flasher import Flasher
@@ -444,13 +447,23 @@ def make_settings_blueprint(
             config_accessor().map_tile_attribution = request.form[
                 "map_tile_attribution"
             ]
+            config_accessor().map_tile_cache_max_mb = int(
+                request.form["map_tile_cache_max_mb"]
+            )
+            TILE_FETCHER.max_bytes = config_accessor().map_tile_cache_max_mb * 10**6
             config_accessor.save()
             flasher.flash_message("Tile source updated.", FlashTypes.SUCCESS)
         return render_template(
             "settings/tile-source.html.j2",
             map_tile_url=config_accessor().map_tile_url,
             map_tile_attribution=config_accessor().map_tile_attribution,
-            test_url=config_accessor().map_tile_url.format(zoom=14, x=8514, y=5504),
+            map_tile_cache_max_mb=config_accessor().map_tile_cache_max_mb,
+            tile_cache_stats=DECODED_TILE_CACHE.stats(),
+            test_url=(
+                url_for("tile.tile", scheme="color", z=14, x=8514, y=5504)
+                if archive_path(config_accessor().map_tile_url)
+                else config_accessor().map_tile_url.format(zoom=14, x=8514, y=5504)
+            ),
         )
 
     return blueprint
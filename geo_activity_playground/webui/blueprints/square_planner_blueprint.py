@@ -1,3 +1,5 @@
+from collections.abc import Iterable
+
 import geojson
 import sqlalchemy
 from flask import Blueprint
@@ -14,7 +16,14 @@ from ...explorer.grid_file import make_explorer_tile
 from ...explorer.grid_file import make_grid_file_geojson
 from ...explorer.grid_file import make_grid_file_gpx
 from ...explorer.grid_file import make_grid_points
+from ...explorer.grid_file import make_outline_feature_collection
+from ...explorer.grid_file import make_outline_file_geojson
+from ...explorer.grid_file import make_outline_file_gpx
+from ...explorer.grid_file import make_outline_polygons
+from ...explorer.tile_visits import get_visited_tiles
+from ...explorer.tile_visits import TileEvolutionState
 from ...explorer.tile_visits import TileVisitAccessor
+from ..http_cache import conditional_on_data_version
 
 
 def make_square_planner_blueprint(tile_visit_accessor: TileVisitAccessor) -> Blueprint:
@@ -24,7 +33,9 @@ def make_square_planner_blueprint(tile_visit_accessor: TileVisitAccessor) -> Blu
 
     @blueprint.route("/<int:zoom>")
     def landing(zoom: int):
-        explored = tile_visit_accessor.tile_state["evolution_state"][zoom]
+        explored = tile_visit_accessor.tile_state["evolution_state"].get(
+            zoom, TileEvolutionState()
+        )
         return redirect(
             url_for(
                 "square_planner.index",
@@ -51,6 +62,7 @@ def make_square_planner_blueprint(tile_visit_accessor: TileVisitAccessor) -> Blu
             )
         )
 
+        visited_tiles = get_visited_tiles(tile_visit_accessor.tile_state, zoom)
         missing_geojson = geojson.dumps(
             geojson.FeatureCollection(
                 features=[
@@ -60,16 +72,18 @@ def make_square_planner_blueprint(tile_visit_accessor: TileVisitAccessor) -> Blu
                         {},
                         zoom,
                     )
-                    for tile_x in range(x, x + size)
-                    for tile_y in range(y, y + size)
-                    if (tile_x, tile_y) not in set(tile_visits[zoom].keys())
+                    for tile_x, tile_y in visited_tiles.missing(
+                        x, y, x + size, y + size
+                    )
                 ]
             )
         )
 
         return render_template(
             "square_planner/index.html.j2",
-            explored_geojson=_get_explored_geojson(tile_visits[zoom].keys(), zoom),
+            explored_geojson=_get_explored_geojson(
+                tile_visits.get(zoom, {}).keys(), zoom
+            ),
             missing_geojson=missing_geojson,
             square_geojson=square_geojson,
             zoom=zoom,
@@ -82,22 +96,26 @@ def make_square_planner_blueprint(tile_visit_accessor: TileVisitAccessor) -> Blu
         )
 
     @blueprint.route("/<int:zoom>/<int:x>/<int:y>/<int:size>/missing.<suffix>")
+    @conditional_on_data_version
     def square_planner_missing(zoom: int, x: int, y: int, size: int, suffix: str):
-        points = make_grid_points(
-            (
-                (tile_x, tile_y)
-                for tile_x in range(x, x + size)
-                for tile_y in range(y, y + size)
-                if (tile_x, tile_y) not in set(tile_visits[zoom].keys())
-            ),
-            zoom,
-        )
-        if suffix == "geojson":
-            response = make_grid_file_geojson(points)
-        elif suffix == "gpx":
-            response = make_grid_file_gpx(points)
+        visited_tiles = get_visited_tiles(tile_visit_accessor.tile_state, zoom)
+        missing = visited_tiles.missing(x, y, x + size, y + size)
+        if request.args.get("mode", "tiles") == "merged":
+            polygons = make_outline_polygons(missing, zoom)
+            if suffix == "geojson":
+                response = make_outline_file_geojson(polygons)
+            elif suffix == "gpx":
+                response = make_outline_file_gpx(polygons)
+            else:
+                raise RuntimeError(f"Unsupported suffix {suffix}.")
         else:
-            raise RuntimeError(f"Unsupported suffix {suffix}.")
+            points = make_grid_points(missing, zoom)
+            if suffix == "geojson":
+                response = make_grid_file_geojson(points)
+            elif suffix == "gpx":
+                response = make_grid_file_gpx(points)
+            else:
+                raise RuntimeError(f"Unsupported suffix {suffix}.")
 
         mimetypes = {"geojson": "application/json", "gpx": "application/xml"}
         return Response(
@@ -127,17 +145,7 @@ def make_square_planner_blueprint(tile_visit_accessor: TileVisitAccessor) -> Blu
     return blueprint
 
 
-def _get_explored_geojson(tile_visits: list[tuple[int, int]], zoom: int) -> str:
+def _get_explored_geojson(tile_visits: Iterable[tuple[int, int]], zoom: int) -> str:
     return geojson.dumps(
-        geojson.FeatureCollection(
-            features=[
-                make_explorer_tile(
-                    tile_x,
-                    tile_y,
-                    {},
-                    zoom,
-                )
-                for tile_x, tile_y in tile_visits
-            ]
-        )
+        make_outline_feature_collection(make_outline_polygons(tile_visits, zoom))
     )
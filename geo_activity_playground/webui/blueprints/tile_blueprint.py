@@ -1,13 +1,14 @@
-import io
-
-import matplotlib.pyplot as pl
-import numpy as np
+from flask import abort
 from flask import Blueprint
 from flask import Response
+from flask import send_file
 
 from ...core.raster_map import ImageTransform
 from ...core.raster_map import TileGetter
 
+# Browsers use a tile for this long before they revalidate it.
+TILE_MAX_AGE = 3600
+
 
 def make_tile_blueprint(
     image_transforms: dict[str, ImageTransform],
@@ -18,10 +19,11 @@ def make_tile_blueprint(
 
     @blueprint.route("/<scheme>/<int:z>/<int:x>/<int:y>.png")
     def tile(scheme: str, z: int, x: int, y: int) -> Response:
-        map_tile = np.array(tile_getter.get_tile(z, x, y)) / 255
-        transformed_tile = image_transforms[scheme].transform_image(map_tile)
-        f = io.BytesIO()
-        pl.imsave(f, transformed_tile, format="png")
-        return Response(bytes(f.getbuffer()), mimetype="image/png")
+        if scheme not in image_transforms:
+            abort(404)
+        path = tile_getter.get_transformed_tile_path(
+            z, x, y, scheme, image_transforms[scheme]
+        )
+        return send_file(path.resolve(), mimetype="image/png", max_age=TILE_MAX_AGE)
 
     return blueprint
@@ -62,8 +62,9 @@ def make_time_zone_fixer_blueprint(
     def truncate_activities():
         DB.session.query(Activity).delete()
         DB.session.commit()
-        tile_visit_accessor.reset()
-        tile_visit_accessor.save()
+        with tile_visit_accessor.lock:
+            tile_visit_accessor.reset()
+            tile_visit_accessor.save()
         return redirect(url_for("upload.reload"))
 
     return blueprint
@@ -15,9 +15,8 @@ from ...core.activities import ActivityRepository
 from ...core.config import Config
 from ...core.datamodel import Activity
 from ...core.datamodel import DB
-from ...explorer.tile_visits import compute_tile_evolution
-from ...explorer.tile_visits import compute_tile_visits_new
 from ...explorer.tile_visits import TileVisitAccessor
+from ...explorer.tile_visits import update_tile_state
 from ...importers.directory import import_from_directory
 from ...importers.strava_api import import_from_strava_api
 from ...importers.strava_checkout import import_from_strava_checkout
@@ -25,6 +24,7 @@ from ..authenticator import Authenticator
 from ..authenticator import needs_authentication
 from ..flasher import Flasher
 from ..flasher import FlashTypes
+from ..prerender import Prerenderer
 
 
 def make_upload_blueprint(
@@ -33,6 +33,7 @@ def make_upload_blueprint(
     config: Config,
     authenticator: Authenticator,
     flasher: Flasher,
+    prerenderer: Optional[Prerenderer] = None,
 ) -> Blueprint:
     blueprint = Blueprint("upload", __name__, template_folder="templates")
 
@@ -86,6 +87,7 @@ def make_upload_blueprint(
             tile_visit_accessor,
             config,
             skip_strava=True,
+            prerenderer=prerenderer,
         )
         latest_activity = DB.session.scalar(
             sqlalchemy.select(Activity).order_by(Activity.id.desc()).limit(1)
@@ -107,6 +109,7 @@ def make_upload_blueprint(
             tile_visit_accessor,
             config,
             skip_strava=True,
+            prerenderer=prerenderer,
         )
         flash("Scanned for new activities.", category="success")
         return redirect(url_for("index"))
@@ -121,17 +124,23 @@ def scan_for_activities(
     strava_begin: Optional[str] = None,
     strava_end: Optional[str] = None,
     skip_strava: bool = False,
+    prerenderer: Optional[Prerenderer] = None,
 ) -> None:
-    if pathlib.Path("Activities").exists():
-        import_from_directory(repository, tile_visit_accessor, config)
-    if pathlib.Path("Strava Export").exists():
-        import_from_strava_checkout(config)
-    if config.strava_client_code and not skip_strava:
-        import_from_strava_api(
-            config, repository, tile_visit_accessor, strava_begin, strava_end
-        )
+    snapshot = prerenderer.snapshot() if prerenderer is not None else None
+
+    try:
+        if pathlib.Path("Activities").exists():
+            import_from_directory(repository, tile_visit_accessor, config)
+        if pathlib.Path("Strava Export").exists():
+            import_from_strava_checkout(config)
+        if config.strava_client_code and not skip_strava:
+            import_from_strava_api(
+                config, repository, tile_visit_accessor, strava_begin, strava_end
+            )
 
-    if len(repository) > 0:
-        compute_tile_visits_new(repository, tile_visit_accessor)
-        compute_tile_evolution(tile_visit_accessor.tile_state, config)
-        tile_visit_accessor.save()
+        if len(repository) > 0:
+            update_tile_state(repository, tile_visit_accessor, config)
+    finally:
+        # Also after a failed import, such that the cached explorer tiles are compared.
+        if prerenderer is not None and snapshot is not None:
+            prerenderer.schedule(snapshot)
@@ -0,0 +1,169 @@
+import collections
+import concurrent.futures
+import logging
+import pathlib
+import queue
+import shutil
+import struct
+import threading
+import uuid
+import zlib
+from collections.abc import Callable
+from collections.abc import Iterable
+from collections.abc import Iterator
+from typing import Optional
+
+import numpy as np
+
+from ..core.paths import atomic_open
+from ..core.raster_map import OSM_TILE_SIZE
+from ..core.raster_map import TileBounds
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def encode_png_stream(
+    strips: Iterable[np.ndarray], width: int, height: int
+) -> Iterator[bytes]:
+    """
+    Encodes an RGBA image, given as horizontal strips of rows, as PNG and yields the bytes of every strip as soon as it is compressed.
+    """
+    yield PNG_SIGNATURE
+    yield _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+    compressor = zlib.compressobj()
+    for strip in strips:
+        # Every row starts with the filter type, zero means no filter.
+        rows = np.zeros((strip.shape[0], width * 4 + 1), dtype=np.uint8)
+        rows[:, 1:] = strip.reshape(strip.shape[0], -1)
+        data = compressor.compress(rows.tobytes()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield _png_chunk(b"IDAT", data)
+    yield _png_chunk(b"IDAT", compressor.flush())
+    yield _png_chunk(b"IEND", b"")
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def render_tile_strips(
+    tile_bounds: TileBounds,
+    render_tile: Callable[[int, int], np.ndarray],
+    executor: concurrent.futures.Executor,
+    lookahead: int = 2,
+) -> Iterator[np.ndarray]:
+    """
+    Renders the tiles in parallel and yields every row of tiles as one strip of pixels, from top to bottom.
+
+    `render_tile` is called with the tile x and y and returns an RGBA tile with 8 bits per channel. Only the rows up to `lookahead` ahead of the one that is being yielded are rendered, such that the memory stays bounded for large areas.
+    """
+    columns = range(int(tile_bounds.x1), int(tile_bounds.x2))
+    rows = collections.deque(range(int(tile_bounds.y1), int(tile_bounds.y2)))
+    pending: collections.deque[list[concurrent.futures.Future]] = collections.deque()
+    while rows or pending:
+        while rows and len(pending) <= lookahead:
+            y = rows.popleft()
+            pending.append([executor.submit(render_tile, x, y) for x in columns])
+        yield np.concatenate([future.result() for future in pending.popleft()], axis=1)
+
+
+class HeatmapDownloadJobs:
+    """
+    Renders heatmap downloads of large areas in the background, such that the browser can poll for the result instead of waiting for one long request.
+
+    The finished images are kept on disk until more than `MAX_JOBS` jobs have been started.
+    """
+
+    MAX_JOBS = 8
+
+    def __init__(
+        self, base_dir: pathlib.Path, executor: concurrent.futures.Executor
+    ) -> None:
+        self.base_dir = base_dir
+        self.executor = executor
+        # Images from before a restart cannot be polled for anymore.
+        shutil.rmtree(base_dir, ignore_errors=True)
+        self._progress: collections.OrderedDict[str, tuple[int, int]] = (
+            collections.OrderedDict()
+        )
+        self._failed: set[str] = set()
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[
+            tuple[str, TileBounds, Callable[[int, int], np.ndarray]]
+        ] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(
+        self, tile_bounds: TileBounds, render_tile: Callable[[int, int], np.ndarray]
+    ) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._progress[job_id] = (0, int(tile_bounds.height))
+            while len(self._progress) > self.MAX_JOBS:
+                old_job_id, _ = self._progress.popitem(last=False)
+                self._failed.discard(old_job_id)
+                self.get_path(old_job_id).unlink(missing_ok=True)
+        self._queue.put((job_id, tile_bounds, render_tile))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+        return job_id
+
+    def get_progress(self, job_id: str) -> Optional[tuple[int, int]]:
+        """
+        Number of rendered tile rows and the total number of tile rows, or `None` for an unknown job.
+        """
+        with self._lock:
+            return self._progress.get(job_id, None)
+
+    def is_ready(self, job_id: str) -> bool:
+        return self.get_progress(job_id) is not None and self.get_path(job_id).exists()
+
+    def is_failed(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._failed
+
+    def get_path(self, job_id: str) -> pathlib.Path:
+        return self.base_dir / f"{job_id}.png"
+
+    def run(
+        self,
+        job_id: str,
+        tile_bounds: TileBounds,
+        render_tile: Callable[[int, int], np.ndarray],
+    ) -> None:
+        strips = render_tile_strips(tile_bounds, render_tile, self.executor)
+        width = int(tile_bounds.width) * OSM_TILE_SIZE
+        height = int(tile_bounds.height) * OSM_TILE_SIZE
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_open(self.get_path(job_id), "wb") as f:
+            for data in encode_png_stream(
+                self._count_strips(job_id, strips), width, height
+            ):
+                f.write(data)
+
+    def _count_strips(
+        self, job_id: str, strips: Iterator[np.ndarray]
+    ) -> Iterator[np.ndarray]:
+        for strip in strips:
+            yield strip
+            with self._lock:
+                if job_id in self._progress:
+                    done, total = self._progress[job_id]
+                    self._progress[job_id] = (done + 1, total)
+
+    def _work(self) -> None:
+        while True:
+            job_id, tile_bounds, render_tile = self._queue.get()
+            try:
+                self.run(job_id, tile_bounds, render_tile)
+            except Exception:
+                logger.exception(f"Rendering the heatmap download {job_id} has failed.")
+                with self._lock:
+                    self._failed.add(job_id)
@@ -0,0 +1,43 @@
+import datetime
+import functools
+import hashlib
+
+from flask import make_response
+from flask import request
+from flask import Response
+from flask.typing import RouteCallable
+from werkzeug.http import is_resource_modified
+
+from ..core.data_version import DATA_VERSION
+
+
+def conditional_on_data_version(route: RouteCallable) -> RouteCallable:
+    """
+    Lets browsers revalidate the responses of a route with an ETag and a Last-Modified date that follow the data version.
+
+    The ETag covers the data version together with the path and the query string, such that a request with a matching `If-None-Match` gets a 304 before the route renders anything.
+    """
+
+    @functools.wraps(route)
+    def wrapped_route(*args, **kwargs):
+        version, modified = DATA_VERSION.get()
+        etag = hashlib.sha1(
+            f"{version}/{modified}/{request.full_path}".encode()
+        ).hexdigest()
+        last_modified = datetime.datetime.fromtimestamp(
+            int(modified), datetime.timezone.utc
+        )
+        if not is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified
+        ):
+            response = Response(status=304)
+        else:
+            response = make_response(route(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapped_route
@@ -0,0 +1,244 @@
+import collections
+import contextlib
+import dataclasses
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+import pandas as pd
+from flask import Flask
+
+from ..core.activities import ActivityRepository
+from ..core.config import ConfigAccessor
+from ..core.heatmap_counts import HeatmapCountStore
+from ..core.paths import cache_dir
+from ..core.tasks import get_state
+from ..core.tasks import set_state
+from ..explorer.tile_rendering import changed_tiles
+from ..explorer.tile_rendering import ExplorerTileRenderer
+from ..explorer.tile_rendering import ExplorerTileTable
+from ..explorer.tile_rendering import square_outline_tiles
+from ..explorer.tile_visits import TileVisitAccessor
+from .blueprints.heatmap_blueprint import prerender_heatmap_tile
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class PrerenderSnapshot:
+    """
+    The parts of the tile state before an import that are needed to find out what has changed.
+    """
+
+    activity_ids: set[int]
+    tables: dict[int, ExplorerTileTable]
+    squares: dict[int, tuple[Optional[int], Optional[int], int]]
+
+
+class Prerenderer:
+    """
+    Renders explorer and heatmap tiles in the background after an import.
+
+    Only the map tiles that show tiles of the new activities or tiles whose color has changed otherwise get rendered again. Afterwards the map tiles of the most viewed areas are warmed up, such that the first visitor after an import doesn't have to wait.
+
+    Comparing colors needs the explorer tiles from before the import. The snapshot only takes them if they are already in memory from rendering tiles. Otherwise all cached tiles of that zoom level are dropped after the import, which avoids building them just in case. The cached tiles of the zoom levels in the snapshot are kept until they have been compared, every snapshot therefore needs to be passed to `schedule`.
+    """
+
+    # Views are counted per map tile at this zoom level.
+    AREA_ZOOM = 10
+    NUM_WARM_AREAS = 3
+    # View counts are written to disk at most this often, in seconds.
+    VIEW_COUNTS_SAVE_INTERVAL = 60
+
+    def __init__(
+        self,
+        repository: ActivityRepository,
+        tile_visit_accessor: TileVisitAccessor,
+        config_accessor: ConfigAccessor,
+        explorer_tile_renderer: ExplorerTileRenderer,
+        heatmap_counts: HeatmapCountStore,
+        app: Optional[Flask] = None,
+    ) -> None:
+        """
+        `app` provides the application context in which the time series are read from the database.
+        """
+        self.repository = repository
+        self.tile_visit_accessor = tile_visit_accessor
+        self.config_accessor = config_accessor
+        self.explorer_tile_renderer = explorer_tile_renderer
+        self.heatmap_counts = heatmap_counts
+        self.app = app
+        self._view_counts_path = cache_dir() / "prerender-view-counts.json"
+        self._view_counts = collections.Counter(get_state(self._view_counts_path, {}))
+        self._view_lock = threading.Lock()
+        self._view_counts_saved = time.monotonic()
+        self._queue: queue.Queue[PrerenderSnapshot] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def record_view(self, z: int, x: int, y: int) -> None:
+        if z < self.AREA_ZOOM:
+            return
+        shift = z - self.AREA_ZOOM
+        with self._view_lock:
+            self._view_counts[f"{x >> shift}/{y >> shift}"] += 1
+            now = time.monotonic()
+            if now - self._view_counts_saved >= self.VIEW_COUNTS_SAVE_INTERVAL:
+                self._save_view_counts()
+
+    def _save_view_counts(self) -> None:
+        # Needs to be called with the view lock held.
+        set_state(self._view_counts_path, dict(self._view_counts))
+        self._view_counts_saved = time.monotonic()
+
+    def snapshot(self) -> PrerenderSnapshot:
+        tile_state = self.tile_visit_accessor.tile_state
+        tables = {}
+        squares = {}
+        for zoom in self.config_accessor().explorer_zoom_levels:
+            table = self.explorer_tile_renderer.get_cached_table(zoom)
+            if table is not None:
+                tables[zoom] = table
+                self.explorer_tile_renderer.expect_invalidation(zoom)
+            evolution_state = tile_state["evolution_state"][zoom]
+            squares[zoom] = (
+                evolution_state.square_x,
+                evolution_state.square_y,
+                evolution_state.max_square_size,
+            )
+        return PrerenderSnapshot(
+            activity_ids=set(tile_state["tiles_per_activity"]),
+            tables=tables,
+            squares=squares,
+        )
+
+    def schedule(self, snapshot: PrerenderSnapshot) -> None:
+        self._queue.put(snapshot)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+    def run(self, snapshot: PrerenderSnapshot) -> None:
+        config = self.config_accessor()
+        tile_state = self.tile_visit_accessor.tile_state
+        new_activity_ids = set(tile_state["tiles_per_activity"]) - snapshot.activity_ids
+        footprints = pd.concat(
+            [
+                tile_state["tiles_per_activity"][activity_id]
+                for activity_id in new_activity_ids
+            ]
+            or [pd.DataFrame({"zoom": [], "tile_x": [], "tile_y": []})]
+        )
+        logger.info(f"Prerendering tiles for {len(new_activity_ids)} new activities …")
+
+        try:
+            self._prerender_explorer_tiles(snapshot, footprints)
+        finally:
+            for zoom in snapshot.tables:
+                self.explorer_tile_renderer.end_invalidation(zoom)
+
+        for z in config.prerender_zoom_levels:
+            for x, y in _footprint_tiles(footprints, z):
+                prerender_heatmap_tile(
+                    x,
+                    y,
+                    z,
+                    self.repository,
+                    tile_state["activities_per_tile"],
+                    self.heatmap_counts,
+                )
+
+        self.warm_up()
+
+    def _prerender_explorer_tiles(
+        self, snapshot: PrerenderSnapshot, footprints: pd.DataFrame
+    ) -> None:
+        config = self.config_accessor()
+        tile_state = self.tile_visit_accessor.tile_state
+        for zoom in config.explorer_zoom_levels:
+            dirty = _footprint_tiles(footprints, zoom)
+            old_table = snapshot.tables.get(zoom, None)
+            if old_table is None:
+                # The zoom level is new or its tiles were not in memory, the cached tiles get dropped as a whole.
+                continue
+            dirty |= changed_tiles(
+                old_table, self.explorer_tile_renderer.get_table(zoom)
+            )
+            evolution_state = tile_state["evolution_state"][zoom]
+            new_square = (
+                evolution_state.square_x,
+                evolution_state.square_y,
+                evolution_state.max_square_size,
+            )
+            if snapshot.squares[zoom] != new_square:
+                dirty |= square_outline_tiles(*snapshot.squares[zoom])
+                dirty |= square_outline_tiles(*new_square)
+            self.explorer_tile_renderer.invalidate(zoom, dirty)
+            for z in config.prerender_zoom_levels:
+                if z > zoom:
+                    continue
+                for x, y in {(tx >> (zoom - z), ty >> (zoom - z)) for tx, ty in dirty}:
+                    self.explorer_tile_renderer.get_tile_path(
+                        zoom, config.cluster_color_strategy, z, x, y
+                    )
+
+    def warm_up(self) -> None:
+        config = self.config_accessor()
+        with self._view_lock:
+            areas = [
+                area for area, _ in self._view_counts.most_common(self.NUM_WARM_AREAS)
+            ]
+            self._save_view_counts()
+        for area in areas:
+            area_x, area_y = map(int, area.split("/"))
+            for z in config.prerender_zoom_levels:
+                for x, y in _map_tiles_in_area(area_x, area_y, self.AREA_ZOOM, z):
+                    for zoom in config.explorer_zoom_levels:
+                        self.explorer_tile_renderer.get_tile_path(
+                            zoom, config.cluster_color_strategy, z, x, y
+                        )
+                    prerender_heatmap_tile(
+                        x,
+                        y,
+                        z,
+                        self.repository,
+                        self.tile_visit_accessor.tile_state["activities_per_tile"],
+                        self.heatmap_counts,
+                    )
+
+    def _work(self) -> None:
+        while True:
+            snapshot = self._queue.get()
+            try:
+                with (
+                    self.app.app_context()
+                    if self.app is not None
+                    else contextlib.nullcontext()
+                ):
+                    self.run(snapshot)
+            except Exception:
+                logger.exception("Prerendering tiles has failed.")
+
+
+def _footprint_tiles(footprints: pd.DataFrame, zoom: int) -> set[tuple[int, int]]:
+    selection = footprints.loc[footprints["zoom"] == zoom]
+    return set(
+        zip(
+            selection["tile_x"].astype(int).tolist(),
+            selection["tile_y"].astype(int).tolist(),
+        )
+    )
+
+
+def _map_tiles_in_area(
+    area_x: int, area_y: int, area_zoom: int, z: int
+) -> list[tuple[int, int]]:
+    if z <= area_zoom:
+        return [(area_x >> (area_zoom - z), area_y >> (area_zoom - z))]
+    factor = 2 ** (z - area_zoom)
+    return [
+        (area_x * factor + x, area_y * factor + y)
+        for x in range(factor)
+        for y in range(factor)
+    ]
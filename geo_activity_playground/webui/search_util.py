@@ -1,9 +1,15 @@
+import collections
+import json
+import threading
+from collections.abc import Callable
 from typing import Optional
 
 from werkzeug.datastructures import MultiDict
 
 from ..core.config import ConfigAccessor
+from ..core.data_version import DATA_VERSION
 from ..core.meta_search import _parse_date_or_none
+from ..core.meta_search import apply_search_query
 from ..core.meta_search import SearchQuery
 from .authenticator import Authenticator
 
@@ -76,3 +82,38 @@ class SearchQueryHistory:
             search_query = SearchQuery.from_primitives(elem)
             result.append((str(search_query), search_query.to_url_str()))
         return result
+
+
+class SearchResultCache:
+    """
+    Remembers the activities that match a search query until the data changes.
+
+    A map view requests dozens of tiles with the same query at once. Without the cache each of them would run the query against the database. The results are kept as long as `DATA_VERSION` stays the same.
+    """
+
+    MAX_QUERIES = 16
+
+    def __init__(
+        self, data_version: Callable[[], int] = lambda: DATA_VERSION.get()[0]
+    ) -> None:
+        self._data_version = data_version
+        self._results: collections.OrderedDict[str, tuple[int, frozenset[int]]] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get_activity_ids(self, query: SearchQuery) -> frozenset[int]:
+        key = json.dumps(query.to_primitives(), sort_keys=True)
+        version = self._data_version()
+        with self._lock:
+            cached = self._results.get(key, None)
+            if cached is not None and cached[0] == version:
+                self._results.move_to_end(key)
+                return cached[1]
+        activity_ids = frozenset(apply_search_query(query)["id"].tolist())
+        with self._lock:
+            self._results[key] = (version, activity_ids)
+            self._results.move_to_end(key)
+            while len(self._results) > self.MAX_QUERIES:
+                self._results.popitem(last=False)
+        return activity_ids
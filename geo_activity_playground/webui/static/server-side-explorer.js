@@ -1,3 +1,5 @@
+const extra_query = (as_of ? `&as_of=${as_of}` : '') + (filter_args ? `&${filter_args}` : '');
+
 let map = L.map('explorer-map', {
     fullscreenControl: true,
     center: [center_latitude, center_longitude],
@@ -24,27 +26,27 @@ let base_maps = {
 }
 
 let overlay_maps = {
-    "Colorful Cluster": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=colorful_cluster`, {
+    "Colorful Cluster": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=colorful_cluster${extra_query}`, {
         maxZoom: 19,
         attribution: map_tile_attribution
     }),
-    "Max Cluster": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=max_cluster`, {
+    "Max Cluster": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=max_cluster${extra_query}`, {
         maxZoom: 19,
         attribution: map_tile_attribution
     }),
-    "First Visit": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=first`, {
+    "First Visit": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=first${extra_query}`, {
         maxZoom: 19,
         attribution: map_tile_attribution
     }),
-    "Last Visit": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=last`, {
+    "Last Visit": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=last${extra_query}`, {
         maxZoom: 19,
         attribution: map_tile_attribution
     }),
-    "Number of Visits": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=visits`, {
+    "Number of Visits": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=visits${extra_query}`, {
         maxZoom: 19,
         attribution: map_tile_attribution
     }),
-    "Mising": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=missing`, {
+    "Mising": L.tileLayer(`/explorer/${zoom}/tile/{z}/{x}/{y}.png?color_strategy=missing${extra_query}`, {
         maxZoom: 19,
         attribution: map_tile_attribution
     }),
@@ -96,5 +98,12 @@ map.on('click', e => {
 
 function downloadAs(suffix) {
     bounds = map.getBounds();
-    window.location.href = `/explorer/${zoom}/${bounds.getNorth()}/${bounds.getEast()}/${bounds.getSouth()}/${bounds.getWest()}/${suffix}`
+    let url = new URL(`/explorer/${zoom}/${bounds.getNorth()}/${bounds.getEast()}/${bounds.getSouth()}/${bounds.getWest()}/${suffix}`, window.location.origin);
+    if (as_of) {
+        url.searchParams.set('as_of', as_of);
+    }
+    for (const [key, value] of new URLSearchParams(filter_args)) {
+        url.searchParams.append(key, value);
+    }
+    window.location.href = url;
 }
\ No newline at end of file
@@ -0,0 +1,55 @@
+import concurrent.futures
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from ..core.raster_map import OSM_TILE_SIZE
+from ..core.raster_map import TileBounds
+from .heatmap_download import encode_png_stream
+from .heatmap_download import HeatmapDownloadJobs
+from .heatmap_download import render_tile_strips
+
+
+def render_tile(x: int, y: int) -> np.ndarray:
+    tile = np.zeros((OSM_TILE_SIZE, OSM_TILE_SIZE, 4), dtype=np.uint8)
+    tile[..., 0] = x
+    tile[..., 1] = y
+    tile[10:20, 30:40, 3] = 255
+    return tile
+
+
+def test_png_stream() -> None:
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (30, 20, 4), dtype=np.uint8)
+    data = b"".join(encode_png_stream([image[:16], image[16:]], 20, 30))
+    decoded = np.array(Image.open(io.BytesIO(data)))
+    np.testing.assert_array_equal(decoded, image)
+
+
+def test_tile_strips() -> None:
+    tile_bounds = TileBounds(10, 5, 7, 8, 11)
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        strips = list(render_tile_strips(tile_bounds, render_tile, executor))
+    assert len(strips) == 4
+    assert all(strip.shape == (OSM_TILE_SIZE, 3 * OSM_TILE_SIZE, 4) for strip in strips)
+    assert [strip[0, 0, 1] for strip in strips] == [7, 8, 9, 10]
+    assert strips[0][0, ::OSM_TILE_SIZE, 0].tolist() == [5, 6, 7]
+
+
+def test_download_job(tmp_path) -> None:
+    tile_bounds = TileBounds(10, 5, 7, 7, 8)
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        jobs = HeatmapDownloadJobs(tmp_path, executor)
+        job_id = jobs.start(tile_bounds, render_tile)
+        for _ in range(100):
+            if jobs.is_ready(job_id):
+                break
+            time.sleep(0.05)
+    assert jobs.get_progress(job_id) == (1, 1)
+    assert not jobs.is_failed(job_id)
+    image = np.array(Image.open(jobs.get_path(job_id)))
+    assert image.shape == (OSM_TILE_SIZE, 2 * OSM_TILE_SIZE, 4)
+    assert image[15, OSM_TILE_SIZE + 35].tolist() == [6, 7, 0, 255]
+    assert jobs.get_progress("unknown") is None
@@ -0,0 +1,50 @@
+import flask
+import pytest
+
+from ..core.data_version import DATA_VERSION
+from .http_cache import conditional_on_data_version
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app = flask.Flask(__name__)
+    app.renders = []
+
+    @app.route("/tile/<int:x>.png")
+    @conditional_on_data_version
+    def tile(x: int):
+        app.renders.append(x)
+        if x == 0:
+            flask.abort(404)
+        return flask.Response(b"png", mimetype="image/png")
+
+    client = app.test_client()
+    client.renders = app.renders
+    return client
+
+
+def test_not_modified_without_rendering(client) -> None:
+    response = client.get("/tile/1.png")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200 and response.cache_control.no_cache
+    assert client.renders == [1]
+
+    response = client.get("/tile/1.png", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.headers["ETag"] == etag
+    assert client.renders == [1]
+
+
+def test_etag_follows_data_and_query(client) -> None:
+    etag = client.get("/tile/1.png").headers["ETag"]
+    assert client.get("/tile/1.png?color=red").headers["ETag"] != etag
+    assert client.get("/tile/2.png").headers["ETag"] != etag
+
+    DATA_VERSION.bump()
+    response = client.get("/tile/1.png", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+def test_errors_have_no_validators(client) -> None:
+    response = client.get("/tile/0.png")
+    assert response.status_code == 404 and "ETag" not in response.headers
@@ -0,0 +1,119 @@
+import datetime
+
+from ..core.config import Config
+from ..core.heatmap_counts import HeatmapCountStore
+from ..core.heatmap_counts import unpack_activity_ids
+from ..explorer.test_tile_visits import FakeRepository
+from ..explorer.test_tile_visits import make_time_series
+from ..explorer.tile_rendering import ExplorerTileRenderer
+from ..explorer.tile_visits import compute_tile_evolution
+from ..explorer.tile_visits import compute_tile_visits_new
+from ..explorer.tile_visits import TileVisitAccessor
+from .prerender import _map_tiles_in_area
+from .prerender import Prerenderer
+
+
+class FakeConfigAccessor:
+    def __init__(self, config: Config) -> None:
+        self.config = config
+
+    def __call__(self) -> Config:
+        return self.config
+
+
+def test_map_tiles_in_area() -> None:
+    assert _map_tiles_in_area(5, 3, 10, 8) == [(1, 0)]
+    assert _map_tiles_in_area(5, 3, 10, 11) == [(10, 6), (10, 7), (11, 6), (11, 7)]
+
+
+def test_prerender_after_import(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config = Config(explorer_zoom_levels=[14], prerender_zoom_levels=[12, 14])
+    repository = FakeRepository()
+    # Tile coordinates at zoom 19, which are (3200, 6400) and (3300, 6400) at zoom 14.
+    repository.activities[1] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 1),
+            [(3200 * 32 + i, 6400 * 32) for i in range(10)],
+        ),
+    )
+    tile_visit_accessor = TileVisitAccessor()
+    tile_visit_accessor.reset()
+    compute_tile_visits_new(repository, tile_visit_accessor)
+    compute_tile_evolution(tile_visit_accessor.tile_state, config)
+    tile_visit_accessor.save()
+
+    renderer = ExplorerTileRenderer(tile_visit_accessor, tmp_path / "Explorer")
+    heatmap_counts = HeatmapCountStore(tmp_path / "Heatmap Counts")
+    prerenderer = Prerenderer(
+        repository,
+        tile_visit_accessor,
+        FakeConfigAccessor(config),
+        renderer,
+        heatmap_counts,
+    )
+    old_path = renderer.get_tile_path(14, "colorful_cluster", 14, 3200, 6400)
+    prerenderer.record_view(14, 3200, 6400)
+
+    snapshot = prerenderer.snapshot()
+    repository.activities[2] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 2),
+            [(3300 * 32 + i, 6400 * 32) for i in range(10)],
+        ),
+    )
+    compute_tile_visits_new(repository, tile_visit_accessor)
+    compute_tile_evolution(tile_visit_accessor.tile_state, config)
+    tile_visit_accessor.save()
+    old_content = old_path.read_bytes()
+    prerenderer.run(snapshot)
+
+    strategy_dir = tmp_path / "Explorer" / "14" / "colorful_cluster"
+    # The unchanged tile is kept, the tiles of the new activity have been rendered.
+    assert old_path.read_bytes() == old_content
+    assert (strategy_dir / "14" / "3300" / "6400.png").exists()
+    assert (strategy_dir / "12" / "825" / "1600.png").exists()
+    # The most viewed area has been warmed up.
+    assert (strategy_dir / "14" / "3201" / "6401.png").exists()
+    # Heatmap counts of the new activity are up to date.
+    assert 1 in unpack_activity_ids(
+        heatmap_counts._get_chunk(3200, 6400, 14).applied[(3200, 6400)]
+    )
+    assert 2 in unpack_activity_ids(
+        heatmap_counts._get_chunk(3300, 6400, 14).applied[(3300, 6400)]
+    )
+    heatmap_counts.close()
+
+
+def test_snapshot_and_view_counts(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config = Config(explorer_zoom_levels=[14])
+    tile_visit_accessor = TileVisitAccessor()
+    tile_visit_accessor.reset()
+    renderer = ExplorerTileRenderer(tile_visit_accessor, tmp_path / "Explorer")
+    prerenderer = Prerenderer(
+        FakeRepository(),
+        tile_visit_accessor,
+        FakeConfigAccessor(config),
+        renderer,
+        HeatmapCountStore(tmp_path / "Heatmap Counts"),
+    )
+    # Nothing has been rendered, so the snapshot doesn't build the tiles.
+    assert prerenderer.snapshot().tables == {}
+    renderer.get_table(14)
+    assert set(prerenderer.snapshot().tables) == {14}
+
+    prerenderer.VIEW_COUNTS_SAVE_INTERVAL = 0
+    prerenderer.record_view(12, 800, 1600)
+    restarted = Prerenderer(
+        FakeRepository(),
+        tile_visit_accessor,
+        FakeConfigAccessor(config),
+        renderer,
+        HeatmapCountStore(tmp_path / "Heatmap Counts"),
+    )
+    assert restarted._view_counts == {"200/400": 1}
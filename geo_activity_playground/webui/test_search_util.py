@@ -0,0 +1,27 @@
+import pandas as pd
+
+from . import search_util
+from ..core.meta_search import SearchQuery
+from .search_util import SearchResultCache
+
+
+def test_search_results_are_cached(monkeypatch) -> None:
+    queries = []
+
+    def apply_search_query(query: SearchQuery) -> pd.DataFrame:
+        queries.append(query)
+        return pd.DataFrame({"id": [3, 5]}, index=[0, 1])
+
+    monkeypatch.setattr(search_util, "apply_search_query", apply_search_query)
+    version = [0]
+    cache = SearchResultCache(data_version=lambda: version[0])
+    query = SearchQuery(name="Run")
+    assert cache.get_activity_ids(query) == {3, 5}
+    assert cache.get_activity_ids(SearchQuery(name="Run")) == {3, 5}
+    assert len(queries) == 1
+    cache.get_activity_ids(SearchQuery(name="Ride"))
+    assert len(queries) == 2
+
+    version[0] = 1
+    cache.get_activity_ids(query)
+    assert len(queries) == 3
@@ -0,0 +1,53 @@
+import datetime
+import threading
+
+from ..core.config import Config
+from ..explorer.test_tile_visits import FakeRepository
+from ..explorer.test_tile_visits import make_time_series
+from ..explorer.tile_visits import TileVisitAccessor
+from ..explorer.tile_visits import update_tile_state
+from .test_zoom_backfill import FakeConfigAccessor
+from .tile_updates import TileStateUpdates
+
+
+def test_deleted_activity_in_background(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config_accessor = FakeConfigAccessor(Config(explorer_zoom_levels=[14]))
+    repository = FakeRepository()
+    for activity_id, x in [(1, 100), (2, 300)]:
+        repository.activities[activity_id] = (
+            True,
+            make_time_series(
+                datetime.datetime(2024, 1, activity_id),
+                [(x * 32, 200 * 32)],
+            ),
+        )
+    tile_visit_accessor = TileVisitAccessor()
+    tile_visit_accessor.reset()
+    update_tile_state(repository, tile_visit_accessor, config_accessor())
+
+    tile_state_updates = TileStateUpdates(
+        repository, tile_visit_accessor, config_accessor
+    )
+    # The job is not started, such that it can be run synchronously.
+    tile_state_updates._start = lambda: None
+    del repository.activities[2]
+    tile_state_updates.schedule(2)
+    assert tile_state_updates.is_pending()
+    # A restart remembers the pending activity.
+    assert TileStateUpdates(
+        repository, tile_visit_accessor, config_accessor
+    ).is_pending()
+
+    # The update waits for others that change the tile state, like the importer.
+    with tile_visit_accessor.lock:
+        thread = threading.Thread(target=tile_state_updates.run)
+        thread.start()
+        thread.join(0.2)
+        assert tile_state_updates.is_pending()
+    thread.join()
+    assert not tile_state_updates.is_pending()
+    tile_state = tile_visit_accessor.tile_state
+    assert set(tile_state["tiles_per_activity"]) == {1}
+    assert set(tile_state["tile_visits"][14]) == {(100, 200)}
@@ -0,0 +1,102 @@
+import datetime
+
+from . import zoom_backfill as zoom_backfill_module
+from ..core.config import Config
+from ..explorer.test_tile_visits import FakeRepository
+from ..explorer.test_tile_visits import make_time_series
+from ..explorer.tile_visits import compute_tile_evolution
+from ..explorer.tile_visits import compute_tile_visits_new
+from ..explorer.tile_visits import remove_activity_from_tile_state
+from ..explorer.tile_visits import replay_tile_evolution
+from ..explorer.tile_visits import TileVisitAccessor
+from .zoom_backfill import ZoomBackfill
+
+
+class FakeConfigAccessor:
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.num_saves = 0
+
+    def __call__(self) -> Config:
+        return self.config
+
+    def save(self) -> None:
+        self.num_saves += 1
+
+
+def test_backfill_enables_zoom_level(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config_accessor = FakeConfigAccessor(Config(explorer_zoom_levels=[14]))
+    repository = FakeRepository()
+    repository.activities[1] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 1),
+            [(x * 2, y * 2) for x in range(100, 104) for y in range(200, 204)],
+        ),
+    )
+    tile_visit_accessor = TileVisitAccessor()
+    tile_visit_accessor.reset()
+    compute_tile_visits_new(repository, tile_visit_accessor)
+    compute_tile_evolution(tile_visit_accessor.tile_state, config_accessor())
+    tile_visit_accessor.save()
+
+    zoom_backfill = ZoomBackfill(tile_visit_accessor, config_accessor)
+    # The job is not started, such that it can be run synchronously.
+    zoom_backfill._start = lambda zoom: None
+    zoom_backfill.schedule(18)
+    assert zoom_backfill.is_pending(18)
+    assert config_accessor().explorer_zoom_levels == [14]
+    # A restart remembers the pending zoom level.
+    assert ZoomBackfill(tile_visit_accessor, config_accessor).is_pending(18)
+
+    zoom_backfill.run(18)
+    assert not zoom_backfill.is_pending(18)
+    assert config_accessor().explorer_zoom_levels == [14, 18]
+    assert config_accessor.num_saves == 1
+    evolution_state = tile_visit_accessor.tile_state["evolution_state"][18]
+    assert evolution_state.max_square_size == 4
+    assert not ZoomBackfill(tile_visit_accessor, config_accessor).is_pending(18)
+
+
+def test_backfill_restarts_when_history_changes(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Cache").mkdir()
+    config_accessor = FakeConfigAccessor(Config(explorer_zoom_levels=[14]))
+    repository = FakeRepository()
+    repository.activities[1] = (
+        True,
+        make_time_series(
+            datetime.datetime(2024, 1, 1),
+            [(x * 2, y * 2) for x in range(100, 104) for y in range(200, 204)],
+        ),
+    )
+    repository.activities[2] = (
+        True,
+        make_time_series(datetime.datetime(2024, 2, 1), [(300, 300)]),
+    )
+    tile_visit_accessor = TileVisitAccessor()
+    tile_visit_accessor.reset()
+    compute_tile_visits_new(repository, tile_visit_accessor)
+
+    # An activity is deleted while the first replay runs.
+    replay_sizes = []
+
+    def replay_and_delete(tiles, evolution_state, zoom, progress=None):
+        replay_sizes.append(len(tiles))
+        if len(replay_sizes) == 1:
+            remove_activity_from_tile_state(tile_visit_accessor.tile_state, 1)
+        return replay_tile_evolution(tiles, evolution_state, zoom, progress)
+
+    monkeypatch.setattr(
+        zoom_backfill_module, "replay_tile_evolution", replay_and_delete
+    )
+    zoom_backfill = ZoomBackfill(tile_visit_accessor, config_accessor)
+    zoom_backfill._start = lambda zoom: None
+    zoom_backfill.schedule(18)
+    zoom_backfill.run(18)
+    assert replay_sizes == [17, 1]
+    evolution_state = tile_visit_accessor.tile_state["evolution_state"][18]
+    assert evolution_state.max_square_size == 1
+    assert len(evolution_state.visited_tiles) == 1
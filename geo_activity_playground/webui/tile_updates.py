@@ -0,0 +1,102 @@
+import contextlib
+import logging
+import queue
+import threading
+from typing import Optional
+
+from flask import Flask
+
+from ..core.activities import ActivityRepository
+from ..core.config import ConfigAccessor
+from ..core.paths import cache_dir
+from ..core.tasks import get_state
+from ..core.tasks import set_state
+from ..explorer.tile_visits import remove_activity_from_tile_state
+from ..explorer.tile_visits import TileVisitAccessor
+from ..explorer.tile_visits import update_tile_state
+
+logger = logging.getLogger(__name__)
+
+
+class TileStateUpdates:
+    """
+    Updates the explorer tiles of activities that have been deleted or changed in the background, such that the request doesn't wait for it.
+
+    Pending activities are remembered on disk, so after a restart the job continues with them. Activities that are scheduled while an update runs are handled together in the next one.
+    """
+
+    def __init__(
+        self,
+        repository: ActivityRepository,
+        tile_visit_accessor: TileVisitAccessor,
+        config_accessor: ConfigAccessor,
+        app: Optional[Flask] = None,
+    ) -> None:
+        """
+        `app` provides the application context in which the time series are read from the database.
+        """
+        self.repository = repository
+        self.tile_visit_accessor = tile_visit_accessor
+        self.config_accessor = config_accessor
+        self.app = app
+        self._pending_path = cache_dir() / "tile-state-updates.json"
+        self._pending: list[int] = get_state(self._pending_path, [])
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[None] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def resume(self) -> None:
+        if self._pending:
+            self._start()
+
+    def schedule(self, activity_id: int) -> None:
+        with self._lock:
+            if activity_id not in self._pending:
+                self._pending.append(activity_id)
+                set_state(self._pending_path, self._pending)
+        self._start()
+
+    def is_pending(self) -> bool:
+        with self._lock:
+            return bool(self._pending)
+
+    def run(self) -> None:
+        with self._lock:
+            activity_ids = list(self._pending)
+        if not activity_ids:
+            return
+        with self.tile_visit_accessor.lock:
+            tile_state = self.tile_visit_accessor.tile_state
+            for activity_id in activity_ids:
+                # Changed activities are added again by `update_tile_state`, deleted ones are not.
+                remove_activity_from_tile_state(tile_state, activity_id)
+            update_tile_state(
+                self.repository, self.tile_visit_accessor, self.config_accessor()
+            )
+        with self._lock:
+            self._pending = [
+                activity_id
+                for activity_id in self._pending
+                if activity_id not in activity_ids
+            ]
+            set_state(self._pending_path, self._pending)
+        logger.info(f"Explorer tiles of activities {activity_ids} are up to date.")
+
+    def _start(self) -> None:
+        self._queue.put(None)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            self._queue.get()
+            try:
+                with (
+                    self.app.app_context()
+                    if self.app is not None
+                    else contextlib.nullcontext()
+                ):
+                    self.run()
+            except Exception:
+                logger.exception("Updating the explorer tiles has failed.")
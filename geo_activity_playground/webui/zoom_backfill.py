@@ -0,0 +1,114 @@
+import logging
+import queue
+import threading
+from typing import Optional
+
+from ..core.config import ConfigAccessor
+from ..core.paths import cache_dir
+from ..core.tasks import get_state
+from ..core.tasks import set_state
+from ..explorer.tile_visits import get_tile_history
+from ..explorer.tile_visits import history_fingerprint
+from ..explorer.tile_visits import mark_tile_state_changed
+from ..explorer.tile_visits import replay_tile_evolution
+from ..explorer.tile_visits import TileEvolutionState
+from ..explorer.tile_visits import TileVisitAccessor
+
+logger = logging.getLogger(__name__)
+
+
+class ZoomBackfill:
+    """
+    Computes the explorer evolution of a newly enabled zoom level in the background.
+
+    The zoom level is only added to the configuration once its clusters and squares are complete, until then the explorer page shows the progress. Pending zoom levels are remembered on disk and the replay writes checkpoints, so after a restart the job continues where it has stopped.
+    """
+
+    def __init__(
+        self, tile_visit_accessor: TileVisitAccessor, config_accessor: ConfigAccessor
+    ) -> None:
+        self.tile_visit_accessor = tile_visit_accessor
+        self.config_accessor = config_accessor
+        self._pending_path = cache_dir() / "explorer-zoom-backfill.json"
+        self._pending: list[int] = get_state(self._pending_path, [])
+        self._progress: dict[int, tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[int] = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def resume(self) -> None:
+        for zoom in self._pending:
+            self._start(zoom)
+
+    def schedule(self, zoom: int) -> None:
+        with self._lock:
+            if zoom in self._pending:
+                return
+            self._pending.append(zoom)
+            set_state(self._pending_path, self._pending)
+        self._start(zoom)
+
+    def is_pending(self, zoom: int) -> bool:
+        with self._lock:
+            return zoom in self._pending
+
+    def get_progress(self, zoom: int) -> tuple[int, int]:
+        """
+        Number of replayed tiles and the total number of tiles of a pending zoom level.
+        """
+        with self._lock:
+            return self._progress.get(zoom, (0, 0))
+
+    def run(self, zoom: int) -> None:
+        # The state is replayed outside of the lock of the tile state and only swapped in at the end, such that imports can continue in the meantime.
+        evolution_state = TileEvolutionState()
+        while True:
+            with self.tile_visit_accessor.lock:
+                tiles = get_tile_history(self.tile_visit_accessor.tile_state, zoom)
+                fingerprint = history_fingerprint(tiles, len(tiles))
+            evolution_state = replay_tile_evolution(
+                tiles,
+                evolution_state,
+                zoom,
+                progress=lambda done, total: self._set_progress(zoom, done, total),
+            )
+            with self.tile_visit_accessor.lock:
+                tile_state = self.tile_visit_accessor.tile_state
+                current = get_tile_history(tile_state, zoom)
+                if history_fingerprint(current, len(current)) == fingerprint:
+                    tile_state["evolution_state"][zoom] = evolution_state
+                    mark_tile_state_changed(tile_state)
+                    self.tile_visit_accessor.save()
+                    break
+                # Activities have been imported or removed during the replay. Appended tiles can be replayed on top, otherwise the replay starts over.
+                if history_fingerprint(current, len(tiles)) != fingerprint:
+                    evolution_state = TileEvolutionState()
+
+        config = self.config_accessor()
+        if zoom not in config.explorer_zoom_levels:
+            config.explorer_zoom_levels.append(zoom)
+            config.explorer_zoom_levels.sort()
+            self.config_accessor.save()
+        with self._lock:
+            self._pending.remove(zoom)
+            self._progress.pop(zoom, None)
+            set_state(self._pending_path, self._pending)
+        logger.info(f"Explorer tiles for {zoom=} are ready.")
+
+    def _set_progress(self, zoom: int, done: int, total: int) -> None:
+        with self._lock:
+            self._progress[zoom] = (done, total)
+
+    def _start(self, zoom: int) -> None:
+        self._queue.put(zoom)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            zoom = self._queue.get()
+            try:
+                self.run(zoom)
+            except Exception:
+                logger.exception(f"Computing explorer tiles for {zoom=} has failed.")